@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Bayesian adaptive choice of the delays in time-domain experiments.
+
+The posterior over the fit parameters is approximated by a Gaussian (Laplace approximation) around
+the weighted least-squares fit of all the data so far, with the fit covariance. Each batch measures
+the delays that maximize the expected information gain, i.e. the reduction in entropy of the
+posterior, chosen greedily from a grid of candidates with a rank-one update of the covariance after
+each choice. The same delay can be chosen more than once in a batch.
+"""
+from typing import Callable, Tuple
+
+import numpy as np
+
+from _rotate import rotation_angle
+
+
+def run_adaptive(
+    candidates: np.ndarray,
+    measure: Callable[[np.ndarray], np.ndarray],
+    model: Callable,
+    fit: Callable,
+    param_idx: int,
+    rel_target: float,
+    nr_delays: int,
+    batch_averages: int,
+    max_batches: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Measure in batches until the relative uncertainty on one fit parameter reaches a target.
+
+    Args:
+        candidates: grid of delays to choose from. The first batch measures `nr_delays` of them,
+            evenly spaced.
+        measure: `measure(delay_arr)` runs one batch with `batch_averages` averages and returns the
+            complex response at each delay.
+        model: fit function `model(t, *p)`.
+        fit: `fit(t, x)` returns `(popt, perr)` for the first batch, when there's no estimate yet.
+        param_idx: index in `p` of the parameter of interest, e.g. the decay time.
+        rel_target: stop when the standard error on `p[param_idx]` is below `rel_target` times
+            its value.
+        nr_delays: number of delays per batch.
+        batch_averages: number of averages per batch.
+        max_batches: stop anyway after this many batches.
+
+    Returns:
+        `(delay_arr, resp_arr, count_arr, delay_hist_arr, popt_hist_arr, perr_hist_arr)`: the
+        candidate delays that were measured at least once, the response averaged over all the
+        batches and the number of averages at each of them, and for each batch the delays
+        measured, the parameter estimate and its standard error after the batch.
+    """
+    candidates = np.atleast_1d(candidates).astype(np.float64)
+    nr_candidates = len(candidates)
+    resp_sum = np.zeros(nr_candidates, np.complex128)
+    count = np.zeros(nr_candidates, np.int64)
+
+    delay_hist = []
+    popt_hist = []
+    perr_hist = []
+
+    # first batch: evenly spaced on the grid
+    idx = np.unique(np.round(np.linspace(0, nr_candidates - 1, nr_delays)).astype(np.int64))
+    popt = None
+    rotation = None  # fixed after the first batch, so that the fits stay consistent
+    for batch in range(max_batches):
+        resp = measure(candidates[idx])
+        np.add.at(resp_sum, idx, batch_averages * resp)
+        np.add.at(count, idx, batch_averages)
+        delay_hist.append(_pad(candidates[idx], nr_delays))
+
+        measured = count > 0
+        t = candidates[measured]
+        resp_avg = resp_sum[measured] / count[measured]
+        if rotation is None:
+            rotation = np.exp(1j * rotation_angle(resp_avg))
+        x = np.real(rotation * resp_avg)
+        try:
+            popt, pcov, s2 = _fit_weighted(model, fit, t, x, count[measured], popt)
+        except Exception as err:
+            print(f"adaptive: unable to fit after batch {batch + 1}: {err}")
+            popt = None
+            nr_params = popt_hist[-1].shape[0] if popt_hist else 0
+            popt_hist.append(np.full(nr_params, np.nan))
+            perr_hist.append(np.full(nr_params, np.nan))
+            # fall back to the least measured candidates
+            idx = np.sort(np.argsort(count, kind="stable")[:nr_delays])
+            continue
+        perr = np.sqrt(np.diag(pcov))
+        popt_hist.append(popt)
+        perr_hist.append(perr)
+
+        rel_err = perr[param_idx] / abs(popt[param_idx])
+        print(f"adaptive: batch {batch + 1}, relative error {rel_err:.3g}")
+        if rel_err < rel_target:
+            break
+
+        idx = _next_delays(model, candidates, popt, pcov, s2, nr_delays, batch_averages)
+
+    if popt_hist:
+        nr_params = max(len(p) for p in popt_hist)
+        popt_hist = [_pad(p, nr_params) for p in popt_hist]
+        perr_hist = [_pad(p, nr_params) for p in perr_hist]
+
+    measured = count > 0
+    return (
+        candidates[measured],
+        resp_sum[measured] / count[measured],
+        count[measured],
+        np.array(delay_hist),
+        np.array(popt_hist),
+        np.array(perr_hist),
+    )
+
+
+def _fit_weighted(model, fit, t, x, count, p0):
+    from scipy.optimize import curve_fit
+
+    if p0 is None:
+        p0, _ = fit(t, x)
+    sigma = 1.0 / np.sqrt(count)
+    popt, pcov = curve_fit(model, t, x, p0=p0, sigma=sigma)
+    if not np.all(np.isfinite(pcov)):
+        raise RuntimeError("covariance of the parameters could not be estimated")
+    # noise variance for a single average
+    dof = max(len(t) - len(popt), 1)
+    s2 = np.sum(count * (x - model(t, *popt)) ** 2) / dof
+    return popt, pcov, s2
+
+
+def _jacobian(model, t, p):
+    p = np.asarray(p, np.float64)
+    jac = np.zeros((len(t), len(p)))
+    for kk in range(len(p)):
+        step = 1e-6 * max(abs(p[kk]), 1e-12)
+        p_hi = p.copy()
+        p_lo = p.copy()
+        p_hi[kk] += step
+        p_lo[kk] -= step
+        jac[:, kk] = (model(t, *p_hi) - model(t, *p_lo)) / (2 * step)
+    return jac
+
+
+def _next_delays(model, candidates, popt, pcov, s2, nr_delays, batch_averages):
+    # greedy maximization of the expected information gain of the batch
+    jac = _jacobian(model, candidates, popt)
+    noise = s2 / batch_averages
+    cov = pcov.copy()
+    idx = np.zeros(nr_delays, np.int64)
+    for ii in range(nr_delays):
+        pred_var = np.einsum("ij,jk,ik->i", jac, cov, jac)
+        kk = int(np.argmax(np.log1p(pred_var / noise)))
+        idx[ii] = kk
+        cov_j = cov @ jac[kk]
+        cov -= np.outer(cov_j, cov_j) / (noise + jac[kk] @ cov_j)
+    return np.sort(idx)
+
+
+def _pad(arr, length):
+    ret = np.full(length, np.nan)
+    ret[: len(arr)] = arr
+    return ret
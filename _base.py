@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
 import time
-from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import h5py
 import numpy as np
 
-from presto.utils import get_sourcecode
+from _cache import Results, cached
+from _reset import ActiveReset
 
 
 class Base:
@@ -14,7 +16,31 @@ class Base:
     Base class for measurements
     """
 
-    def save(self, script_path: str, save_filename: Optional[str] = None) -> str:
+    def save(
+        self,
+        script_path: str,
+        save_filename: Optional[str] = None,
+        compression: Union[None, str, Dict[str, Optional[str]]] = None,
+        shuffle: bool = False,
+        downcast: bool = False,
+    ) -> str:
+        """Save all public attributes to an HDF5 file.
+
+        Scalars are saved as attributes, arrays as datasets. Uncompressed arrays are contiguous on
+        disk. Compressed multi-dimensional arrays are chunked with one entry along the first axis
+        per chunk, i.e. one repetition/delay/row, to match how they are read during analysis.
+
+        Args:
+            script_path: path of the measurement script, its source code is saved in the file.
+            save_filename: if `None`, save to `data/<script>_<timestamp>.h5` next to the script.
+            compression: lossless compression filter, `"gzip"` or `"lzf"`. Either one filter for
+                all array datasets, or a dictionary mapping dataset names to filters (missing
+                names are not compressed).
+            shuffle: enable the shuffle filter on compressed datasets.
+            downcast: save complex arrays in single precision (complex64).
+        """
+        from presto.utils import get_sourcecode
+
         script_path = os.path.realpath(script_path)  # full path of current script
 
         if save_filename is None:
@@ -31,9 +57,7 @@ class Base:
         )  # save also the sourcecode of the script for future reference
         with h5py.File(save_path, "w") as h5f:
             dt = h5py.string_dtype(encoding="utf-8")
-            ds = h5f.create_dataset("source_code", (len(source_code),), dt)
-            for ii, line in enumerate(source_code):
-                ds[ii] = line
+            h5f.create_dataset("source_code", data=source_code, dtype=dt)
 
             for attribute in self.__dict__:
                 if attribute.startswith("_"):
@@ -41,30 +65,497 @@ class Base:
                     continue
                 if attribute in ["jpa_params", "clear"]:
                     h5f.attrs[attribute] = str(self.__dict__[attribute])
+                elif isinstance(self.__dict__[attribute], ActiveReset):
+                    self.__dict__[attribute].save(h5f, attribute)
+                elif self.__dict__[attribute] is None:
+                    # not acquired (yet)
+                    continue
                 elif np.isscalar(self.__dict__[attribute]):
                     h5f.attrs[attribute] = self.__dict__[attribute]
                 else:
-                    h5f.create_dataset(attribute, data=self.__dict__[attribute])
+                    if isinstance(compression, dict):
+                        filter_ = compression.get(attribute)
+                    else:
+                        filter_ = compression
+                    _create_dataset(
+                        h5f,
+                        attribute,
+                        self.__dict__[attribute],
+                        compression=filter_,
+                        shuffle=shuffle,
+                        downcast=downcast,
+                    )
         print(f"Data saved to: {save_path}")
+        self._filename = save_path  # where the analysis is cached
         return save_path
 
+    def _save_rows_init(
+        self,
+        script_path: str,
+        save_filename: Optional[str],
+        rows_shape: Tuple[int, ...],
+        datasets: Dict[str, Tuple[Tuple[int, ...], type]],
+    ) -> str:
+        """Create the save file for a sweep that is saved one row at a time with `_save_row`.
+
+        Public attributes are saved as in `save`. The datasets in `datasets` (name -> shape,
+        dtype) are preallocated and filled with NaN (zero for integers), with one row (last axis)
+        per chunk. The boolean dataset `rows_done` with shape `rows_shape` keeps track of the
+        completed rows.
+        """
+        save_path = Base.save(self, script_path, save_filename=save_filename)
+        with h5py.File(save_path, "a") as h5f:
+            for name, (shape, dtype) in datasets.items():
+                ds = h5f.create_dataset(
+                    name,
+                    shape=shape,
+                    dtype=dtype,
+                    chunks=(1,) * (len(shape) - 1) + shape[-1:],
+                )
+                if not np.issubdtype(dtype, np.inexact):
+                    continue  # integer datasets are left to zero
+                nan_row = np.full(shape[-1], np.nan, dtype)
+                for idx in np.ndindex(shape[:-1]):
+                    ds[idx] = nan_row
+            h5f.create_dataset("rows_done", shape=rows_shape, dtype=bool)
+        return save_path
+
+    def _save_row(self, row, idx=None, **data) -> None:
+        """Write one row of data to the save file and mark it as completed.
+
+        Args:
+            row: index in `rows_done`
+            idx: index in the datasets, if different from `row`
+            data: dataset name -> data of the row
+        """
+        if idx is None:
+            idx = row
+        with h5py.File(self._save_filename, "a") as h5f:
+            for name, value in data.items():
+                h5f[name][idx] = value
+            h5f["rows_done"][row] = True
+
+    def _load_rows_done(self) -> np.ndarray:
+        with h5py.File(self._save_filename, "r") as h5f:
+            return h5f["rows_done"][()]
+
+    @staticmethod
+    def _open_load(load_filename: str, lazy: bool = False) -> h5py.File:
+        """Open the file to load from, for `load`.
+
+        With `lazy`, open it for writing if possible. The lazily loaded datasets keep the file
+        open, and a file open read-only can't be opened again for writing in the same process,
+        e.g. to cache the analysis in it.
+        """
+        if lazy:
+            try:
+                return h5py.File(load_filename, "r+")
+            except OSError:
+                pass  # e.g. read-only file, or open elsewhere: nothing will be cached
+        return h5py.File(load_filename, "r")
+
+    @staticmethod
+    def _load_array(h5f: h5py.File, name: str, lazy: bool = False):
+        """Read dataset `name` from an open file.
+
+        If `lazy` is `True`, don't read the data and return an array-like that reads from disk
+        only the part that is actually indexed: a read-only `np.memmap` if the dataset is
+        contiguous and uncompressed, otherwise an `h5py.Dataset` on a new handle to the file, in
+        the same mode as `h5f` (see `_open_load`), that stays open as long as the dataset is
+        referenced.
+        """
+        ds = h5f[name]
+        if not lazy:
+            return ds[()]
+        offset = ds.id.get_offset()
+        if ds.chunks is None and offset is not None and ds.dtype.kind in "biufc":
+            return np.memmap(
+                h5f.filename, dtype=ds.dtype, mode="r", offset=offset, shape=ds.shape
+            )
+        return h5py.File(h5f.filename, h5f.mode)[name]
+
+    def _cached(
+        self,
+        name: str,
+        inputs: Dict[str, Any],
+        params: Dict[str, Any],
+        compute: Callable[[], Results],
+        recompute: bool = False,
+    ) -> Results:
+        """Results of analysis `name`, cached in the data file, see `_cache.cached`.
+
+        Nothing is cached if the data was neither saved nor loaded.
+        """
+        filename = getattr(self, "_filename", "")
+        return cached(filename, name, inputs, params, compute, recompute)
+
+    def _readout_inputs(self, idx_low: int, idx_high: int) -> Dict[str, Any]:
+        """The raw data used by `_readout_resp`, for the key of the analysis cache."""
+        integrated_arr = getattr(self, "integrated_arr", None)
+        if integrated_arr is not None:
+            return {"integrated_arr": integrated_arr}
+        return {"store_arr": self.store_arr[:, 0, idx_low:idx_high]}
+
+    def _readout_resp(self, idx_low: int, idx_high: int) -> np.ndarray:
+        """Readout averaged over the integration window, one complex number per readout.
+
+        Uses the result of on-instrument integration (`integrate=True`) if available, otherwise the
+        mean over samples `idx_low` to `idx_high` of the stored traces.
+        """
+        integrated_arr = getattr(self, "integrated_arr", None)
+        if integrated_arr is not None:
+            return integrated_arr
+        return np.mean(self.store_arr[:, 0, idx_low:idx_high], axis=-1)
+
+
+CHUNK_MIN_SIZE = 1 << 16  # bytes, h5py chooses the chunks for smaller arrays
+CHUNK_MAX_SIZE = 1 << 20  # bytes
+
+
+def _chunk_shape(shape: Tuple[int, ...], itemsize: int) -> Tuple[int, ...]:
+    # one entry of the first axis per chunk, e.g. one repetition or one delay
+    # split further along the following axes if that is still too large
+    chunks = [1] + list(shape[1:])
+    for axis in range(1, len(shape) - 1):
+        if np.prod(chunks) * itemsize <= CHUNK_MAX_SIZE:
+            break
+        chunks[axis] = 1
+    return tuple(chunks)
 
-def project(resp_arr, reference_templates):
+
+def _create_dataset(
+    h5f: h5py.Group,
+    name: str,
+    data,
+    compression: Optional[str] = None,
+    shuffle: bool = False,
+    downcast: bool = False,
+) -> h5py.Dataset:
+    data = np.asarray(data)
+    if downcast and data.dtype == np.complex128:
+        data = data.astype(np.complex64)
+
+    if compression is None or data.ndim == 0:
+        chunks = None  # contiguous
+        compression = None
+    elif data.ndim > 1 and data.nbytes >= CHUNK_MIN_SIZE:
+        chunks = _chunk_shape(data.shape, data.dtype.itemsize)
+    else:
+        chunks = True  # let h5py choose
+
+    return h5f.create_dataset(
+        name,
+        data=data,
+        chunks=chunks,
+        compression=compression,
+        shuffle=shuffle and compression is not None,
+    )
+
+
+def project(resp_arr, reference_templates, chunk_size: Optional[int] = None):
+    """Project traces onto the reference templates for |g> and |e>.
+
+    The projection is a single matrix-vector product over the last (sample) axis, so any number of
+    leading batch dimensions is accepted, e.g. (repeat, delay, port, sample). Single-precision
+    (complex64) input is not upcast.
+
+    Args:
+        resp_arr: traces with shape (..., nr_samples). Anything that can be sliced along the first
+            axis is accepted, e.g. `h5py.Dataset` or `np.memmap`.
+        reference_templates: tuple `(ref_g, ref_e)` of templates with length `nr_samples`.
+        chunk_size: if not `None`, process `chunk_size` entries along the first axis at a time, so
+            that at most one chunk of `resp_arr` is loaded in memory.
+
+    Returns:
+        real array with shape `resp_arr.shape[:-1]`: 0 for a trace equal to `ref_g`, 1 for `ref_e`.
+    """
     ref_g, ref_e = reference_templates
-    conj_g = ref_g.conj()
-    conj_e = ref_e.conj()
-    norm_g = np.sum(ref_g * conj_g).real
-    norm_e = np.sum(ref_e * conj_e).real
-    overlap = np.sum(ref_g * conj_e).real
-    proj_g = np.zeros(resp_arr.shape[0])
-    proj_e = np.zeros(resp_arr.shape[0])
-    for i in range(resp_arr.shape[0]):
-        proj_g[i] = np.sum(conj_g * resp_arr[i, :]).real
-        proj_e[i] = np.sum(conj_e * resp_arr[i, :]).real
-    res = proj_e - proj_g
-    res_g = overlap - norm_g
-    res_e = norm_e - overlap
-    res_min = res_g
-    res_rng = res_e - res_g
-    data = (res - res_min) / res_rng
+    ref_g = np.asarray(ref_g)
+    ref_e = np.asarray(ref_e)
+    norm_g = float(np.sum(ref_g * ref_g.conj()).real)
+    norm_e = float(np.sum(ref_e * ref_e.conj()).real)
+    overlap = float(np.sum(ref_g * ref_e.conj()).real)
+    res_min = overlap - norm_g
+    res_rng = norm_e - overlap - res_min
+
+    if not hasattr(resp_arr, "dtype"):
+        resp_arr = np.asarray(resp_arr)
+    dtype = np.result_type(resp_arr.dtype, np.complex64)
+    # proj_e - proj_g = Re(<resp, ref_e>) - Re(<resp, ref_g>) = Re(<resp, ref_e - ref_g>)
+    weights = (ref_e - ref_g).conj().astype(dtype)
+
+    def _project(x):
+        res = np.matmul(np.asarray(x, dtype=dtype), weights).real
+        return (res - res_min) / res_rng
+
+    shape = resp_arr.shape
+    if chunk_size is None or len(shape) < 2:
+        return _project(resp_arr[()])
+
+    data = np.empty(shape[:-1], dtype=weights.real.dtype)
+    for start in range(0, shape[0], chunk_size):
+        stop = min(start + chunk_size, shape[0])
+        data[start:stop] = _project(resp_arr[start:stop])
     return data
+
+
+INTEGRATION_FS = 1e9  # Hz, sample rate of the store data and of the template-matching templates
+
+
+def setup_integration(pls, input_port: int, idx_low: int, idx_high: int):
+    """Integrate the readout on the instrument instead of storing the full trace.
+
+    Sets up a pair of template matches with a boxcar weight that sum the in-phase and quadrature
+    components of the samples `idx_low` to `idx_high` of what would be the store window. Only two
+    numbers per shot are then transferred from the instrument, instead of the full trace.
+
+    Args:
+        pls: the `pulsed.Pulsed` instance.
+        input_port: the sample port.
+        idx_low: first sample of the integration window, counted from the start of the store.
+        idx_high: one past the last sample of the integration window.
+
+    Returns:
+        `(matches, match_delay)`: pass `matches` to `pls.match` at `match_delay` seconds after
+        where `pls.store` would be called, and to `get_integration_data` after the run.
+    """
+    boxcar = np.ones(idx_high - idx_low, np.float64)
+    matches = pls.setup_template_matching_pair(
+        input_port=input_port,
+        template1=boxcar,  # Re(<trace, 1>) = I
+        template2=1j * boxcar,  # Re(<trace, 1j>) = Q
+    )
+    return matches, idx_low / INTEGRATION_FS
+
+
+def get_integration_data(pls, matches, nr_points: int, nr_samples: int) -> np.ndarray:
+    """Average the integrated readout set up by `setup_integration` over all shots.
+
+    Args:
+        pls: the `pulsed.Pulsed` instance, after `run`.
+        matches: as returned by `setup_integration`.
+        nr_points: number of matches per average, i.e. `repeat_count` times the matches per
+            sequence.
+        nr_samples: length of the integration window, `idx_high - idx_low`.
+
+    Returns:
+        complex array with shape `(nr_points,)`, the mean over the integration window of the
+        averaged trace, i.e. what `np.mean(store_arr[:, 0, idx_low:idx_high], axis=-1)` would be
+        with the full traces.
+    """
+    data_i, data_q = pls.get_template_matching_data(matches)
+    data = np.asarray(data_i) + 1j * np.asarray(data_q)
+    # one result per shot, ordered by average, then by repetition and match within the sequence
+    return np.mean(data.reshape(-1, nr_points), axis=0) / nr_samples
+
+
+AVERAGE_NR_BLOCKS = 10  # with a SEM target, acquire num_averages pixels in this many blocks
+SETTLE_SIGMA = 3.0  # blocks differing by more than this many standard errors are not settled
+
+
+def average_pixels(
+    get_data: Callable[[int], np.ndarray],
+    num_averages: int,
+    num_skip: int = 0,
+    sem_target: Optional[float] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """Average lockin pixels, optionally stopping as soon as the result is precise enough.
+
+    With `sem_target`, pixels are acquired in blocks and accumulated with running mean and
+    variance (Welford/Chan). Initial blocks are discarded until two consecutive blocks agree
+    within `SETTLE_SIGMA` standard errors, then acquisition stops when the standard error of the
+    mean is below `sem_target` for all tones, or after `num_averages` pixels.
+
+    Args:
+        get_data: acquire `n` new pixels, return complex array with shape (n,) or (n, nr_tones)
+        num_averages: number of pixels averaged, maximum number if `sem_target` is given
+        num_skip: pixels discarded at the start
+        sem_target: if not `None`, target standard error of the mean, same units as the data
+
+    Returns:
+        mean, standard error of the mean and mean power |data|^2, each with shape () or
+        (nr_tones,), and the number of pixels averaged
+    """
+    if sem_target is None:
+        return _reduce_pixels(get_data(num_skip + num_averages)[-num_averages:])
+
+    block = max(2, -(-num_averages // AVERAGE_NR_BLOCKS))
+    n, mean, m2 = _block_stats(get_data(num_skip + block)[-block:])
+    settled = False
+    nr_discarded = 0
+    while n < num_averages and (not settled or np.max(_sem(m2, n)) > sem_target):
+        n_b, mean_b, m2_b = _block_stats(get_data(min(block, num_averages - n)))
+        if not settled:
+            err = np.sqrt(_sem(m2, n) ** 2 + _sem(m2_b, n_b) ** 2)
+            settled = np.all(np.abs(mean_b - mean) <= SETTLE_SIGMA * err)
+            if not settled and nr_discarded < num_averages:
+                # still settling: discard what we have and restart from the new block
+                nr_discarded += n
+                n, mean, m2 = n_b, mean_b, m2_b
+                continue
+            settled = True
+        # merge the new block into the running statistics
+        n_ab = n + n_b
+        delta = mean_b - mean
+        mean = mean + delta * (n_b / n_ab)
+        m2 = m2 + m2_b + np.abs(delta) ** 2 * (n * n_b / n_ab)
+        n = n_ab
+
+    return mean, _sem(m2, n), np.abs(mean) ** 2 + m2 / n, n
+
+
+def _reduce_pixels(data: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    # mean, standard error, mean power and number of pixels, as returned by average_pixels
+    n, mean, m2 = _block_stats(data)
+    return mean, _sem(m2, n), np.abs(mean) ** 2 + m2 / n, n
+
+
+def _block_stats(data: np.ndarray):
+    # number of samples, mean and sum of squared deviations from the mean, along the first axis
+    mean = np.mean(data, axis=0)
+    return len(data), mean, np.sum(np.abs(data - mean) ** 2, axis=0)
+
+
+def _sem(m2, n: int):
+    # standard error of the mean from the sum of squared deviations of n samples
+    return np.sqrt(m2 / ((n - 1) * n)) if n > 1 else np.full_like(m2, np.inf)
+
+
+class PixelPipeline:
+    """Acquire lockin points while the host-side work on the previous points runs in background.
+
+    `get_pixels` blocks until the data is available, so the instrument is idle while the host
+    reduces the data and writes it to disk. Here the reduction of each point (without
+    `sem_target`) and any bookkeeping passed to `submit`, e.g. saving a row, run in a worker
+    thread, in order, while the main thread retunes and acquires the next point.
+
+    The time spent in each phase is accumulated in `timing` and printed by `report`: `retune`
+    (`configure_mixer`), `settle` (sleep after retuning), `acquire` (nominal `n / df` of
+    `get_pixels`), `transfer` (rest of `get_pixels`), `reduce` and `bookkeeping` (both in the
+    worker thread, overlapped with the others).
+
+    Example:
+        with PixelPipeline(lck, get_data, df, num_averages) as pipe:
+            for ii, freq in enumerate(freq_arr):
+                pipe.retune(freq=freq, in_ports=input_port, out_ports=output_port)
+                pipe.acquire(ii)
+            for ii, (mean, sem, pwr, count) in pipe.collect():
+                ...
+        pipe.report()
+
+    Args:
+        lck: the `lockin.Lockin` instance
+        get_data: as for `average_pixels`
+        df: lockin pixel rate, to split `get_pixels` time in acquisition and transfer
+        num_averages, num_skip, sem_target: as for `average_pixels`
+        settle: sleep after each retune, in seconds
+    """
+
+    PHASES = ["retune", "settle", "acquire", "transfer", "reduce", "bookkeeping"]
+
+    def __init__(
+        self,
+        lck,
+        get_data: Callable[[int], np.ndarray],
+        df: float,
+        num_averages: int,
+        num_skip: int = 0,
+        sem_target: Optional[float] = None,
+        settle: float = 1e-3,
+    ) -> None:
+        self.timing: Dict[str, float] = {phase: 0.0 for phase in self.PHASES}
+        self.nr_points = 0
+
+        self._lck = lck
+        self._get_data = get_data
+        self._df = df
+        self._num_averages = num_averages
+        self._num_skip = num_skip
+        self._sem_target = sem_target
+        self._settle = settle
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._points: List[Tuple[Any, Future]] = []
+        self._tasks: List[Future] = []
+
+    def __enter__(self) -> "PixelPipeline":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # wait for pending bookkeeping (e.g. saving) also on errors, then raise its errors if any
+        self._executor.shutdown(wait=True)
+        if exc_type is None:
+            self._check_tasks()
+
+    def retune(self, **kwargs) -> None:
+        """Call `lck.hardware.configure_mixer(**kwargs)` and wait for settling."""
+        t0 = time.perf_counter()
+        self._lck.hardware.configure_mixer(**kwargs)
+        t1 = time.perf_counter()
+        self._lck.hardware.sleep(self._settle, False)
+        t2 = time.perf_counter()
+        self.timing["retune"] += t1 - t0
+        self.timing["settle"] += t2 - t1
+
+    def acquire(self, key) -> None:
+        """Acquire one point and queue its reduction; the result is returned by `collect`."""
+        self.nr_points += 1
+        t0 = time.perf_counter()
+        if self._sem_target is None:
+            data = self._get_data(self._num_skip + self._num_averages)[-self._num_averages :]
+            future = self._executor.submit(self._timed, "reduce", _reduce_pixels, data)
+            nr_pixels = self._num_skip + self._num_averages
+        else:
+            # blocks depend on the result so far: no overlap possible
+            future = Future()
+            future.set_result(
+                average_pixels(
+                    self._get_data, self._num_averages, self._num_skip, self._sem_target
+                )
+            )
+            nr_pixels = future.result()[3]
+        elapsed = time.perf_counter() - t0
+        acquire = min(elapsed, nr_pixels / self._df)
+        self.timing["acquire"] += acquire
+        self.timing["transfer"] += elapsed - acquire
+        self._points.append((key, future))
+
+    def collect(self) -> List[Tuple[Any, Tuple[np.ndarray, np.ndarray, np.ndarray, int]]]:
+        """Wait for and return `(key, (mean, sem, power, count))` of the points acquired so far."""
+        points, self._points = self._points, []
+        self._check_tasks()
+        return [(key, future.result()) for key, future in points]
+
+    def submit(self, func: Callable, *args, **kwargs) -> None:
+        """Run `func(*args, **kwargs)` in background, after the reduction of all points so far.
+
+        Arguments are not copied: don't modify them afterwards.
+        """
+        task = self._executor.submit(self._timed, "bookkeeping", func, *args, **kwargs)
+        self._tasks.append(task)
+
+    def report(self) -> None:
+        """Print the time spent in each phase, in total and per point."""
+        nr_points = max(self.nr_points, 1)
+        total = sum(self.timing.values())
+        print(f"{'':>12s} {'total':>9s} {'per point':>10s} {'fraction':>9s}")
+        for phase, t in self.timing.items():
+            print(
+                f"{phase:>12s} {t:8.2f}s {1e3 * t / nr_points:8.3f}ms "
+                f"{100 * t / total if total > 0 else 0.0:8.1f}%"
+            )
+
+    def _timed(self, phase: str, func: Callable, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timing[phase] += time.perf_counter() - t0
+
+    def _check_tasks(self) -> None:
+        # raise errors from finished bookkeeping tasks
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            if task.done():
+                task.result()
+            else:
+                self._tasks.append(task)
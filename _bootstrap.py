@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Bootstrap and jackknife uncertainties for the fits of the experiments.
+
+The standard errors from the covariance of `curve_fit` assume that the model is exact and that the
+noise is white and Gaussian, and they are too small when it isn't. Here the data are resampled and
+refitted many times instead, and the spread of the refitted parameters gives the uncertainty:
+    - "residuals": add the residuals of the fit, drawn with replacement, back to the fitted curve;
+    - "repetitions": for data with shape `(nr_repetitions, nr_points)`, average repetitions drawn
+      with replacement;
+    - "jackknife": leave out one point (or one repetition) at a time.
+
+The refits run in a pool of processes, in chunks with their own seed from `seed`, so that the
+result doesn't depend on the number of processes. Example:
+    popt, perr, ci = bootstrap(_fit_simple, _decay, delay_arr, data)
+"""
+import time
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+NR_SAMPLES = 1_000
+CHUNK_SIZE = 50  # refits per task
+CONFIDENCE = 0.683  # one standard deviation
+SEED = 1234
+METHODS = ("residuals", "repetitions", "jackknife")
+AVERAGED_METHODS = ("residuals", "jackknife")  # for data already averaged over the repetitions
+
+Fit = Callable[[np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray]]
+
+
+def bootstrap(
+    fit: Fit,
+    model: Optional[Callable],
+    x: np.ndarray,
+    y: np.ndarray,
+    method: str = "residuals",
+    nr_samples: int = NR_SAMPLES,
+    confidence: float = CONFIDENCE,
+    seed: int = SEED,
+    max_workers: Optional[int] = None,
+    time_budget: Optional[float] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fit `y` and estimate the uncertainty of the parameters by resampling.
+
+    Args:
+        fit: fit function `fit(x, y) -> (popt, perr)`, e.g. `_fit_simple` of an experiment. It
+            must be defined at module level, or be a `functools.partial` of one, to be sent to the
+            other processes.
+        model: `model(x, *popt)`, the fitted function. Only needed for `"residuals"`.
+        x: the independent variable, shape `(nr_points,)`.
+        y: the data, shape `(nr_points,)`, or `(nr_repetitions, nr_points)` to be averaged over
+            the first axis.
+        method: `"residuals"`, `"repetitions"` or `"jackknife"`, see module docstring.
+        nr_samples: number of refits, ignored for `"jackknife"`.
+        confidence: probability contained in the confidence interval.
+        seed: seed of the random resampling, the same seed gives the same result.
+        max_workers: number of processes, the number of cores if `None`. With 1, refit in this
+            process.
+        time_budget: if not `None`, stop after about this many seconds and use the refits done so
+            far. The refits still running are stopped. The result then depends on the speed of the
+            computer.
+
+    Returns:
+        `(popt, perr, ci)`: the parameters fitted to the data, their standard errors from the
+        spread of the refits, and the confidence interval with shape `(2, nr_params)`, from the
+        percentiles of the refits for the bootstrap and from `perr` for the jackknife.
+    """
+    from scipy.stats import norm
+
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}, got {method!r}")
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if method == "repetitions" and y.ndim != 2:
+        raise ValueError("method 'repetitions' needs y with shape (nr_repetitions, nr_points)")
+    if method == "residuals" and model is None:
+        raise ValueError("method 'residuals' needs the model")
+
+    y_mean = np.mean(y, axis=0) if y.ndim == 2 else y
+    popt, _ = fit(x, y_mean)
+    popt = np.asarray(popt)
+
+    if method == "residuals":
+        fitted = model(x, *popt)
+        data = (fitted, y_mean - fitted)
+    else:
+        data = (y,)
+    if method == "jackknife":
+        nr_samples = len(y)
+    tasks = []
+    seeds = np.random.SeedSequence(seed).spawn((nr_samples + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    for ii, seed_seq in enumerate(seeds):
+        start = ii * CHUNK_SIZE
+        stop = min(start + CHUNK_SIZE, nr_samples)
+        tasks.append((fit, method, x, data, len(popt), seed_seq, start, stop))
+
+    results = _run(tasks, max_workers, time_budget)
+    if len(results) == 0:
+        raise RuntimeError("no refits completed within the time budget")
+    samples = np.concatenate(results, axis=0)
+    ok = np.all(np.isfinite(samples), axis=1)
+    if np.count_nonzero(ok) < 2:
+        raise RuntimeError("not enough successful refits")
+    samples = samples[ok]
+
+    if method == "jackknife":
+        nr = len(samples)
+        perr = np.sqrt((nr - 1) / nr * np.sum((samples - samples.mean(axis=0)) ** 2, axis=0))
+        z = norm.ppf(0.5 + 0.5 * confidence)
+        ci = np.array([popt - z * perr, popt + z * perr])
+    else:
+        perr = np.std(samples, axis=0, ddof=1)
+        alpha = 0.5 * (1.0 - confidence)
+        ci = np.quantile(samples, [alpha, 1.0 - alpha], axis=0)
+    return popt, perr, ci
+
+
+def check_averaged(method: Optional[str]) -> None:
+    """Raise `ValueError` if `method` can't be used on data averaged over the repetitions.
+
+    For the `analyze` methods of the experiments, which only have the averaged data.
+    """
+    if method is not None and method not in AVERAGED_METHODS:
+        raise ValueError(
+            f"uncertainty must be None or one of {AVERAGED_METHODS} for averaged data, "
+            f"got {method!r}"
+        )
+
+
+def _run(tasks, max_workers, time_budget):
+    # results of the completed tasks, in the order of the tasks
+    import multiprocessing
+
+    t_stop = None if time_budget is None else time.monotonic() + time_budget
+    results = {}
+    if max_workers == 1:
+        for ii, task in enumerate(tasks):
+            if t_stop is not None and time.monotonic() > t_stop:
+                break
+            results[ii] = _refit(*task)
+        return [results[ii] for ii in sorted(results)]
+
+    # leaving the block terminates the workers, also the refits still running when out of time
+    with multiprocessing.Pool(max_workers) as pool:
+        pending = [pool.apply_async(_refit, task) for task in tasks]
+        for ii, result in enumerate(pending):
+            timeout = None if t_stop is None else max(t_stop - time.monotonic(), 0.0)
+            try:
+                results[ii] = result.get(timeout)
+            except multiprocessing.TimeoutError:
+                break  # out of time
+        # keep the later tasks that are done as well
+        for jj, result in enumerate(pending):
+            if jj not in results and result.ready() and result.successful():
+                results[jj] = result.get()
+    return [results[ii] for ii in sorted(results)]
+
+
+def _refit(fit, method, x, data, nr_params, seed_seq, start, stop):
+    # refit the samples start to stop, NaN where the fit fails
+    rng = np.random.default_rng(seed_seq)
+    ret = np.full((stop - start, nr_params), np.nan)
+    for ii in range(start, stop):
+        if method == "residuals":
+            fitted, residuals = data
+            _x = x
+            _y = fitted + rng.choice(residuals, len(residuals))
+        elif method == "repetitions":
+            (y,) = data
+            _x = x
+            _y = np.mean(y[rng.integers(0, len(y), len(y))], axis=0)
+        else:
+            (y,) = data
+            keep = np.arange(len(y)) != ii
+            if y.ndim == 2:
+                _x = x
+                _y = np.mean(y[keep], axis=0)
+            else:
+                _x = x[keep]
+                _y = y[keep]
+        try:
+            popt, _ = fit(_x, _y)
+        except Exception:
+            continue
+        ret[ii - start] = popt
+    return ret
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Cache analysis results inside the data file.
+
+The results of an analysis, e.g. the integrated and rotated response and the fitted parameters,
+are saved in the group `/analysis/<name>` of the HDF5 file the data was loaded from. The group
+keeps the key of the inputs it was computed from: a hash of the raw data used by the analysis and
+of the analysis parameters (integration window, reference templates, model, ...). A later analysis
+with the same key reads the results back instead of computing them again.
+
+Example:
+    experiment = T1.load(filename)
+    experiment.analyze()  # computes and caches
+    experiment = T1.load(filename)
+    experiment.analyze()  # reads the cache
+    experiment.analyze(recompute=True)  # computes and replaces the cache
+    invalidate(filename)  # removes all cached results from the file
+"""
+import hashlib
+from typing import Any, Callable, Dict, Optional
+
+import h5py
+import numpy as np
+
+ANALYSIS_GROUP = "analysis"
+CACHE_VERSION = 1  # increase when the analysis changes, to invalidate older caches
+HASH_CHUNK_SIZE = 1 << 24  # bytes of raw data hashed at a time
+
+Results = Dict[str, Any]
+
+
+def cache_key(inputs: Dict[str, Any], params: Dict[str, Any]) -> str:
+    """Hash of the raw data and of the parameters of an analysis.
+
+    Args:
+        inputs: name -> array used by the analysis, e.g. the stored traces in the integration
+            window. `None` entries are allowed. Anything that can be sliced along the first axis
+            is accepted, e.g. `h5py.Dataset` or `np.memmap`, and is hashed one chunk at a time.
+        params: name -> parameter of the analysis, scalars, strings, `None` or arrays.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"version={CACHE_VERSION}".encode())
+    for name in sorted(inputs):
+        h.update(f"input:{name}".encode())
+        _hash_array(h, inputs[name])
+    for name in sorted(params):
+        h.update(f"param:{name}".encode())
+        value = params[name]
+        if value is None or isinstance(value, (str, bool, int, float)):
+            h.update(repr(value).encode())
+        else:
+            _hash_array(h, value)
+    return h.hexdigest()
+
+
+def load_cached(filename: str, name: str, key: str) -> Optional[Results]:
+    """Cached results of analysis `name`, or `None` if missing or computed from other inputs."""
+    with h5py.File(filename, "r") as h5f:
+        if ANALYSIS_GROUP not in h5f or name not in h5f[ANALYSIS_GROUP]:
+            return None
+        grp = h5f[ANALYSIS_GROUP][name]
+        if grp.attrs.get("key") != key:
+            return None
+        results: Results = {}
+        for result in grp.attrs["results"]:
+            if result in grp:
+                results[result] = grp[result][()]
+            elif result in grp.attrs:
+                results[result] = grp.attrs[result]
+            else:
+                results[result] = None  # e.g. failed fit
+        return results
+
+
+def save_cached(filename: str, name: str, key: str, results: Results) -> None:
+    """Save `results` of analysis `name`, replacing what was cached before."""
+    with h5py.File(filename, "a") as h5f:
+        analysis = h5f.require_group(ANALYSIS_GROUP)
+        if name in analysis:
+            del analysis[name]
+        grp = analysis.create_group(name)
+        grp.attrs["key"] = key
+        grp.attrs["results"] = list(results)
+        for result, value in results.items():
+            if value is None:
+                continue
+            elif np.isscalar(value):
+                grp.attrs[result] = value
+            else:
+                grp.create_dataset(result, data=np.asarray(value))
+
+
+def invalidate(filename: str, name: Optional[str] = None) -> None:
+    """Remove cached analysis `name` from the file, or all of them if `None`."""
+    with h5py.File(filename, "a") as h5f:
+        if ANALYSIS_GROUP not in h5f:
+            return
+        if name is None:
+            del h5f[ANALYSIS_GROUP]
+        elif name in h5f[ANALYSIS_GROUP]:
+            del h5f[ANALYSIS_GROUP][name]
+
+
+def cached(
+    filename: str,
+    name: str,
+    inputs: Dict[str, Any],
+    params: Dict[str, Any],
+    compute: Callable[[], Results],
+    recompute: bool = False,
+) -> Results:
+    """Return the cached results of analysis `name`, or `compute()` them and cache them.
+
+    Args:
+        filename: data file, with an empty string nothing is cached.
+        name: name of the analysis, one cache entry per name.
+        inputs, params: the key of the cache, see `cache_key`.
+        compute: computes the results, name -> array, scalar or `None`.
+        recompute: compute even if cached, and replace the cache.
+    """
+    if not filename:
+        return compute()
+    key = cache_key(inputs, params)
+    if not recompute:
+        try:
+            results = load_cached(filename, name, key)
+        except OSError:
+            results = None  # e.g. the file was moved
+        if results is not None:
+            return results
+    results = compute()
+    try:
+        save_cached(filename, name, key, results)
+    except OSError as err:
+        # e.g. read-only file, or open elsewhere
+        print(f"unable to cache the analysis in {filename}: {err}")
+    return results
+
+
+def _hash_array(h, data) -> None:
+    if data is None:
+        h.update(b"None")
+        return
+    if not hasattr(data, "dtype"):
+        data = np.asarray(data)
+    h.update(f"{data.dtype.str}{tuple(data.shape)}".encode())
+    if len(data.shape) == 0:
+        h.update(np.ascontiguousarray(data[()]).tobytes())
+        return
+    row_size = max(data.dtype.itemsize * int(np.prod(data.shape[1:])), 1)
+    step = max(HASH_CHUNK_SIZE // row_size, 1)
+    for start in range(0, data.shape[0], step):
+        h.update(np.ascontiguousarray(data[start : start + step]).tobytes())
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""Fit many decays or damped oscillations at once.
+
+The initial guess for each trace is computed in closed form with the matrix-pencil method: the
+poles of the signal are the eigenvalues of a small matrix built from the dominant right singular
+vectors of the Hankel matrix of the trace, and the amplitudes follow by linear least squares. The
+guess is then refined with Levenberg-Marquardt iterations that run on all the traces together,
+each with its own damping.
+
+The fit functions and the order of the parameters are the same as in the experiments, e.g.
+`T1._decay` and `RamseySingle._func`, and the standard errors are computed as in
+`scipy.optimize.curve_fit`.
+"""
+from typing import Tuple
+
+import numpy as np
+
+MAX_ITER = 100
+FIRST_PASS = 20  # iterations before the slow traces are put together
+BLOCK_SIZE = 256  # traces fitted together, small enough to stay in cache
+PENCIL_FACTOR = 4  # the pencil parameter is at most this times the number of poles
+RTOL = 1.5e-8  # as ftol in curve_fit
+
+
+def decay(t, T, xe, xg):
+    """`xg + (xe - xg) * exp(-t / T)`"""
+    return xg + (xe - xg) * np.exp(-t / T)
+
+
+def damped_cosine(t, offset, amplitude, T2, frequency, phase):
+    """`offset + amplitude * exp(-t / T2) * cos(2π * frequency * t + phase)`"""
+    return offset + amplitude * np.exp(-t / T2) * np.cos(2.0 * np.pi * frequency * t + phase)
+
+
+def fit_decay(
+    t: np.ndarray,
+    x: np.ndarray,
+    max_iter: int = MAX_ITER,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Fit `decay` to every trace in `x`.
+
+    Args:
+        t: delays, shape `(nr_delays,)`. They don't need to be evenly spaced, sorted or unique.
+        x: real traces with shape `(..., nr_delays)`.
+        max_iter: maximum number of Levenberg-Marquardt iterations.
+
+    Returns:
+        `(popt, perr)`, each with shape `x.shape[:-1] + (3,)`: the parameters `(T, xe, xg)` and
+        their standard errors. Both are NaN for the traces that couldn't be fitted.
+    """
+    return _fit_batch(_guess_decay, _decay_jac, 3, t, x, max_iter)
+
+
+def fit_damped_cosine(
+    t: np.ndarray,
+    x: np.ndarray,
+    max_iter: int = MAX_ITER,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Fit `damped_cosine` to every trace in `x`.
+
+    Args:
+        t: delays, shape `(nr_delays,)`. They don't need to be evenly spaced, sorted or unique.
+        x: real traces with shape `(..., nr_delays)`.
+        max_iter: maximum number of Levenberg-Marquardt iterations.
+
+    Returns:
+        `(popt, perr)`, each with shape `x.shape[:-1] + (5,)`: the parameters
+        `(offset, amplitude, T2, frequency, phase)` and their standard errors. The amplitude and
+        the frequency are positive. Both are NaN for the traces that couldn't be fitted.
+    """
+    popt, perr = _fit_batch(_guess_damped_cosine, _damped_cosine_jac, 5, t, x, max_iter)
+    # same curve, with positive amplitude and frequency
+    negative = popt[..., 1] < 0.0
+    popt[..., 1] = np.where(negative, -popt[..., 1], popt[..., 1])
+    popt[..., 4] = np.where(negative, popt[..., 4] + np.pi, popt[..., 4])
+    negative = popt[..., 3] < 0.0
+    popt[..., 3] = np.where(negative, -popt[..., 3], popt[..., 3])
+    popt[..., 4] = np.where(negative, -popt[..., 4], popt[..., 4])
+    popt[..., 4] = np.angle(np.exp(1j * popt[..., 4]))
+    return popt, perr
+
+
+def _fit_batch(guess, model_jac, nr_params, t, x, max_iter):
+    t = np.asarray(t, np.float64)
+    x = np.asarray(x, np.float64)
+    if x.shape[-1] != len(t):
+        raise ValueError(f"expected traces with {len(t)} points, got {x.shape[-1]}")
+    if len(t) <= nr_params:
+        raise ValueError(f"need more than {nr_params} points to fit, got {len(t)}")
+    shape = x.shape[:-1]
+    x = x.reshape(-1, len(t))
+    # the initial guesses need sorted delays, e.g. from an adaptive run; the fit doesn't care
+    order = np.argsort(t, kind="stable")
+    t = t[order]
+    x = x[:, order]
+    if t[-1] == t[0]:
+        raise ValueError("need at least two different delays")
+    nr_traces = x.shape[0]
+
+    popt = np.full((nr_traces, nr_params), np.nan)
+    perr = np.full((nr_traces, nr_params), np.nan)
+    slow = [np.zeros(0, np.int64)]
+    with np.errstate(all="ignore"):
+        for start in range(0, nr_traces, BLOCK_SIZE):
+            stop = min(start + BLOCK_SIZE, nr_traces)
+            block = x[start:stop]
+            valid = np.all(np.isfinite(block), axis=-1)
+            block = np.where(valid[:, None], block, 0.0)
+            p0 = guess(t, block)
+            p0[~valid] = np.nan  # skipped by the iterations
+            popt[start:stop], perr[start:stop], converged = _levenberg_marquardt(
+                model_jac, t, block, p0, min(max_iter, FIRST_PASS)
+            )
+            slow.append(start + np.flatnonzero(~converged))
+
+        # the few traces that converge slowly continue together, rather than in each block
+        slow = np.concatenate(slow)
+        for start in range(0, len(slow) if max_iter > FIRST_PASS else 0, BLOCK_SIZE):
+            idx = slow[start : start + BLOCK_SIZE]
+            popt[idx], perr[idx], _ = _levenberg_marquardt(
+                model_jac, t, x[idx], popt[idx], max_iter - FIRST_PASS
+            )
+
+    failed = ~(np.all(np.isfinite(popt), axis=-1) & np.all(np.isfinite(perr), axis=-1))
+    popt[failed] = np.nan
+    perr[failed] = np.nan
+    return popt.reshape(shape + (nr_params,)), perr.reshape(shape + (nr_params,))
+
+
+def _levenberg_marquardt(model_jac, t, x, p0, max_iter):
+    # all the traces step together, those that have converged are dropped from the batch
+    nr_traces, nr_params = p0.shape
+    p = p0.copy()
+    y, jac = model_jac(t, p)
+    res = x - y
+    cost = np.sum(res**2, axis=-1)
+    lam = np.full(nr_traces, 1e-3)
+    active = np.flatnonzero(np.isfinite(cost) & np.all(np.isfinite(p), axis=-1))
+    diag = np.arange(nr_params)
+
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        jac_a = jac[active]
+        jtj = np.matmul(jac_a.transpose(0, 2, 1), jac_a)
+        grad = np.matmul(jac_a.transpose(0, 2, 1), res[active, :, None])[..., 0]
+        lhs = jtj.copy()
+        lhs[:, diag, diag] *= 1.0 + lam[active, None]
+        step = _solve(lhs, grad)
+
+        p_new = p[active] + step
+        y_new, jac_new = model_jac(t, p_new)
+        res_new = x[active] - y_new
+        cost_new = np.sum(res_new**2, axis=-1)
+
+        better = cost_new < cost[active]
+        idx = active[better]
+        # converged when either the cost or the parameters change little, as in curve_fit
+        small = cost[idx] - cost_new[better] <= RTOL * cost[idx]
+        small |= np.all(np.abs(step[better]) <= RTOL * np.abs(p[idx]), axis=-1)
+        p[idx] = p_new[better]
+        res[idx] = res_new[better]
+        jac[idx] = jac_new[better]
+        cost[idx] = cost_new[better]
+        lam[idx] = np.maximum(lam[idx] / 10.0, 1e-12)
+        lam[active[~better]] *= 10.0
+
+        done = np.zeros(len(active), bool)
+        done[better] = small
+        done |= lam[active] > 1e12  # no step in any direction reduces the cost
+        active = active[~done]
+
+    # standard errors as in curve_fit, with the residual variance from the fit
+    dof = max(x.shape[-1] - nr_params, 1)
+    jtj = np.matmul(jac.transpose(0, 2, 1), jac)
+    pcov = _inv(jtj) * (cost / dof)[:, None, None]
+    perr = np.sqrt(pcov[:, diag, diag])
+
+    converged = np.ones(nr_traces, bool)
+    converged[active] = False
+    return p, perr, converged
+
+
+def _solve(lhs, rhs):
+    # parameters can differ by many orders of magnitude, equilibrate before solving
+    scale = _scale(lhs)
+    lhs = lhs / (scale[:, :, None] * scale[:, None, :])
+    try:
+        sol = np.linalg.solve(lhs, (rhs / scale)[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        # some traces are singular
+        sol = np.einsum("bpq,bq->bp", np.linalg.pinv(lhs), rhs / scale)
+    return sol / scale
+
+
+def _inv(a):
+    scale = _scale(a)
+    outer = scale[:, :, None] * scale[:, None, :]
+    try:
+        return np.linalg.inv(a / outer) / outer
+    except np.linalg.LinAlgError:
+        return np.linalg.pinv(a / outer) / outer
+
+
+def _scale(a):
+    diag = np.arange(a.shape[-1])
+    scale = np.sqrt(np.abs(a[:, diag, diag]))
+    scale[~(scale > 0.0)] = 1.0
+    return scale
+
+
+def _decay_jac(t, p):
+    T, xe, xg = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    e = np.exp(-t / T)
+    y = xg + (xe - xg) * e
+    jac = np.empty(y.shape + (3,))
+    jac[..., 0] = (xe - xg) * e * t / T**2
+    jac[..., 1] = e
+    jac[..., 2] = 1.0 - e
+    return y, jac
+
+
+def _damped_cosine_jac(t, p):
+    offset, amplitude, T2 = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+    frequency, phase = p[:, 3:4], p[:, 4:5]
+    e = np.exp(-t / T2)
+    arg = 2.0 * np.pi * frequency * t + phase
+    ec = e * np.cos(arg)
+    es = e * np.sin(arg)
+    y = offset + amplitude * ec
+    jac = np.empty(y.shape + (5,))
+    jac[..., 0] = 1.0
+    jac[..., 1] = ec
+    jac[..., 2] = amplitude * ec * t / T2**2
+    jac[..., 3] = -2.0 * np.pi * amplitude * es * t
+    jac[..., 4] = -amplitude * es
+    return y, jac
+
+
+def _guess_decay(t, x):
+    # poles: 1 for the offset and z = exp(-dt / T)
+    dt, poles = _pencil(t, x, 2)
+    z = np.min(poles.real, axis=-1)
+    span = t[-1] - t[0]
+    T = np.where((z > 0.0) & (z < 1.0), -dt / np.log(z), 0.5 * span)
+    T = np.clip(T, 1e-3 * span, 1e3 * span)
+
+    e = np.exp(-t / T[:, None])
+    coef = _linear_lstsq(np.stack((e, 1.0 - e), axis=-1), x)
+    return np.column_stack((T, coef[:, 0], coef[:, 1]))
+
+
+def _guess_damped_cosine(t, x):
+    # poles: 1 for the offset and the pair z, z* = exp((-1 / T2 ± 2πj * frequency) * dt)
+    dt, poles = _pencil(t, x, 3)
+    span = t[-1] - t[0]
+    # with noise or slow oscillations it's not obvious which pole is the offset, try them all
+    best_cost = np.full(len(x), np.inf)
+    p0 = np.zeros((len(x), 5))
+    for z in poles.T:
+        T2 = np.where(np.abs(z) < 1.0, -dt / np.log(np.abs(z)), 0.5 * span)
+        T2 = np.clip(T2, 1e-3 * span, 1e3 * span)
+        frequency = np.abs(np.angle(z)) / (2.0 * np.pi * dt)
+        # zero frequency is a saddle point of the cost, start from less than a period in the span
+        frequency = np.maximum(frequency, 0.25 / span)
+
+        e = np.exp(-t / T2[:, None])
+        arg = 2.0 * np.pi * frequency[:, None] * t
+        basis = np.stack((np.ones_like(e), e * np.cos(arg), e * np.sin(arg)), axis=-1)
+        coef = _linear_lstsq(basis, x)
+        cost = np.sum((x - np.matmul(basis, coef[..., None])[..., 0]) ** 2, axis=-1)
+
+        better = cost < best_cost
+        best_cost[better] = cost[better]
+        p0[better, 0] = coef[better, 0]
+        p0[better, 1] = np.hypot(coef[better, 1], coef[better, 2])
+        p0[better, 2] = T2[better]
+        p0[better, 3] = frequency[better]
+        p0[better, 4] = np.arctan2(-coef[better, 2], coef[better, 1])
+    return p0
+
+
+def _pencil(t, x, nr_poles):
+    # matrix pencil on an evenly spaced grid, interpolating if the delays are not
+    nr_delays = len(t)
+    t_uni = np.linspace(t[0], t[-1], nr_delays)
+    if not np.allclose(t, t_uni, rtol=0.0, atol=1e-6 * (t[-1] - t[0])):
+        x = _interp(t_uni, t, x)
+    dt = t_uni[1] - t_uni[0]
+
+    # pencil parameter, capped since the cost grows with its cube and this is only a guess
+    L = min(max(nr_delays // 3, nr_poles), PENCIL_FACTOR * nr_poles)
+    idx = np.arange(nr_delays - L)[:, None] + np.arange(L + 1)
+    hankel = x[:, idx]  # (nr_traces, nr_delays - L, L + 1)
+    # dominant right singular vectors, from the much smaller Gram matrix
+    gram = np.matmul(hankel.transpose(0, 2, 1), hankel)
+    _, vecs = np.linalg.eigh(gram)
+    vecs = vecs[:, :, -nr_poles:]
+    pencil = np.linalg.pinv(vecs[:, :-1, :]) @ vecs[:, 1:, :]
+    poles = np.linalg.eigvals(pencil)
+    poles[~np.isfinite(poles)] = 0.0
+    return dt, poles
+
+
+def _interp(t_new, t, x):
+    # linear interpolation of all the traces at once, t sorted
+    # the points at repeated delays are averaged, so that the intervals are not empty
+    t, inverse, counts = np.unique(t, return_inverse=True, return_counts=True)
+    if len(t) < len(inverse):
+        x_sum = np.zeros((len(x), len(t)))
+        np.add.at(x_sum, (slice(None), inverse), x)
+        x = x_sum / counts
+    right = np.clip(np.searchsorted(t, t_new), 1, len(t) - 1)
+    left = right - 1
+    w = (t_new - t[left]) / (t[right] - t[left])
+    return x[:, left] * (1.0 - w) + x[:, right] * w
+
+
+def _linear_lstsq(basis, x):
+    # solve basis @ coef = x for each trace, basis has shape (nr_traces, nr_delays, nr_coef)
+    ata = np.matmul(basis.transpose(0, 2, 1), basis)
+    atx = np.matmul(basis.transpose(0, 2, 1), x[..., None])[..., 0]
+    return _solve(ata, atx)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Choose the window and the weights for template matching from averaged readout traces.
+
+The instrument classifies a readout trace x with the pair of templates (ref_g, ref_e) by the sign
+of Re<ref_e - ref_g, x> - threshold. With weights w in place of ref_e - ref_g, the separation
+between the |g> and |e> distributions, i.e. the difference of their means over their standard
+deviation, is
+    SNR = Re<w, e - g> / sqrt(sum(|w|**2 * noise_var) / 2)
+where noise_var is the single-shot variance of each complex sample. It is largest for the matched
+filter w = (e - g) / noise_var, and all the windows of all the lengths are scored with cumulative
+sums.
+"""
+from math import erfc
+from typing import Tuple, Union
+
+import numpy as np
+
+NoiseVar = Union[float, np.ndarray]
+
+
+def estimate_noise_var(traces: np.ndarray, num_averages: int) -> float:
+    """Single-shot noise variance per complex sample, from averaged traces.
+
+    The readout signal is slow compared to the sampling rate, so the difference between consecutive
+    samples is mostly noise, with twice the variance. The median is used to be insensitive to the
+    fast edges of the signal.
+
+    Args:
+        traces: averaged traces with the samples on the last axis, e.g. for |g> and |e>.
+        num_averages: number of averages in `traces`.
+    """
+    diff2 = np.abs(np.diff(traces, axis=-1)) ** 2
+    # |diff|**2 is exponentially distributed, with median = mean * ln(2)
+    return float(num_averages * np.median(diff2) / np.log(2) / 2)
+
+
+def search_windows(
+    delta: np.ndarray,
+    noise_var: NoiseVar,
+    lengths: np.ndarray,
+    step: int = 2,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Find the best window of each length, for the matched filter and for a boxcar.
+
+    Windows start every `step` samples and end before the last sample.
+
+    Args:
+        delta: `e - g`, difference of the averaged traces.
+        noise_var: single-shot noise variance, scalar or one per sample.
+        lengths: candidate window lengths, in samples.
+        step: spacing of the candidate start indices.
+
+    Returns:
+        `(idx_arr, snr_arr, boxcar_idx_arr, boxcar_snr_arr)`, one entry per length: the start
+        index and the separation of the best window for the matched filter, and the same with
+        constant weights. The separation is zero where no window of that length fits.
+    """
+    delta = np.asarray(delta)
+    lengths = np.atleast_1d(lengths).astype(np.int64)
+    nr_samples = len(delta)
+    noise_var = np.broadcast_to(np.asarray(noise_var, np.float64), delta.shape)
+
+    cum_mf = np.r_[0.0, np.cumsum(np.abs(delta) ** 2 / noise_var)]
+    cum_delta = np.r_[0.0, np.cumsum(delta)]
+    cum_var = np.r_[0.0, np.cumsum(noise_var)]
+
+    starts = np.arange(0, nr_samples, step)
+    stops = starts[None, :] + lengths[:, None]  # (nr_lengths, nr_starts)
+    valid = stops < nr_samples
+    stops = np.minimum(stops, nr_samples)
+
+    snr = np.sqrt(2.0 * (cum_mf[stops] - cum_mf[starts]))
+    var = cum_var[stops] - cum_var[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        boxcar_snr = np.abs(cum_delta[stops] - cum_delta[starts]) / np.sqrt(var / 2.0)
+    snr = np.where(valid, snr, 0.0)
+    boxcar_snr = np.where(valid, np.nan_to_num(boxcar_snr), 0.0)
+
+    best = np.argmax(snr, axis=1)
+    boxcar_best = np.argmax(boxcar_snr, axis=1)
+    rows = np.arange(len(lengths))
+    return (
+        starts[best],
+        snr[rows, best],
+        starts[boxcar_best],
+        boxcar_snr[rows, boxcar_best],
+    )
+
+
+def distance_window(delta: np.ndarray, length: int, step: int = 2) -> int:
+    """Start of the window of `length` samples with the largest summed distance `sum(|e - g|)`.
+
+    The criterion used by `ReadoutRef` for the plain templates `ref_g` and `ref_e`: windows start
+    every `step` samples and end before the last sample, and the first of equal windows is chosen.
+    """
+    cum_distance = np.r_[0.0, np.cumsum(np.abs(delta))]
+    starts = np.arange(0, len(delta) - length, step)
+    if len(starts) == 0:
+        return 0
+    return int(starts[np.argmax(cum_distance[starts + length] - cum_distance[starts])])
+
+
+def separation(weights: np.ndarray, delta: np.ndarray, noise_var: NoiseVar) -> float:
+    """Separation of |g> and |e> when classifying with `weights`, see module docstring."""
+    signal = np.sum(np.real(np.conj(weights) * delta))
+    noise = np.sqrt(np.sum(np.abs(weights) ** 2 * noise_var) / 2.0)
+    return float(abs(signal) / noise)
+
+
+def assignment_error(snr: float) -> float:
+    """Expected probability of misclassifying a state, for Gaussian noise and separation `snr`."""
+    return 0.5 * erfc(snr / (2.0 * np.sqrt(2.0)))
+
+
+def matched_templates(
+    ref_g: np.ndarray, ref_e: np.ndarray, noise_var: NoiseVar
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Templates for `setup_template_matching_pair` that apply the matched filter.
+
+    The templates differ by the weights `(ref_e - ref_g) / noise_var` times the mean noise
+    variance, and have the same midpoint as `ref_g` and `ref_e`, so that the usual threshold
+    `(|ref_e|**2 - |ref_g|**2) / 2` is still halfway between the states. The weights are scaled
+    down if needed to keep the templates within full scale, `|template| <= 1`, which doesn't change
+    the classification. With white noise they are `ref_g` and `ref_e`.
+    """
+    noise_var = np.broadcast_to(np.asarray(noise_var, np.float64), np.shape(ref_g))
+    weights = (ref_e - ref_g) * np.mean(noise_var) / noise_var
+    middle = 0.5 * (ref_g + ref_e)
+    half = 0.5 * weights * _full_scale_factor(middle, 0.5 * weights)
+    return middle - half, middle + half
+
+
+def _full_scale_factor(middle: np.ndarray, half: np.ndarray) -> float:
+    # largest c <= 1 with |middle +- c * half| <= 1 on all samples
+    # the threshold of the scaled pair is c * Re<w, middle>, so the sign of the decision
+    # Re<c * w, x> - c * Re<w, middle> doesn't depend on c
+    rest = 1.0 - np.abs(middle) ** 2
+    if np.any(rest < 0.0):
+        raise ValueError("reference traces exceed full scale")
+    a = np.abs(half) ** 2
+    b = np.abs(np.real(np.conj(middle) * half))
+    nonzero = a > 0.0
+    if not np.any(nonzero):
+        return 1.0
+    a, b, rest = a[nonzero], b[nonzero], rest[nonzero]
+    # positive root of |middle +- c * half|**2 = 1, the closer of the two signs
+    limit = (np.sqrt(b**2 + a * rest) - b) / a
+    return float(min(1.0, np.min(limit)))
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Fit Gaussian mixtures to single shots with expectation-maximization.
+
+The fit runs directly on the shots, e.g. the template-matching results of `ReadoutReset` (1D) or
+integrated IQ points (2D), without histogramming them first. The log-density of a Gaussian is a
+linear function of the features `[1, x, x_i * x_j]`, so each E step is one matrix product of the
+features of all the shots with the parameters of all the components, and each M step needs only
+the product of the features with the responsibilities, i.e. the weighted counts, sums and sums of
+squares. With `chunk_size`, these sums are accumulated over chunks of shots and only one chunk is
+in memory at a time; the iterations are the same as with all the shots at once.
+"""
+from typing import Callable, Iterable, Optional, Tuple
+
+import numpy as np
+
+MAX_ITER = 500
+TOL = 1e-9  # on the change of the mean log-likelihood per shot
+INIT_SHOTS = 1 << 16  # shots in the subsample fitted first
+BLOCK_SIZE = 1 << 14  # shots processed together, small enough to stay in cache
+REG_COVAR = 1e-9  # added to the variances, relative to the variance of all the shots
+
+
+def fit_gaussian_mixture(
+    x,
+    nr_components: int = 2,
+    weights: Optional[np.ndarray] = None,
+    means: Optional[np.ndarray] = None,
+    covariances: Optional[np.ndarray] = None,
+    weights_only: bool = False,
+    chunk_size: Optional[int] = None,
+    max_iter: int = MAX_ITER,
+    tol: float = TOL,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fit a mixture of `nr_components` Gaussians to the shots in `x`.
+
+    Args:
+        x: the shots. Real with shape `(nr_shots,)` for 1D data, complex with shape `(nr_shots,)`
+            for IQ data, or real with shape `(nr_shots, nr_dims)`. Anything that can be sliced
+            along the first axis is accepted, e.g. `h5py.Dataset` or `np.memmap`.
+        nr_components: number of Gaussians, ignored if `means` is given.
+        weights: initial weights, equal if `None`.
+        means: initial means, in the same format as the returned ones. If `None`, the shots are
+            split into `nr_components` groups of the same size along their principal axis.
+        covariances: initial covariances, in the same format as the returned ones. If `None`, the
+            covariance of the initial groups.
+        weights_only: keep `means` and `covariances` fixed and fit only the weights, e.g. to
+            measure the populations with the same readout as another fit.
+        chunk_size: if not `None`, process `chunk_size` shots at a time, so that at most one chunk
+            of `x` is loaded in memory.
+        max_iter: maximum number of iterations.
+        tol: stop when the mean log-likelihood per shot improves by less than this.
+
+    Returns:
+        `(weights, means, covariances)` with the components sorted by their mean along the
+        principal axis of the shots. `weights` has shape `(nr_components,)` and sums to one. For 1D
+        data, `means` and `covariances` (the variances) have shape `(nr_components,)`. For IQ data,
+        `means` is complex with shape `(nr_components,)` and `covariances` has shape
+        `(nr_components, 2, 2)` for I and Q. Otherwise, they have shapes `(nr_components, nr_dims)`
+        and `(nr_components, nr_dims, nr_dims)`.
+    """
+    if not hasattr(x, "dtype"):
+        x = np.asarray(x)
+    is_complex = np.iscomplexobj(np.empty(0, x.dtype))
+    is_1d = len(x.shape) == 1 and not is_complex
+    nr_shots = x.shape[0]
+    if chunk_size is None:
+        chunk_size = nr_shots
+    if weights_only and (means is None or covariances is None):
+        raise ValueError("weights_only requires both means and covariances")
+
+    def _chunks():
+        for start in range(0, nr_shots, chunk_size):
+            yield _as_2d(x[start : start + chunk_size])
+
+    # work in standardized coordinates, from the first chunk, for numerical stability
+    first = next(_chunks())
+    nr_dims = first.shape[1]
+    shift = np.mean(first, axis=0)
+    scale = np.sqrt(np.mean(np.var(first, axis=0)))
+    if not scale > 0.0:
+        scale = 1.0
+    features = _features(first, shift, scale)
+    del first
+    axis = _principal_axis(features[1 : 1 + nr_dims])
+    reg = REG_COVAR * np.eye(nr_dims)
+
+    if means is None:
+        # split along the principal axis
+        proj = axis @ features[1 : 1 + nr_dims]
+        edges = np.quantile(proj, np.linspace(0.0, 1.0, nr_components + 1)[1:-1])
+        labels = np.searchsorted(edges, proj)
+        resp = np.eye(nr_components)[:, labels]
+        _, mu, cov = _maximize(features @ resp.T, nr_dims, reg)
+    else:
+        mu = (_as_2d(means) - shift) / scale
+        nr_components = len(mu)
+        cov = np.broadcast_to(np.eye(nr_dims), (nr_components, nr_dims, nr_dims))
+    if covariances is not None:
+        cov = _as_cov(covariances, nr_dims) / scale**2
+    if weights is None:
+        weights = np.ones(nr_components)
+    w = np.asarray(weights, np.float64) / np.sum(weights)
+
+    # converge on a subsample of the first chunk, then refine with all the shots
+    step = features.shape[1] // INIT_SHOTS
+    if step > 1:
+        sample = [features[:, ::step]]
+        w, mu, cov = _iterate(lambda: sample, w, mu, cov, weights_only, reg, max_iter, tol)
+
+    if chunk_size < nr_shots:
+        del features
+        w, mu, cov = _iterate(
+            lambda: (_features(chunk, shift, scale) for chunk in _chunks()),
+            w,
+            mu,
+            cov,
+            weights_only,
+            reg,
+            max_iter,
+            tol,
+        )
+    else:
+        features = [features]
+        w, mu, cov = _iterate(lambda: features, w, mu, cov, weights_only, reg, max_iter, tol)
+
+    order = np.argsort(mu @ axis)
+    w = w[order]
+    mu = shift + scale * mu[order]
+    cov = scale**2 * cov[order]
+    if is_1d:
+        return w, mu[:, 0], cov[:, 0, 0]
+    elif is_complex:
+        return w, mu[:, 0] + 1j * mu[:, 1], cov
+    else:
+        return w, mu, cov
+
+
+def _iterate(
+    all_features: Callable[[], Iterable[np.ndarray]],
+    w: np.ndarray,
+    mu: np.ndarray,
+    cov: np.ndarray,
+    weights_only: bool,
+    reg: np.ndarray,
+    max_iter: int,
+    tol: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # EM iterations, all_features() yields the features of each chunk
+    nr_dims = mu.shape[1]
+    coeffs = _coefficients(w, mu, cov)
+    log_lik_old = -np.inf
+    for _ in range(max_iter):
+        stats = 0.0
+        log_lik = 0.0
+        for features in all_features():
+            for start in range(0, features.shape[1], BLOCK_SIZE):
+                block = features[:, start : start + BLOCK_SIZE]
+                resp, _log_lik = _expect(block, coeffs)
+                stats = stats + block @ resp.T
+                log_lik += _log_lik
+        log_lik /= stats[0].sum()
+        if weights_only:
+            w = stats[0] / np.sum(stats[0])
+        else:
+            w, mu, cov = _maximize(stats, nr_dims, reg)
+        coeffs = _coefficients(w, mu, cov)
+        if log_lik - log_lik_old < tol:
+            break
+        log_lik_old = log_lik
+    return w, mu, cov
+
+
+def _as_2d(x) -> np.ndarray:
+    # shots as real array with shape (nr_shots, nr_dims)
+    x = np.asarray(x)
+    if np.iscomplexobj(x):
+        return np.stack((x.real, x.imag), axis=-1).astype(np.float64)
+    elif x.ndim == 1:
+        return x[:, None].astype(np.float64)
+    else:
+        return x.astype(np.float64)
+
+
+def _as_cov(covariances, nr_dims: int) -> np.ndarray:
+    # covariances with shape (nr_components, nr_dims, nr_dims), also from 1D variances
+    cov = np.asarray(covariances, np.float64)
+    if cov.ndim == 1:
+        cov = cov[:, None, None]
+    assert cov.shape[1:] == (nr_dims, nr_dims)
+    return cov
+
+
+def _principal_axis(x: np.ndarray) -> np.ndarray:
+    # x: centered shots with shape (nr_dims, nr_shots)
+    _, vecs = np.linalg.eigh(x @ x.T)
+    axis = vecs[:, -1]
+    # positive along the sum of the dimensions, so that 1D data keep their order
+    return axis if np.sum(axis) >= 0.0 else -axis
+
+
+def _features(x: np.ndarray, shift: np.ndarray, scale: float) -> np.ndarray:
+    # [1, x_i, x_i * x_j for i <= j], shape (nr_features, nr_shots) for fast sums over components
+    x = ((x - shift) / scale).T
+    ii, jj = np.triu_indices(len(x))
+    return np.concatenate((np.ones((1, x.shape[1])), x, x[ii] * x[jj]), axis=0)
+
+
+def _coefficients(w: np.ndarray, mu: np.ndarray, cov: np.ndarray) -> np.ndarray:
+    # log(w_k * N(x; mu_k, cov_k)) = coeffs[k] @ features(x)
+    nr_components, nr_dims = mu.shape
+    ii, jj = np.triu_indices(nr_dims)
+    prec = np.linalg.inv(cov)
+    _, logdet = np.linalg.slogdet(cov)
+    prec_mu = np.einsum("kij,kj->ki", prec, mu)
+    with np.errstate(divide="ignore"):
+        log_w = np.log(w)
+    const = log_w - 0.5 * (logdet + nr_dims * np.log(2.0 * np.pi) + np.sum(mu * prec_mu, axis=1))
+    quad = -np.where(ii == jj, 0.5, 1.0) * prec[:, ii, jj]
+    return np.concatenate((const[:, None], prec_mu, quad), axis=1)
+
+
+def _expect(features: np.ndarray, coeffs: np.ndarray) -> Tuple[np.ndarray, float]:
+    # responsibilities with shape (nr_components, nr_shots), and total log-likelihood
+    log_p = coeffs @ features
+    log_p_max = np.max(log_p, axis=0)
+    resp = np.exp(log_p - log_p_max)
+    total = np.sum(resp, axis=0)
+    resp /= total
+    log_lik = float(np.sum(np.log(total)) + np.sum(log_p_max))
+    return resp, log_lik
+
+
+def _maximize(
+    stats: np.ndarray, nr_dims: int, reg: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # weights, means and covariances from the weighted counts, sums and sums of squares
+    ii, jj = np.triu_indices(nr_dims)
+    counts = np.maximum(stats[0], np.finfo(np.float64).tiny)
+    mu = (stats[1 : 1 + nr_dims] / counts).T
+    second = np.zeros((len(counts), nr_dims, nr_dims))
+    second[:, ii, jj] = (stats[1 + nr_dims :] / counts).T
+    second[:, jj, ii] = second[:, ii, jj]
+    cov = second - mu[:, :, None] * mu[:, None, :] + reg
+    return stats[0] / np.sum(stats[0]), mu, cov
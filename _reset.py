@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Active reset of the qubit, to replace most of the wait for decay between shots.
+
+Example:
+    ref = ReadoutRef.load(ref_filename).analyze(plot=False)
+    reset = ActiveReset(
+        ref["ref_g"], ref["ref_e"], ref["readout_match_delay"], control_freq, control_amp
+    )
+    experiment = T1(..., reset=reset)  # wait_delay is not used
+"""
+from typing import List, Optional
+
+import h5py
+import numpy as np
+
+from _templates import phase_q
+
+
+class ActiveReset:
+    """Measure the qubit and flip it back to |g> with a conditional π pulse.
+
+    Added by an experiment in place of its `wait_delay` at the end of each shot. The reset readout
+    is classified on the instrument by template matching with the reference traces for |g> and |e>
+    (as in `ReadoutReset`), and the π pulse is output only if the qubit is found in |e>. An
+    optional verification readout after the last π pulse measures how often the reset fails.
+
+    Args:
+        ref_g: reference template for |g>, e.g. from `ReadoutRef.analyze`
+        ref_e: reference template for |e>
+        readout_match_delay: from the start of the readout pulse to the start of the match
+        control_freq: frequency of the qubit, for the π pulse
+        control_amp: amplitude of the π pulse
+        ringdown_delay: wait after the readout of the experiment, for the resonator to empty
+        feedback_delay: extra wait between the end of the match and the conditional π pulse
+        final_delay: wait after the reset, for the resonator to empty before the next shot
+        nr_resets: number of times to measure and conditionally flip the qubit
+        verify: add a readout after the reset to measure how often the qubit is left in |e>
+
+    Attributes:
+        excited_arr: replaced by `get_data`, fraction of shots found in |e> at each reset (and
+            verification) readout, shape `(nr_points, nr_readouts)`.
+    """
+
+    def __init__(
+        self,
+        ref_g: List[complex],
+        ref_e: List[complex],
+        readout_match_delay: float,
+        control_freq: float,
+        control_amp: float,
+        ringdown_delay: float = 2e-6,
+        feedback_delay: float = 0.0,
+        final_delay: float = 2e-6,
+        nr_resets: int = 1,
+        verify: bool = True,
+    ) -> None:
+        self.ref_g = np.atleast_1d(ref_g).astype(np.complex128)
+        self.ref_e = np.atleast_1d(ref_e).astype(np.complex128)
+        self.readout_match_delay = readout_match_delay
+        self.control_freq = control_freq
+        self.control_amp = control_amp
+        self.ringdown_delay = ringdown_delay
+        self.feedback_delay = feedback_delay
+        self.final_delay = final_delay
+        self.nr_resets = nr_resets
+        self.verify = verify
+
+        self.excited_arr = None  # replaced by get_data
+
+        self._matches = None  # replaced by setup
+        self._readout_pulse = None  # replaced by setup
+        self._readout_duration = 0.0  # replaced by setup
+        self._reset_pulse = None  # replaced by setup
+        self._control_port = 0  # replaced by setup
+        self._control_duration = 0.0  # replaced by setup
+
+        assert self.ref_g.shape == self.ref_e.shape
+        assert self.nr_resets > 0
+
+    @property
+    def nr_readouts(self) -> int:
+        """Number of readouts in each reset: `nr_resets`, plus one if `verify`."""
+        return self.nr_resets + int(self.verify)
+
+    def setup(
+        self,
+        pls,
+        sample_port: int,
+        control_port: int,
+        control_nco: float,
+        readout_pulse,
+        readout_duration: float,
+        control_envelope: np.ndarray,
+    ) -> None:
+        """Set up the template matching and the conditional π pulse, before programming.
+
+        The π pulse uses group 1 of `control_port`, so that it's not affected by frequency and
+        amplitude sweeps of the experiment on group 0.
+
+        Args:
+            pls: the `pulsed.Pulsed` instance.
+            sample_port: input port of the readout.
+            control_port: output port of the qubit control.
+            control_nco: frequency of the mixer of `control_port`.
+            readout_pulse: the readout pulse of the experiment, used also for the reset.
+            readout_duration: duration of `readout_pulse`.
+            control_envelope: envelope of the control pulse of the experiment, its shape and
+                duration are used for the π pulse.
+        """
+        control_if = self.control_freq - control_nco
+        pls.setup_freq_lut(
+            output_ports=control_port,
+            group=1,
+            frequencies=abs(control_if),
+            phases=0.0,
+            phases_q=phase_q(control_if),
+        )
+        pls.setup_scale_lut(
+            output_ports=control_port,
+            group=1,
+            scales=self.control_amp,
+        )
+        envelope = control_envelope / np.max(np.abs(control_envelope))
+        self._reset_pulse = pls.setup_template(
+            output_port=control_port,
+            group=1,
+            template=envelope,
+            template_q=None if np.iscomplexobj(envelope) else envelope,
+            envelope=True,
+        )
+
+        match_g, match_e = pls.setup_template_matching_pair(
+            input_port=sample_port,
+            template1=-self.ref_g,  # NOTE minus sign
+            template2=self.ref_e,
+            threshold=_threshold(self.ref_g, self.ref_e),
+        )  # success when match_e + match_g - threshold > 0, i.e. in |e>
+        pls.setup_condition([match_g, match_e], self._reset_pulse, [])
+
+        self._matches = [match_g, match_e]
+        self._readout_pulse = readout_pulse
+        self._readout_duration = readout_duration
+        self._control_port = control_port
+        self._control_duration = len(control_envelope) / pls.get_fs("dac")
+
+    def program(self, pls, T: float) -> float:
+        """Program the reset starting at `T`, right after the readout pulse of the experiment.
+
+        Returns:
+            the time when the next shot can start
+        """
+        assert self._matches is not None, "call setup first"
+        match_g = self._matches[0]
+        end_of_match = self.readout_match_delay + match_g.get_duration()
+
+        T += self.ringdown_delay
+        for ii in range(self.nr_readouts):
+            pls.output_pulse(T, self._readout_pulse)
+            pls.match(T + self.readout_match_delay, self._matches)
+            T += max(end_of_match, self._readout_duration)
+            if ii < self.nr_resets:
+                # Conditional π pulse
+                T += self.feedback_delay
+                pls.reset_phase(T, self._control_port, group=1)
+                pls.output_pulse(T, self._reset_pulse)
+                T += self._control_duration
+        T += self.final_delay
+        return T
+
+    def get_data(self, pls, nr_points: int) -> np.ndarray:
+        """Classify the reset readouts after the run and print the failure rate.
+
+        Args:
+            pls: the `pulsed.Pulsed` instance, after `run`.
+            nr_points: number of resets per average, i.e. `repeat_count` times the calls to
+                `program` in the sequence.
+
+        Returns:
+            `excited_arr`, also saved as attribute
+        """
+        match_g_arr, match_e_arr = pls.get_template_matching_data(self._matches)
+        threshold = _threshold(self.ref_g, self.ref_e)
+        excited = (np.asarray(match_g_arr) + np.asarray(match_e_arr) - threshold) > 0
+        excited = excited.reshape(-1, nr_points, self.nr_readouts)
+        self.excited_arr = np.mean(excited, axis=0)
+
+        print(f"Active reset: {100 * np.mean(self.excited_arr[:, 0]):.1f}% shots found in |e>")
+        if self.verify:
+            print(f"Active reset: {100 * np.mean(self.excited_arr[:, -1]):.1f}% failed")
+        return self.excited_arr
+
+    def save(self, h5f: h5py.File, name: str = "reset") -> None:
+        """Save the parameters and the statistics to group `name` of an open file."""
+        group = h5f.create_group(name)
+        for attribute, value in self.__dict__.items():
+            if attribute.startswith("_") or value is None:
+                continue
+            if np.isscalar(value):
+                group.attrs[attribute] = value
+            else:
+                group.create_dataset(attribute, data=value)
+
+    @classmethod
+    def load(cls, h5f: h5py.File, name: str = "reset") -> Optional["ActiveReset"]:
+        """Load from group `name` of an open file, `None` if the experiment didn't use a reset."""
+        if name not in h5f:
+            return None
+        group = h5f[name]
+        self = cls(
+            ref_g=group["ref_g"][()],
+            ref_e=group["ref_e"][()],
+            readout_match_delay=group.attrs["readout_match_delay"],
+            control_freq=group.attrs["control_freq"],
+            control_amp=group.attrs["control_amp"],
+            ringdown_delay=group.attrs["ringdown_delay"],
+            feedback_delay=group.attrs["feedback_delay"],
+            final_delay=group.attrs["final_delay"],
+            nr_resets=group.attrs["nr_resets"],
+            verify=group.attrs["verify"],
+        )
+        self.excited_arr = group["excited_arr"][()] if "excited_arr" in group else None
+        return self
+
+
+def _threshold(ref1, ref2):
+    return 0.5 * (np.sum(np.abs(ref2) ** 2) - np.sum(np.abs(ref1) ** 2))
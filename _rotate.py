@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Rotate complex IQ data so that the signal is in the I quadrature.
+
+The rotation is the one of `presto.utils.rotate_opt`, minimizing the mean of Q**2, but found in
+closed form instead of by scanning the angle. For data z rotated by θ:
+    mean(Im(exp(jθ) z)**2) = (mean(|z|**2) - Re(exp(2jθ) mean(z**2))) / 2
+which is smallest when exp(2jθ) mean(z**2) is real and positive. This is the principal axis of the
+2x2 second-moment matrix of I and Q, since mean(z**2) = mean(I**2) - mean(Q**2) + 2j mean(I Q). Of
+the two solutions π apart, the one closest to zero is used.
+"""
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+Axis = Optional[Union[int, Tuple[int, ...]]]
+
+
+def rotation_angle(data: np.ndarray, axis: Axis = None, center: bool = False) -> np.ndarray:
+    """Angle that rotates `data` onto the I quadrature.
+
+    Args:
+        data: complex data, e.g. the response of a sweep or single shots.
+        axis: axis or axes over which the data share the same rotation, e.g. `-1` for one angle
+            per row of a chevron. `None` for a single angle for all the data, as in
+            `presto.utils.rotate_opt`.
+        center: subtract the mean first, i.e. use the principal axis of the covariance instead of
+            the second moment about the origin. Useful for single shots far from the origin.
+
+    Returns:
+        the angle in radians, in `[-π/2, π/2)`, with shape `data.shape` without `axis`.
+    """
+    data = np.asarray(data)
+    if center:
+        data = data - np.mean(data, axis=axis, keepdims=True)
+    return -0.5 * np.angle(np.mean(data * data, axis=axis))
+
+
+def rotate_opt(
+    data: np.ndarray,
+    axis: Axis = None,
+    center: bool = False,
+    real: bool = False,
+    return_x: bool = False,
+):
+    """Rotate `data` onto the I quadrature, see `rotation_angle`.
+
+    With the default arguments this is a drop-in replacement for `presto.utils.rotate_opt`.
+
+    Args:
+        data: complex data.
+        axis: axis or axes over which the data share the same rotation, `None` for all.
+        center: use the covariance instead of the second moment about the origin.
+        real: return only the I quadrature, without computing the rotated complex data.
+        return_x: also return the rotation angle.
+
+    Returns:
+        the rotated data with the same shape as `data`, real if `real`. If `return_x`, the tuple
+        `(data, angle)`.
+    """
+    data = np.asarray(data)
+    x = rotation_angle(data, axis, center)
+    rot = np.exp(1j * x).astype(np.result_type(data.dtype, np.complex64))
+    if axis is not None:
+        rot = np.expand_dims(rot, axis)
+    if real:
+        ret = data.real * rot.real - data.imag * rot.imag
+    else:
+        ret = data * rot
+    if return_x:
+        return ret, x
+    else:
+        return ret
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""Keep one connection to Presto open across consecutive experiment runs.
+
+Example:
+    with Session() as session:
+        t1.run(presto_address, session=session)
+        echo.run(presto_address, session=session)  # no reconnect, only changed settings applied
+"""
+import contextlib
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# converter settings -> enum of presto.hardware
+CONVERTER_ENUMS = {
+    "adc_mode": "AdcMode",
+    "adc_fsample": "AdcFSample",
+    "dac_mode": "DacMode",
+    "dac_fsample": "DacFSample",
+}
+
+
+class Session:
+    """Shared hardware connection and cache of the settings already applied to it.
+
+    Pass the same `Session` to the `run` method of several experiments. The first run opens the
+    connection, later runs reuse it as long as they ask for the same address and converter
+    configuration. Calls to `hardware.set_adc_attenuation`, `set_dac_current`, `set_inv_sinc`,
+    `configure_mixer`, `set_lmx` and `set_dc_bias` that would not change the current state are
+    skipped, and so is `hardware.sleep` when nothing was changed since the previous sleep. The JPA
+    is not turned off at the end of each run, but only when the session is closed.
+
+    Attributes:
+        timing: one dictionary per run, with the time spent in total (including connecting, if
+            needed), in hardware setup calls and in the acquisition (`run`) itself, all in
+            seconds, and the number of skipped calls.
+    """
+
+    def __init__(self) -> None:
+        self.timing: List[Dict[str, float]] = []
+
+        self._interface: Any = None  # replaced by open
+        self._key: Optional[Tuple] = None  # address and converter configuration of _interface
+        self._state: Dict[Tuple, Tuple] = {}  # last applied arguments, by setting and port
+        self._unsynced = False  # a mixer was configured with sync=False
+        self._changed = True  # settings changed since last sleep
+        self._run_timing: Dict[str, float] = {}
+
+    def __enter__(self) -> "Session":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    @contextlib.contextmanager
+    def open(self, interface_class, **kwargs) -> Iterator[Any]:
+        """Use the session's connection for one run.
+
+        Args:
+            interface_class: e.g. `pulsed.Pulsed`
+            kwargs: arguments to `interface_class`: address, port, ext_ref_clk and the converter
+                configuration. The connection is reopened if they differ from the previous run.
+
+        Yields:
+            the connected instance, with a `hardware` attribute that skips redundant settings
+        """
+        t0 = time.perf_counter()
+        key = (interface_class, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+        if key != self._key:
+            self.close()
+            self._interface = interface_class(**kwargs)
+            self._interface.__enter__()
+            self._key = key
+
+        self._run_timing = {"total": 0.0, "setup": 0.0, "acquisition": 0.0, "skipped": 0}
+        try:
+            yield _Interface(self._interface, self)
+        finally:
+            self._run_timing["total"] = time.perf_counter() - t0
+            self.timing.append(self._run_timing)
+            print(
+                f"Session run {len(self.timing)}: "
+                f"{self._run_timing['setup']:.3f} s hardware setup, "
+                f"{self._run_timing['acquisition']:.3f} s acquisition, "
+                f"{self._run_timing['total']:.3f} s total, "
+                f"{self._run_timing['skipped']:d} settings unchanged"
+            )
+
+    def close(self) -> None:
+        """Turn off the JPA pump and bias, if any, and close the connection."""
+        if self._interface is None:
+            return
+        try:
+            hardware = self._interface.hardware
+            for (setting, port), args in self._state.items():
+                if setting == "set_lmx" and args != (0.0, 0.0):
+                    hardware.set_lmx(0.0, 0.0, port)
+                elif setting == "set_dc_bias" and args[0] != 0.0:
+                    hardware.set_dc_bias(0.0, port)
+        finally:
+            self._interface.__exit__(None, None, None)
+            self._interface = None
+            self._key = None
+            self._state = {}
+            self._unsynced = False
+            self._changed = True
+
+    def _apply(self, func, setting: str, ports, args: Tuple, *call_args, **call_kwargs) -> None:
+        keys = [(setting, port) for port in _as_list(ports)]
+        if all(self._state.get(key) == args for key in keys):
+            self._run_timing["skipped"] += 1
+            return
+        t0 = time.perf_counter()
+        func(*call_args, **call_kwargs)
+        self._run_timing["setup"] += time.perf_counter() - t0
+        for key in keys:
+            self._state[key] = args
+        self._changed = True
+
+
+class _Interface:
+    # thin wrapper around pulsed.Pulsed/lockin.Lockin that times the acquisition
+
+    def __init__(self, interface, session: Session) -> None:
+        self._interface = interface
+        self._session = session
+        self.hardware = _Hardware(interface.hardware, session)
+
+    def __getattr__(self, name):
+        return getattr(self._interface, name)
+
+    def run(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return self._interface.run(*args, **kwargs)
+        finally:
+            self._session._run_timing["acquisition"] += time.perf_counter() - t0
+
+
+class _Hardware:
+    # thin wrapper around the hardware object that skips settings already applied
+
+    def __init__(self, hardware, session: Session) -> None:
+        self._hardware = hardware
+        self._session = session
+
+    def __getattr__(self, name):
+        return getattr(self._hardware, name)
+
+    def set_adc_attenuation(self, port, att):
+        self._session._apply(
+            self._hardware.set_adc_attenuation, "set_adc_attenuation", port, (att,), port, att
+        )
+
+    def set_dac_current(self, port, current):
+        self._session._apply(
+            self._hardware.set_dac_current, "set_dac_current", port, (current,), port, current
+        )
+
+    def set_inv_sinc(self, port, order):
+        self._session._apply(
+            self._hardware.set_inv_sinc, "set_inv_sinc", port, (order,), port, order
+        )
+
+    def set_lmx(self, freq, pwr, port):
+        self._session._apply(self._hardware.set_lmx, "set_lmx", port, (freq, pwr), freq, pwr, port)
+
+    def set_dc_bias(self, bias, port, *args, **kwargs):
+        self._session._apply(
+            self._hardware.set_dc_bias,
+            "set_dc_bias",
+            port,
+            (bias, args, tuple(sorted(kwargs.items()))),
+            bias,
+            port,
+            *args,
+            **kwargs,
+        )
+
+    def configure_mixer(self, freq, in_ports=None, out_ports=None, sync=True, **kwargs):
+        session = self._session
+        args = (freq, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+        keys = [("configure_mixer_in", port) for port in _as_list(in_ports)]
+        keys += [("configure_mixer_out", port) for port in _as_list(out_ports)]
+        unchanged = all(session._state.get(key) == args for key in keys)
+        if unchanged and not (sync and session._unsynced):
+            session._run_timing["skipped"] += 1
+            return
+        # a previous call with sync=False still waits for a sync: don't skip this one
+        t0 = time.perf_counter()
+        self._hardware.configure_mixer(
+            freq=freq, in_ports=in_ports, out_ports=out_ports, sync=sync, **kwargs
+        )
+        session._run_timing["setup"] += time.perf_counter() - t0
+        for key in keys:
+            session._state[key] = args
+        session._unsynced = not sync
+        session._changed = True
+
+    def sleep(self, duration, *args, **kwargs):
+        session = self._session
+        if not session._changed:
+            session._run_timing["skipped"] += 1
+            return
+        t0 = time.perf_counter()
+        self._hardware.sleep(duration, *args, **kwargs)
+        session._run_timing["setup"] += time.perf_counter() - t0
+        session._changed = False
+
+
+def _as_list(ports) -> list:
+    if ports is None:
+        return []
+    return list(ports) if isinstance(ports, (list, tuple)) else [ports]
+
+
+def connect(session: Optional[Session], interface_class, **kwargs):
+    """Context manager for the connection to Presto, opened by `session` if given.
+
+    Without a session this is simply `interface_class(**kwargs)`. The converter configuration
+    (`adc_mode`, `adc_fsample`, `dac_mode` and `dac_fsample`) can be given by the names of the
+    members of the enums in `presto.hardware`, e.g. `"Mixed42"`, so that the experiment modules
+    don't import `presto.hardware` until they connect.
+    """
+    kwargs = converter_configuration(**kwargs)
+    if session is None:
+        return interface_class(**kwargs)
+    return session.open(interface_class, **kwargs)
+
+
+def converter_configuration(**kwargs) -> Dict[str, Any]:
+    """Replace the names of the converter settings with the members of the `presto.hardware` enums.
+
+    Other arguments, and settings that are already enum members, are returned unchanged.
+    """
+    from presto import hardware
+
+    for name, enum_name in CONVERTER_ENUMS.items():
+        if name in kwargs:
+            kwargs[name] = _enum_member(getattr(hardware, enum_name), kwargs[name])
+    return kwargs
+
+
+def _enum_member(enum, value):
+    # one value or one per port
+    if isinstance(value, (list, tuple)):
+        return [_enum_member(enum, v) for v in value]
+    return getattr(enum, value) if isinstance(value, str) else value
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Share pulse templates within a program, and cache the pulse envelopes.
+
+`Templates` wraps `pls.setup_template`: a template with the same content, port, group and
+envelope flag as one already set up in the program is returned again instead of being set up a
+second time, e.g. the π pulses of several experiments in a `Sequence`. The content is compared by
+hash, so that long templates are not kept around. The manager also counts the samples set up on
+each output port and group, to see how much template memory a sequence needs before adding more
+pulses, e.g. for randomized benchmarking.
+
+Templates made conditional with `pls.setup_condition` are only output when the condition is met,
+so they can't be shared with unconditional pulses: set them up with `unique=True`.
+
+`sin2_envelope` memoizes `presto.utils.sin2`, the control envelope of all the experiments, and
+`phase_q` gives the phase of the Q carrier that puts a pulse in the upper or lower sideband.
+
+Example:
+    templates = Templates(pls)
+    control_envelope = sin2_envelope(control_ns, drag)
+    pi_2_pulse = templates.setup(control_port, 0, 0.5 * control_envelope)
+    pi_pulse = templates.setup(control_port, 0, 1.0 * control_envelope)
+    templates.report()
+"""
+import functools
+import hashlib
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+ENVELOPE_CACHE_SIZE = 64  # envelopes kept by sin2_envelope
+
+Key = Tuple[int, int, bool, str, str]
+
+
+def sin2_envelope(nr_samples: int, drag: float = 0.0) -> np.ndarray:
+    """Memoized `presto.utils.sin2`, the sin^2 envelope with optional DRAG.
+
+    The returned array is shared between the calls and is read-only: multiply it, e.g.
+    `amp * sin2_envelope(...)`, or copy it before modifying it in place.
+    """
+    return _sin2(int(nr_samples), float(drag))
+
+
+def phase_q(freq_if: float) -> float:
+    """Phase of the Q carrier in `pls.setup_freq_lut`, to output at `freq_if` from the NCO.
+
+    The frequency LUT takes `abs(freq_if)`: the upper sideband for a positive IF, the lower one
+    for a negative IF.
+    """
+    if freq_if == 0.0:
+        return 0.0
+    return -np.pi / 2 if freq_if > 0 else np.pi / 2
+
+
+@functools.lru_cache(maxsize=ENVELOPE_CACHE_SIZE)
+def _sin2(nr_samples: int, drag: float) -> np.ndarray:
+    from presto.utils import sin2
+
+    envelope = sin2(nr_samples, drag=drag)
+    envelope.flags.writeable = False
+    return envelope
+
+
+class Templates:
+    """Set up the output templates of one program, sharing the identical ones.
+
+    Create one instance per program, i.e. per `pulsed.Pulsed` connection: the templates can't be
+    shared with another program.
+
+    Args:
+        pls: the `pulsed.Pulsed` instance.
+
+    Attributes:
+        nr_requests: number of calls to `setup`.
+    """
+
+    def __init__(self, pls) -> None:
+        self.pls = pls
+        self.nr_requests = 0
+        self._templates: Dict[Key, object] = {}  # content key -> template
+        self._nr_templates: Dict[Tuple[int, int], int] = {}  # (port, group) -> templates
+        self._nr_samples: Dict[Tuple[int, int], int] = {}  # (port, group) -> samples
+
+    def setup(
+        self,
+        output_port: int,
+        group: int,
+        template: np.ndarray,
+        template_q: Optional[np.ndarray] = None,
+        envelope: bool = True,
+        unique: bool = False,
+    ):
+        """Same as `pls.setup_template`, but reuse a template with the same content.
+
+        Args:
+            output_port, group, template, template_q, envelope: see `pls.setup_template`.
+            unique: always set up a new template, and don't share it later. Needed for the
+                templates made conditional with `pls.setup_condition`.
+
+        Returns:
+            the template, to use with `pls.output_pulse`
+        """
+        self.nr_requests += 1
+        where = (int(output_port), int(group))
+        key = (*where, bool(envelope), _digest(template), _digest(template_q))
+        if not unique and key in self._templates:
+            return self._templates[key]
+
+        pulse = self.pls.setup_template(
+            output_port=output_port,
+            group=group,
+            template=template,
+            template_q=template_q,
+            envelope=envelope,
+        )
+        if not unique:
+            self._templates[key] = pulse
+        self._nr_templates[where] = self._nr_templates.get(where, 0) + 1
+        self._nr_samples[where] = self._nr_samples.get(where, 0) + len(template)
+        return pulse
+
+    @property
+    def nr_templates(self) -> int:
+        """Number of templates set up on the instrument."""
+        return sum(self._nr_templates.values())
+
+    def usage(self) -> Dict[Tuple[int, int], Dict[str, int]]:
+        """Template memory used by the program.
+
+        Returns:
+            `(output_port, group)` -> `{"templates": ..., "samples": ...}`, the number of
+            templates set up and the sum of their lengths in samples
+        """
+        return {
+            where: {"templates": self._nr_templates[where], "samples": self._nr_samples[where]}
+            for where in sorted(self._nr_templates)
+        }
+
+    def report(self) -> None:
+        """Print the template memory used on each port and group, and the templates shared."""
+        for (port, group), used in self.usage().items():
+            print(
+                f"port {port}, group {group}: "
+                f"{used['templates']} templates, {used['samples']} samples"
+            )
+        print(
+            f"{self.nr_templates} templates set up for {self.nr_requests} pulses, "
+            f"{self.nr_requests - self.nr_templates} shared"
+        )
+
+
+def _digest(template: Optional[np.ndarray]) -> str:
+    if template is None:
+        return ""
+    data = np.ascontiguousarray(template)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{data.dtype.str}{data.shape}".encode())
+    h.update(data.tobytes())
+    return h.hexdigest()
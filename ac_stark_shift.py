@@ -4,23 +4,23 @@
 Measure Ramsey oscillations while driving the resonator with variable power.
 """
 import ast
-from typing import List
+from typing import List, Optional
 
-import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.utils import rotate_opt, sin2
-
-from _base import Base
+from _base import Base, get_integration_data, setup_integration
+from _fit import fit_damped_cosine
+from _reset import ActiveReset
+from _rotate import rotate_opt
+from _session import Session, connect
+from _templates import sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -47,6 +47,9 @@ class AcStarkShift(Base):
         num_averages: int,
         jpa_params: dict = None,
         drag: float = 0.0,
+        integrate: bool = False,
+        nr_raw_traces: int = 0,
+        reset: Optional[ActiveReset] = None,
     ) -> None:
         self.readout_freq = readout_freq
         self.control_freq = control_freq
@@ -66,18 +69,32 @@ class AcStarkShift(Base):
         self.num_averages = num_averages
         self.jpa_params = jpa_params
         self.drag = drag
+        # integrate the readout on the instrument, transferring one complex number per shot
+        self.integrate = integrate
+        # with integrate, store anyway the full traces of the first nr_raw_traces readouts in
+        # the sequence
+        self.nr_raw_traces = nr_raw_traces
+        # if not None, reset the qubit actively at the end of each shot instead of waiting for
+        # wait_delay
+        self.reset = reset
 
         self.t_arr = None  # replaced by run
         self.store_arr = None  # replaced by run
+        self.integrated_arr = None  # replaced by run, if integrate
 
     def run(
         self,
         presto_address: str,
         presto_port: int = None,
         ext_ref_clk: bool = False,
+        session: Optional[Session] = None,
     ) -> str:
+        from presto import pulsed
+
         # Instantiate interface class
-        with pulsed.Pulsed(
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -169,7 +186,7 @@ class AcStarkShift(Base):
             control_ns = int(
                 round(self.control_duration * pls.get_fs("dac"))
             )  # number of samples in the control template
-            control_envelope = sin2(control_ns, drag=self.drag)
+            control_envelope = sin2_envelope(control_ns, self.drag)
             control_pulse = pls.setup_template(
                 output_port=self.control_port,
                 group=0,
@@ -179,14 +196,31 @@ class AcStarkShift(Base):
             )
 
             # Setup sampling window
-            pls.set_store_ports(self.sample_port)
-            pls.set_store_duration(self.sample_duration)
+            nr_stored = len(self.delay_arr)  # readouts in the sequence
+            if self.integrate:
+                matches, match_delay = setup_integration(
+                    pls, self.sample_port, IDX_LOW, IDX_HIGH
+                )
+                nr_stored = min(self.nr_raw_traces, nr_stored)
+            if nr_stored > 0:
+                pls.set_store_ports(self.sample_port)
+                pls.set_store_duration(self.sample_duration)
+            if self.reset is not None:
+                self.reset.setup(
+                    pls,
+                    self.sample_port,
+                    self.control_port,
+                    self.control_freq,
+                    readout_pulse,
+                    self.readout_duration,
+                    control_envelope,
+                )
 
             # ******************************
             # *** Program pulse sequence ***
             # ******************************
             T = 0.0  # s, start at time zero ...
-            for delay in self.delay_arr:
+            for ii, delay in enumerate(self.delay_arr):
                 # ringup cavity
                 # NOTE: adjust phase here so that it matches the reset phase below?
                 #       actually since we use zero IF reset phase is a no-op...
@@ -208,12 +242,18 @@ class AcStarkShift(Base):
                 # NOTE: reset phase for readout pulse here
                 pls.reset_phase(T, self.readout_port)
                 pls.output_pulse(T, readout_pulse)
-                pls.store(T + self.readout_sample_delay)
+                if ii < nr_stored:
+                    pls.store(T + self.readout_sample_delay)
+                if self.integrate:
+                    pls.match(T + self.readout_sample_delay + match_delay, matches)
                 T += self.readout_duration
                 # Move to next iteration, waiting for decay
-                T += self.wait_delay
+                if self.reset is None:
+                    T += self.wait_delay
+                else:
+                    T = self.reset.program(pls, T)
             pls.next_scale(T, self.readout_port, 1)
-            T += self.wait_delay
+            T += self.wait_delay if self.reset is None else self.reset.final_delay
 
             if self.jpa_params is not None:
                 # adjust period to minimize effect of JPA idler
@@ -239,20 +279,27 @@ class AcStarkShift(Base):
                 num_averages=self.num_averages,
                 print_time=True,
             )
-            self.t_arr, self.store_arr = pls.get_store_data()
+            if nr_stored > 0:
+                self.t_arr, self.store_arr = pls.get_store_data()
+            if self.reset is not None:
+                self.reset.get_data(pls, nr_amps * len(self.delay_arr))
+            if self.integrate:
+                self.integrated_arr = get_integration_data(
+                    pls, matches, nr_amps * len(self.delay_arr), IDX_HIGH - IDX_LOW
+                )
 
-            if self.jpa_params is not None:
+            if self.jpa_params is not None and session is None:
                 pls.hardware.set_lmx(0.0, 0.0, self.jpa_params["pump_port"])
                 pls.hardware.set_dc_bias(0.0, self.jpa_params["bias_port"])
 
         return self.save()
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "AcStarkShift":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "AcStarkShift":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq = h5f.attrs["readout_freq"]
             control_freq = h5f.attrs["control_freq"]
             readout_amp = h5f.attrs["readout_amp"]
@@ -273,8 +320,14 @@ class AcStarkShift(Base):
 
             jpa_params = ast.literal_eval(h5f.attrs["jpa_params"])
 
-            t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            # not saved when integrating on the instrument without raw traces
+            t_arr = h5f["t_arr"][()] if "t_arr" in h5f else None
+            store_arr = cls._load_array(h5f, "store_arr", lazy) if "store_arr" in h5f else None
+            integrated_arr = h5f["integrated_arr"][()] if "integrated_arr" in h5f else None
+            # not saved by older versions
+            integrate = h5f.attrs.get("integrate", False)
+            nr_raw_traces = h5f.attrs.get("nr_raw_traces", 0)
+            reset = ActiveReset.load(h5f)
 
         self = cls(
             readout_freq=readout_freq,
@@ -295,27 +348,27 @@ class AcStarkShift(Base):
             num_averages=num_averages,
             jpa_params=jpa_params,
             drag=drag,
+            integrate=integrate,
+            nr_raw_traces=nr_raw_traces,
+            reset=reset,
         )
         self.t_arr = t_arr
         self.store_arr = store_arr
+        self.integrated_arr = integrated_arr
 
         return self
 
     def analyze(self, all_plots: bool = False):
-        if self.t_arr is None:
-            raise RuntimeError
-        if self.store_arr is None:
+        if self.store_arr is None and self.integrated_arr is None:
             raise RuntimeError
 
         import matplotlib.pyplot as plt
 
         ret_fig = []
 
-        idx = np.arange(IDX_LOW, IDX_HIGH)
-        t_low = self.t_arr[IDX_LOW]
-        t_high = self.t_arr[IDX_HIGH]
-
-        if all_plots:
+        if all_plots and self.store_arr is not None:
+            t_low = self.t_arr[IDX_LOW]
+            t_high = self.t_arr[IDX_HIGH]
             # Plot raw store data for first iteration as a check
             fig1, ax1 = plt.subplots(2, 1, sharex=True, tight_layout=True)
             ax11, ax12 = ax1
@@ -328,8 +381,8 @@ class AcStarkShift(Base):
             ret_fig.append(fig1)
 
         # analyze and reshape data
-        resp_arr = np.mean(self.store_arr[:, 0, idx], axis=-1)
-        data = rotate_opt(resp_arr).real
+        resp_arr = self._readout_resp(IDX_LOW, IDX_HIGH)
+        data = rotate_opt(resp_arr, real=True)
         nr_amps = len(self.ringup_amp_arr)
         nr_delays = len(self.delay_arr)
         data.shape = (nr_amps, nr_delays)
@@ -344,18 +397,9 @@ class AcStarkShift(Base):
         ret_fig.append(fig2)
 
         # Ramsey fits
-        popt_all = np.zeros((nr_amps, 5))
-        perr_all = np.zeros((nr_amps, 5))
-        for ii, amp in enumerate(self.ringup_amp_arr):
-            try:
-                popt, perr = _fit_simple(self.delay_arr, data[ii, :])
-                popt_all[ii, :] = popt
-                perr_all[ii, :] = perr
-            except Exception as err:
-                print(f"Unable to fit data for amp nr {ii}: {amp}!")
-                print(err)
-                popt_all[ii, :] = np.nan
-                perr_all[ii, :] = np.nan
+        popt_all, perr_all = _fit_batch(self.delay_arr, data)
+        for ii in np.flatnonzero(np.isnan(popt_all[:, 0])):
+            print(f"Unable to fit data for amp nr {ii}: {self.ringup_amp_arr[ii]}!")
 
         ringup_pwr_arr = self.ringup_amp_arr**2
         freq_arr = popt_all[:, 3]
@@ -404,32 +448,10 @@ def _func(t, offset, amplitude, gamma, frequency, phase):
     return offset + amplitude * np.exp(-gamma * t) * np.cos(2.0 * np.pi * frequency * t + phase)
 
 
-def _fit_simple(x, y):
-    from scipy.optimize import curve_fit
-
-    pkpk = np.max(y) - np.min(y)
-    offset = np.min(y) + pkpk / 2
-    amplitude = 0.5 * pkpk
-    T2 = 0.5 * (np.max(x) - np.min(x))
-    gamma = 1 / T2
-    freqs = np.fft.rfftfreq(len(x), x[1] - x[0])
-    fft = np.fft.rfft(y)
-    fft[0] = 0
-    idx_max = np.argmax(np.abs(fft))
-    frequency = freqs[idx_max]
-    phase = np.angle(fft[idx_max])
-    p0 = (
-        offset,
-        amplitude,
-        gamma,
-        frequency,
-        phase,
-    )
-    popt, pcov = curve_fit(
-        _func,
-        x,
-        y,
-        p0=p0,
-    )
-    perr = np.sqrt(np.diag(pcov))
+def _fit_batch(x, y):
+    # fit with T2 instead of gamma = 1 / T2 in the model
+    popt, perr = fit_damped_cosine(x, y)
+    gamma = 1.0 / popt[..., 2]
+    perr[..., 2] *= gamma**2
+    popt[..., 2] = gamma
     return popt, perr
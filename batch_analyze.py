@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Analyze all the data files in a directory without plotting, and summarize them in one table.
+
+The experiment of each file is detected from its name, `<script>_<timestamp>.h5` as saved by
+`Base.save`, or else from the class defined in the source code saved in the file. The fit is done
+by the `analyze_batch` method of the experiment, without matplotlib, and the files are analyzed in
+parallel in a pool of processes, one file per task. The files are loaded lazily, reading only the
+part of the traces used by the fit, and the results are cached in each file (see `_cache`), so that
+running again only fits new files. `CycleTs` files give one row per measurement of T1 and of T2,
+refitted from the saved data all at once. Files of other experiments are listed with the message
+`unknown experiment`.
+
+The summary has one row per result and one column per fitted parameter, with the file, the
+experiment and the time of the measurement. It is written as CSV, or as Parquet if the output ends
+with `.parquet` (requires pandas and pyarrow).
+
+Run from the repository root with:
+    python batch_analyze.py data/ -o summary.csv
+or from Python:
+    rows = analyze_files(sorted(glob.glob("data/*.h5")))
+"""
+import argparse
+import csv
+import glob
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import h5py
+import numpy as np
+
+Row = Dict[str, Any]
+
+FILENAME_RE = re.compile(r"^(?P<script>.+)_(?P<date>\d{8})_(?P<time>\d{6})\.h5$")
+CLASS_RE = re.compile(r"^class\s+(\w+)\s*\(\s*Base\s*\)", re.MULTILINE)
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"  # local time, as in the file names
+COMMON_ATTRS = ["readout_freq", "control_freq"]  # copied to the summary when present
+FIRST_COLUMNS = ["file", "experiment", "timestamp"] + COMMON_ATTRS + ["error"]
+
+
+def detect_experiment(filename: str) -> Optional[str]:
+    """Name of the script that saved `filename`, e.g. `"t1"`, or `None` if unknown."""
+    match = FILENAME_RE.match(os.path.basename(filename))
+    if match is not None and match.group("script") in SCRIPTS:
+        return match.group("script")
+    # renamed file: look for the experiment class in the saved source code
+    try:
+        with h5py.File(filename, "r") as h5f:
+            if "source_code" not in h5f:
+                return None
+            source_code = h5f["source_code"][()]
+    except OSError:
+        return None
+    # one string, or an array with one line per entry
+    lines = np.atleast_1d(source_code).tolist()
+    source_code = "".join(s.decode("utf-8") if isinstance(s, bytes) else s for s in lines)
+    for class_name in CLASS_RE.findall(source_code):
+        if class_name in CLASSES:
+            return CLASSES[class_name]
+    return None
+
+
+def analyze_file(filename: str, recompute: bool = False) -> List[Row]:
+    """Analyze one file, return the rows of the summary.
+
+    Errors don't propagate: the file then gets one row with the message in the `error` column.
+    """
+    script = detect_experiment(filename)
+    row = {"file": filename, "experiment": script, "timestamp": _file_timestamp(filename)}
+    if script is None:
+        row["error"] = "unknown experiment"
+        return [row]
+    try:
+        with h5py.File(filename, "r") as h5f:
+            for attr in COMMON_ATTRS:
+                if attr in h5f.attrs:
+                    row[attr] = float(h5f.attrs[attr])
+        rows = SCRIPTS[script](filename, recompute)
+    except Exception as err:
+        row["error"] = f"{type(err).__name__}: {err}"
+        return [row]
+    return [{**row, **r} for r in rows]
+
+
+def analyze_files(
+    filenames: Sequence[str], max_workers: Optional[int] = None, recompute: bool = False
+) -> List[Row]:
+    """Analyze `filenames` in a pool of processes, see `analyze_file`.
+
+    Args:
+        filenames: the data files.
+        max_workers: number of processes, the number of cores if `None`. With 1, analyze in this
+            process.
+        recompute: analyze the raw data even if the results are cached in the data files, see
+            `_cache`.
+
+    Returns:
+        the rows of all the files, in the order of `filenames`.
+    """
+    rows = []
+    if max_workers == 1:
+        for filename in filenames:
+            rows.extend(analyze_file(filename, recompute))
+        return rows
+    with ProcessPoolExecutor(max_workers) as executor:
+        for ii, file_rows in enumerate(
+            executor.map(analyze_file, filenames, [recompute] * len(filenames))
+        ):
+            print(f"{ii + 1}/{len(filenames)} {os.path.basename(filenames[ii])}")
+            rows.extend(file_rows)
+    return rows
+
+
+def write_summary(rows: List[Row], output: str) -> None:
+    """Write `rows` to `output`, CSV or Parquet (`.parquet`), one column per key."""
+    columns = [c for c in FIRST_COLUMNS if any(c in row for row in rows)]
+    for row in rows:
+        columns.extend(key for key in row if key not in columns)
+
+    if output.endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError as err:
+            raise ImportError("writing Parquet requires pandas and pyarrow, use .csv") from err
+        pd.DataFrame(rows, columns=columns).to_parquet(output, index=False)
+    else:
+        with open(output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    print(f"Summary of {len(rows)} results saved to: {output}")
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory", help="directory with the .h5 data files")
+    parser.add_argument(
+        "-o", "--output", default=None, help="CSV or .parquet, default <directory>/summary.csv"
+    )
+    parser.add_argument("-p", "--pattern", default="*.h5", help="file name pattern")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes")
+    parser.add_argument("--recompute", action="store_true", help="ignore the cached analysis")
+    args = parser.parse_args(argv)
+
+    filenames = sorted(glob.glob(os.path.join(args.directory, args.pattern)))
+    output = args.output or os.path.join(args.directory, "summary.csv")
+    t0 = time.perf_counter()
+    rows = analyze_files(filenames, args.jobs, args.recompute)
+    print(f"{len(filenames)} files analyzed in {time.perf_counter() - t0:.1f} s")
+    write_summary(rows, output)
+
+
+def _file_timestamp(filename: str) -> str:
+    # time of the measurement from the file name, else the modification time of the file
+    match = FILENAME_RE.match(os.path.basename(filename))
+    if match is not None:
+        t = time.strptime(match.group("date") + match.group("time"), "%Y%m%d%H%M%S")
+        return time.strftime(TIME_FORMAT, t)
+    return time.strftime(TIME_FORMAT, time.localtime(os.path.getmtime(filename)))
+
+
+def _params(names: Sequence[str], popt, perr) -> Row:
+    # one column per parameter and one for its error, NaN if the fit failed
+    if popt is None:
+        popt = perr = [np.nan] * len(names)
+    row = {}
+    for name, value, error in zip(names, popt, perr):
+        row[name] = float(value)
+        row[f"{name}_err"] = float(error)
+    return row
+
+
+def _t1(filename: str, recompute: bool) -> List[Row]:
+    from t1 import T1
+
+    _, (popt, perr) = T1.load(filename, lazy=True).analyze_batch(recompute=recompute)
+    return [_params(["T1", "xe", "xg"], popt, perr)]
+
+
+def _ramsey_echo(filename: str, recompute: bool) -> List[Row]:
+    from ramsey_echo import RamseyEcho
+
+    _, (popt, perr) = RamseyEcho.load(filename, lazy=True).analyze_batch(recompute=recompute)
+    return [_params(["T2_echo", "xe", "xg"], popt, perr)]
+
+
+def _ramsey_single(filename: str, recompute: bool) -> List[Row]:
+    from ramsey_single import RamseySingle
+
+    _, (popt, perr) = RamseySingle.load(filename, lazy=True).analyze_batch(recompute=recompute)
+    names = ["offset", "amplitude", "T2_star", "detuning", "phase"]
+    return [_params(names, popt, perr)]
+
+
+def _rabi_amp(filename: str, recompute: bool) -> List[Row]:
+    from rabi_amp import RabiAmp
+
+    experiment = RabiAmp.load(filename, lazy=True)
+    _, (popt, perr) = experiment.analyze_batch(recompute=recompute)
+    row = _params(["offset", "amplitude", "T2_rabi", "period", "phase"], popt, perr)
+    row["pi_amp"] = row["period"] * experiment.num_pulses / 2
+    row["pi_amp_err"] = row["period_err"] * experiment.num_pulses / 2
+    return [row]
+
+
+def _cycle_ts(filename: str, recompute: bool) -> List[Row]:
+    # read the saved data directly, no need to load the whole experiment
+    from _fit import fit_decay
+
+    rows = []
+    with h5py.File(filename, "r") as h5f:
+        delay_arr = h5f["delay_arr"][()]
+        for which, name in [("1", "T1"), ("2", "T2_echo")]:
+            data = h5f[f"data{which}"][()]
+            time_arr = h5f[f"time{which}_arr"][()]
+            nr_rows = min(len(data), len(time_arr))
+            # all the repetitions in one batch
+            popt, perr = fit_decay(delay_arr, data[:nr_rows])
+            for ii in range(nr_rows):
+                row = {"timestamp": time.strftime(TIME_FORMAT, time.localtime(time_arr[ii]))}
+                row["measurement"] = name
+                row.update(_params([name, "xe", "xg"], popt[ii], perr[ii]))
+                rows.append(row)
+    return rows
+
+
+# script name -> analysis of a file, returning the rows of the summary
+SCRIPTS: Dict[str, Callable[[str, bool], List[Row]]] = {
+    "t1": _t1,
+    "ramsey_echo": _ramsey_echo,
+    "ramsey_single": _ramsey_single,
+    "rabi_amp": _rabi_amp,
+    "cycle_Ts": _cycle_ts,
+}
+# experiment class -> script name
+CLASSES = {
+    "T1": "t1",
+    "RamseyEcho": "ramsey_echo",
+    "RamseySingle": "ramsey_single",
+    "RabiAmp": "rabi_amp",
+    "CycleTs": "cycle_Ts",
+}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the batch fitter in `_fit` against `curve_fit` called once per trace.
+
+Two cases: a 500-row `RamseyChevron` (damped cosines) and a year of `CycleTs` data (one T1 and one
+echo T2 decay per minute). The loop is too slow on the year, so it's timed on the first
+`LOOP_SAMPLE` traces and extrapolated.
+
+Run from the repository root with:
+    python -m benchmarks.bench_fit
+"""
+import time
+
+import numpy as np
+
+from _fit import damped_cosine, decay, fit_damped_cosine, fit_decay
+
+NR_DELAYS = 101
+NOISE = 0.02
+CHEVRON_ROWS = 500
+CYCLES_PER_YEAR = 365 * 24 * 60  # one T1 and one T2 per minute
+LOOP_SAMPLE = 2_000
+
+
+def fit_decay_loop(t, x):
+    # original implementation, kept here as reference
+    from scipy.optimize import curve_fit
+
+    popt = np.full((len(x), 3), np.nan)
+    perr = np.full((len(x), 3), np.nan)
+    for ii in range(len(x)):
+        T = 0.5 * (t[-1] - t[0])
+        xe, xg = x[ii, 0], x[ii, -1]
+        p0 = (T, xe, xg)
+        try:
+            with np.errstate(all="ignore"):
+                _popt, pcov = curve_fit(decay, t, x[ii], p0)
+        except Exception:
+            continue
+        popt[ii] = _popt
+        perr[ii] = np.sqrt(np.diag(pcov))
+    return popt, perr
+
+
+def fit_damped_cosine_loop(t, x):
+    # original implementation, kept here as reference
+    from scipy.optimize import curve_fit
+
+    popt = np.full((len(x), 5), np.nan)
+    perr = np.full((len(x), 5), np.nan)
+    for ii in range(len(x)):
+        y = x[ii]
+        pkpk = np.max(y) - np.min(y)
+        offset = np.min(y) + pkpk / 2
+        amplitude = 0.5 * pkpk
+        T2 = 0.5 * (np.max(t) - np.min(t))
+        freqs = np.fft.rfftfreq(len(t), t[1] - t[0])
+        fft = np.fft.rfft(y)
+        fft[0] = 0
+        idx_max = np.argmax(np.abs(fft))
+        frequency = freqs[idx_max]
+        phase = np.angle(fft[idx_max])
+        p0 = (offset, amplitude, T2, frequency, phase)
+        try:
+            with np.errstate(all="ignore"):
+                _popt, pcov = curve_fit(damped_cosine, t, y, p0=p0)
+        except Exception:
+            continue
+        popt[ii] = _popt
+        perr[ii] = np.sqrt(np.diag(pcov))
+    return popt, perr
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - t0, ret
+
+
+def _report(name, nr_traces, t_loop, popt_loop, t_batch, popt_batch, idx, truth):
+    # idx: parameter to compare, truth: its true value for each trace
+    nr_loop = len(popt_loop)
+    err_loop = np.abs(popt_loop[:, idx] / truth[:nr_loop] - 1)
+    err_batch = np.abs(popt_batch[:, idx] / truth - 1)
+    print(
+        f"{name:>10s} {nr_traces:10d} {t_loop:10.1f} {t_batch:10.1f} {t_loop / t_batch:8.1f} "
+        f"{100 * np.mean(np.isnan(err_loop)):8.2f} {100 * np.mean(np.isnan(err_batch)):8.2f} "
+        f"{100 * np.nanmedian(err_loop):9.2f} {100 * np.nanmedian(err_batch):9.2f}"
+    )
+
+
+def main():
+    rng = np.random.default_rng(1234)
+
+    print(f"{NR_DELAYS} delays per trace, noise {NOISE} of the contrast")
+    print(
+        f"{'':>10s} {'traces':>10s} {'loop [s]':>10s} {'batch [s]':>10s} {'speedup':>8s} "
+        f"{'fail L %':>8s} {'fail B %':>8s} {'err L %':>9s} {'err B %':>9s}"
+    )
+
+    # Ramsey chevron: detuning goes through zero in the middle of the sweep
+    t = np.linspace(0.0, 20e-6, NR_DELAYS)
+    det = np.abs(np.linspace(-2e6, 2e6, CHEVRON_ROWS))
+    T2 = 10e-6
+    phase = rng.uniform(-np.pi, np.pi, CHEVRON_ROWS)
+    x = damped_cosine(t, 0.5, 0.5, T2, det[:, None], phase[:, None])
+    x += NOISE * rng.normal(size=x.shape)
+    t_loop, (popt_loop, _) = _timeit(fit_damped_cosine_loop, t, x)
+    t_batch, (popt_batch, _) = _timeit(fit_damped_cosine, t, x)
+    # compare T2, since the detuning is zero at the center
+    T2_arr = np.full(CHEVRON_ROWS, T2)
+    _report("chevron", CHEVRON_ROWS, t_loop, popt_loop, t_batch, popt_batch, 2, T2_arr)
+
+    # a year of CycleTs: T1 and echo T2 drift and fluctuate
+    t = np.linspace(0.0, 200e-6, NR_DELAYS)
+    for name, mean in [("T1", 40e-6), ("T2 echo", 60e-6)]:
+        Tx = mean * rng.lognormal(0.0, 0.2, CYCLES_PER_YEAR)
+        x = decay(t, Tx[:, None], 1.0, 0.0)
+        x += NOISE * rng.normal(size=x.shape)
+        t_loop, (popt_loop, _) = _timeit(fit_decay_loop, t, x[:LOOP_SAMPLE])
+        t_loop *= CYCLES_PER_YEAR / LOOP_SAMPLE
+        t_batch, (popt_batch, _) = _timeit(fit_decay, t, x)
+        _report(name, CYCLES_PER_YEAR, t_loop, popt_loop, t_batch, popt_batch, 0, Tx)
+        del x
+    print(f"loop extrapolated from {LOOP_SAMPLE} traces for the year of CycleTs")
+
+
+if __name__ == "__main__":
+    main()
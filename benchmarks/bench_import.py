@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the import time of each module, with `python -X importtime`.
+
+Each module is imported in a new interpreter, `NR_REPEAT` times, and the table shows the median
+cumulative import time, the part of it spent in numpy and h5py (needed by all the modules to load
+and save data, measured once by importing only them), and the heavy packages imported with the
+module. Importing a module must not import the instrument drivers (`presto`), nor plotting or
+fitting packages (`matplotlib`, `scipy`): they are imported by `run` and `analyze` when needed.
+The run fails if a module imports any of them, or takes more than `BUDGET` seconds on top of numpy
+and h5py.
+
+Run from the repository root with:
+    python -m benchmarks.bench_import
+"""
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+MODULES = [
+    "_base",
+    "_session",
+    "_templates",
+    "ac_stark_shift",
+    "batch_analyze",
+    "cycle_Ts",
+    "excited_sweep",
+    "jpa_sweep_bias",
+    "jpa_sweep_power_bias",
+    "parallel",
+    "rabi_amp",
+    "ramsey_chevron",
+    "ramsey_echo",
+    "ramsey_single",
+    "readout_ref",
+    "readout_reset",
+    "sequence",
+    "sweep",
+    "sweep_power",
+    "t1",
+    "two_tone_power",
+    "two_tone_pulsed",
+]
+BASELINE = ["numpy", "h5py"]
+HEAVY = ["presto", "matplotlib", "scipy", "pandas"]
+NR_REPEAT = 5
+BUDGET = 0.1  # s, on top of numpy and h5py
+
+
+def import_times(module: str):
+    """Cumulative import time in seconds of `module` and of each package imported with it.
+
+    `module` can also be a comma-separated list, e.g. `"numpy, h5py"`.
+    """
+    ret = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    if ret.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{ret.stderr}")
+    times = {}
+    # import time: self [us] | cumulative | imported package
+    for line in ret.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # each package is listed once, where it is first imported
+        times[name.strip()] = int(cumulative) * 1e-6
+    return times
+
+
+def main():
+    print(
+        f"{'module':>22s} {'total [ms]':>11s} {'numpy+h5py':>11s} {'own [ms]':>9s}  heavy imports"
+    )
+    baseline = []
+    for _ in range(NR_REPEAT):
+        times = import_times(", ".join(BASELINE))
+        baseline.append(sum(times[name] for name in BASELINE))
+    baseline = np.median(baseline)
+
+    failed = []
+    for module in MODULES:
+        total, heavy = [], set()
+        for _ in range(NR_REPEAT):
+            times = import_times(module)
+            total.append(times[module])
+            heavy |= {name.split(".")[0] for name in times if name.split(".")[0] in HEAVY}
+        total = np.median(total)
+        own = max(total - baseline, 0.0)
+        print(
+            f"{module:>22s} {1e3 * total:11.1f} {1e3 * baseline:11.1f} {1e3 * own:9.1f}  "
+            f"{', '.join(sorted(heavy)) or '-'}"
+        )
+        if heavy or own > BUDGET:
+            failed.append(module)
+    if failed:
+        print(f"over budget ({1e3 * BUDGET:.0f} ms) or importing heavy packages: {failed}")
+        sys.exit(1)
+    print(f"all modules within budget ({1e3 * BUDGET:.0f} ms on top of numpy and h5py)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Benchmark `_mixture.fit_gaussian_mixture` against the fit to the histogram in `ReadoutReset`.
+
+The shots are drawn from two Gaussians, |g> and |e>, with a small and wide excited population as
+before an active reset. Both fitters are run `NR_REPEAT` times with new shots, and the table shows
+the median time and the root-mean-square error of the excited population and of the assignment
+error of |e>.
+
+Run from the repository root with:
+    python -m benchmarks.bench_mixture
+"""
+import time
+
+import numpy as np
+from scipy.special import erf
+
+from _mixture import fit_gaussian_mixture
+
+NR_SHOTS = [10_000, 100_000, 1_000_000, 10_000_000]
+NR_REPEAT = 5
+CHUNK_SIZE = 1_000_000
+# truth: m0, s0, w0, m1, s1, w1
+TRUTH = np.array([-0.05, 0.010, 0.92, 0.05, 0.012, 0.08])
+
+
+def single_gaussian(x, m, s, w):
+    return w * np.exp(-((x - m) ** 2) / (2 * s**2)) / np.sqrt(2 * np.pi * s**2)
+
+
+def double_gaussian(x, m0, s0, w0, m1, s1, w1):
+    return single_gaussian(x, m0, s0, w0) + single_gaussian(x, m1, s1, w1)
+
+
+def double_gaussian_fixed(x, m0, s0, w0, m1, s1):
+    w1 = 1.0 - w0
+    return double_gaussian(x, m0, s0, w0, m1, s1, w1)
+
+
+def error(m, s):
+    x = abs(m) / (np.sqrt(2) * s)
+    return 0.5 * (1 - erf(x))
+
+
+def _init(match_diff):
+    # split at zero, as in `ReadoutReset.analyze`
+    idx_low = match_diff < 0
+    low = match_diff[idx_low]
+    high = match_diff[~idx_low]
+    weight_low = len(low) / len(match_diff)
+    return np.array([low.mean(), low.std(), weight_low, high.mean(), high.std(), 1 - weight_low])
+
+
+def fit_hist(match_diff):
+    # original implementation, kept here as reference
+    from scipy.optimize import curve_fit
+
+    init = _init(match_diff)
+    std = max(init[1], init[4])
+    x_min = init[0] - 5 * std
+    x_max = init[3] + 5 * std
+    nr_bins = int(round(np.sqrt(match_diff.shape[0])))
+    H, xedges = np.histogram(match_diff, bins=nr_bins, range=(x_min, x_max), density=True)
+    xdata = 0.5 * (xedges[1:] + xedges[:-1])
+    popt, _ = curve_fit(double_gaussian_fixed, xdata, H, p0=init[:-1])
+    return np.r_[popt, 1.0 - popt[2]]
+
+
+def fit_em(match_diff, chunk_size=None):
+    init = _init(match_diff)
+    w, m, v = fit_gaussian_mixture(
+        match_diff,
+        weights=init[[2, 5]],
+        means=init[[0, 3]],
+        covariances=init[[1, 4]] ** 2,
+        chunk_size=chunk_size,
+    )
+    s = np.sqrt(v)
+    return np.array([m[0], s[0], w[0], m[1], s[1], w[1]])
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - t0, ret
+
+
+def _shots(rng, nr_shots):
+    m0, s0, _, m1, s1, w1 = TRUTH
+    excited = rng.random(nr_shots) < w1
+    return np.where(excited, rng.normal(m1, s1, nr_shots), rng.normal(m0, s0, nr_shots))
+
+
+def _rms(x):
+    return np.sqrt(np.mean(np.square(x)))
+
+
+def main():
+    rng = np.random.default_rng(1234)
+    err_true = error(TRUTH[3], TRUTH[4])
+
+    print(f"excited population {TRUTH[5]:.0%}, assignment error of |e> {err_true:.2e}")
+    print(
+        f"{'shots':>10s} {'hist [s]':>10s} {'EM [s]':>10s} {'speedup':>8s} "
+        f"{'w1 H %':>8s} {'w1 EM %':>8s} {'err H %':>8s} {'err EM %':>8s}"
+    )
+    for nr_shots in NR_SHOTS:
+        t_hist, t_em = [], []
+        w_hist, w_em, e_hist, e_em = [], [], [], []
+        for _ in range(NR_REPEAT):
+            match_diff = _shots(rng, nr_shots)
+            _t, popt = _timeit(fit_hist, match_diff)
+            t_hist.append(_t)
+            w_hist.append(popt[5] - TRUTH[5])
+            e_hist.append(error(popt[3], popt[4]) / err_true - 1)
+            _t, popt = _timeit(fit_em, match_diff)
+            t_em.append(_t)
+            w_em.append(popt[5] - TRUTH[5])
+            e_em.append(error(popt[3], popt[4]) / err_true - 1)
+        t_hist = np.median(t_hist)
+        t_em = np.median(t_em)
+        print(
+            f"{nr_shots:10d} {t_hist:10.3f} {t_em:10.3f} {t_hist / t_em:8.2f} "
+            f"{100 * _rms(w_hist):8.3f} {100 * _rms(w_em):8.3f} "
+            f"{100 * _rms(e_hist):8.1f} {100 * _rms(e_em):8.1f}"
+        )
+    print("w1: absolute error of the excited population, err: relative error of the assignment")
+
+    nr_shots = NR_SHOTS[-1]
+    match_diff = _shots(rng, nr_shots)
+    t_em, popt = _timeit(fit_em, match_diff)
+    t_chunk, popt_chunk = _timeit(fit_em, match_diff, CHUNK_SIZE)
+    assert np.allclose(popt, popt_chunk, rtol=1e-4)
+    print(f"{nr_shots} shots in chunks of {CHUNK_SIZE}: {t_chunk:.3f} s, all at once {t_em:.3f} s")
+
+    # IQ: no histogram fit to compare with
+    excited = rng.random(nr_shots) < TRUTH[5]
+    noise = rng.normal(size=(nr_shots, 2)).view(np.complex128)[:, 0]
+    shots = np.where(excited, 1.0 + 1.0j, 0.2 + 0.5j) + 0.2 * noise
+    t_iq, (w, m, cov) = _timeit(fit_gaussian_mixture, shots)
+    print(f"{nr_shots} IQ shots: {t_iq:.3f} s, excited population {w[1]:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Benchmark `_base.project` against the original row-by-row implementation.
+
+Run from the repository root with:
+    python -m benchmarks.bench_project
+"""
+import time
+
+import numpy as np
+
+from _base import project
+
+NR_ROWS = [1_000, 100_000, 1_000_000]
+NR_SAMPLES = 100
+CHUNK_SIZE = 65_536
+
+
+def project_loop(resp_arr, reference_templates):
+    # original implementation, kept here as reference
+    ref_g, ref_e = reference_templates
+    conj_g = ref_g.conj()
+    conj_e = ref_e.conj()
+    norm_g = np.sum(ref_g * conj_g).real
+    norm_e = np.sum(ref_e * conj_e).real
+    overlap = np.sum(ref_g * conj_e).real
+    proj_g = np.zeros(resp_arr.shape[0])
+    proj_e = np.zeros(resp_arr.shape[0])
+    for i in range(resp_arr.shape[0]):
+        proj_g[i] = np.sum(conj_g * resp_arr[i, :]).real
+        proj_e[i] = np.sum(conj_e * resp_arr[i, :]).real
+    res = proj_e - proj_g
+    res_g = overlap - norm_g
+    res_e = norm_e - overlap
+    res_min = res_g
+    res_rng = res_e - res_g
+    data = (res - res_min) / res_rng
+    return data
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - t0, ret
+
+
+def main():
+    rng = np.random.default_rng(1234)
+    ref_g = np.exp(1j * np.linspace(0.0, np.pi, NR_SAMPLES))
+    ref_e = np.exp(1j * np.linspace(0.0, 2 * np.pi, NR_SAMPLES))
+    templates = (ref_g, ref_e)
+
+    print(f"{NR_SAMPLES} samples per row")
+    print(
+        f"{'rows':>10s} {'dtype':>10s} {'loop [s]':>10s} {'matvec [s]':>10s} {'chunked [s]':>11s}"
+    )
+    for nr_rows in NR_ROWS:
+        states = rng.integers(0, 2, nr_rows)
+        noise = rng.normal(size=(nr_rows, NR_SAMPLES, 2)).view(np.complex128)[..., 0]
+        resp_arr = np.where(states[:, None], ref_e, ref_g) + 0.1 * noise
+        del noise
+        for dtype in [np.complex128, np.complex64]:
+            resp_arr = resp_arr.astype(dtype)
+            t_loop, ref = _timeit(project_loop, resp_arr, templates)
+            t_vec, data = _timeit(project, resp_arr, templates)
+            t_chunk, data_chunk = _timeit(project, resp_arr, templates, chunk_size=CHUNK_SIZE)
+            assert np.allclose(ref, data, atol=1e-4)
+            assert np.allclose(ref, data_chunk, atol=1e-4)
+            print(
+                f"{nr_rows:10d} {np.dtype(dtype).name:>10s} {t_loop:10.3f} {t_vec:10.3f} {t_chunk:11.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
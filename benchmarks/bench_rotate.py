@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Benchmark `_rotate.rotate_opt` against the original scan over 360 angles.
+
+Run from the repository root with:
+    python -m benchmarks.bench_rotate
+"""
+import time
+
+import numpy as np
+
+from _rotate import rotate_opt
+
+NR_SHOTS = [1_000, 100_000, 1_000_000, 10_000_000]
+CHEVRON_SHAPE = (500, 101)
+
+
+def rotate_opt_loop(data):
+    # original implementation, kept here as reference
+    N = 360
+    _mean = np.zeros(N)
+    for ii in range(N):
+        _data = data * np.exp(1j * 2 * np.pi / N * ii)
+        _mean[ii] = np.mean(_data.imag**2)
+    fft = np.fft.rfft(_mean) / N
+    x_fft1 = -np.angle(fft[2])
+    x_fft1 -= np.pi
+    x_fft1 /= 2
+    x_fft2 = x_fft1 + np.pi
+    x_fft1 = (x_fft1 + np.pi) % (2 * np.pi) - np.pi
+    x_fft2 = (x_fft2 + np.pi) % (2 * np.pi) - np.pi
+    if np.abs(x_fft1) < np.abs(x_fft2):
+        x_fft = x_fft1
+    else:
+        x_fft = x_fft2
+    return data * np.exp(1j * x_fft)
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - t0, ret
+
+
+def _shots(rng, shape, dtype=np.complex128):
+    states = rng.integers(0, 2, shape)
+    noise = rng.normal(size=shape + (2,)).view(np.complex128)[..., 0]
+    return ((0.3 + 0.8j * states) * np.exp(0.4j) + 0.2 * noise).astype(dtype)
+
+
+def main():
+    rng = np.random.default_rng(1234)
+
+    print("single angle for all the shots")
+    print(f"{'shots':>10s} {'loop [s]':>10s} {'closed [s]':>10s} {'real [s]':>10s}")
+    for nr_shots in NR_SHOTS:
+        data = _shots(rng, (nr_shots,))
+        t_loop, ref = _timeit(rotate_opt_loop, data)
+        t_closed, rotated = _timeit(rotate_opt, data)
+        t_real, rotated_real = _timeit(rotate_opt, data, real=True)
+        assert np.allclose(ref, rotated)
+        assert np.allclose(ref.real, rotated_real)
+        print(f"{nr_shots:10d} {t_loop:10.3f} {t_closed:10.3f} {t_real:10.3f}")
+
+    print(f"one angle per row of a {CHEVRON_SHAPE} chevron")
+    data = _shots(rng, CHEVRON_SHAPE)
+    t_loop, ref = _timeit(lambda x: np.array([rotate_opt_loop(row) for row in x]), data)
+    t_closed, rotated = _timeit(rotate_opt, data, axis=-1)
+    assert np.allclose(ref, rotated)
+    print(f"{'loop [s]':>10s} {'closed [s]':>10s}")
+    print(f"{t_loop:10.3f} {t_closed:10.3f}")
+
+
+if __name__ == "__main__":
+    main()
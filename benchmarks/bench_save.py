@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Benchmark `Base.save`: save time and file size for each experiment class.
+
+The arrays have the shapes produced by a typical run of each experiment, filled with a simulated
+readout response plus noise. Run from the repository root with:
+    python -m benchmarks.bench_save
+"""
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from presto.utils import get_sourcecode
+
+from _base import Base
+
+NR_SAMPLES = 4_000  # 4 us store window
+NR_DELAYS = 101
+NR_FREQ = 1_001
+
+# array attributes saved by each class: name -> (shape, dtype)
+EXPERIMENTS = {
+    "T1": ("t1.py", {"delay_arr": ((NR_DELAYS,), float), "store_arr": ((NR_DELAYS, 1), complex)}),
+    "RabiAmp": (
+        "rabi_amp.py",
+        {"control_amp_arr": ((NR_DELAYS,), float), "store_arr": ((NR_DELAYS, 1), complex)},
+    ),
+    "RamseySingle": (
+        "ramsey_single.py",
+        {"delay_arr": ((NR_DELAYS,), float), "store_arr": ((NR_DELAYS, 1), complex)},
+    ),
+    "RamseyEcho": (
+        "ramsey_echo.py",
+        {"delay_arr": ((NR_DELAYS,), float), "store_arr": ((NR_DELAYS, 1), complex)},
+    ),
+    "RamseyChevron": (
+        "ramsey_chevron.py",
+        {
+            "delay_arr": ((NR_DELAYS,), float),
+            "control_freq_arr": ((51,), float),
+            "store_arr": ((51 * NR_DELAYS, 1), complex),
+        },
+    ),
+    "AcStarkShift": (
+        "ac_stark_shift.py",
+        {
+            "delay_arr": ((NR_DELAYS,), float),
+            "ringup_amp_arr": ((21,), float),
+            "store_arr": ((21 * NR_DELAYS, 1), complex),
+        },
+    ),
+    "TwoTonePulsed": (
+        "two_tone_pulsed.py",
+        {"control_freq_arr": ((201,), float), "store_arr": ((201, 1), complex)},
+    ),
+    "ExcitedSweep": (
+        "excited_sweep.py",
+        {
+            "readout_freq_arr": ((201,), float),
+            "readout_if_arr": ((201,), float),
+            "store_arr": ((2 * 201, 1), complex),
+        },
+    ),
+    "ReadoutRef": ("readout_ref.py", {"store_arr": ((2, 1), complex)}),
+    "ReadoutReset": (
+        "readout_reset.py",
+        {
+            "ref_g": ((1_000,), complex),
+            "ref_e": ((1_000,), complex),
+            "store_arr": ((2, 1), complex),
+            "match_g_arr": ((40_000,), float),
+            "match_e_arr": ((40_000,), float),
+        },
+    ),
+    "Sweep": ("sweep.py", {"freq_arr": ((NR_FREQ,), float), "resp_arr": ((NR_FREQ,), complex)}),
+    "SweepPower": (
+        "sweep_power.py",
+        {
+            "amp_arr": ((51,), float),
+            "freq_arr": ((NR_FREQ,), float),
+            "resp_arr": ((51, NR_FREQ), complex),
+        },
+    ),
+    "TwoTonePower": (
+        "two_tone_power.py",
+        {
+            "control_amp_arr": ((51,), float),
+            "control_freq_arr": ((NR_FREQ,), float),
+            "resp_arr": ((51, NR_FREQ), complex),
+        },
+    ),
+    "JpaSweepBias": (
+        "jpa_sweep_bias.py",
+        {
+            "bias_arr": ((101,), float),
+            "freq_arr": ((NR_FREQ,), float),
+            "resp_arr": ((101, NR_FREQ), complex),
+        },
+    ),
+    "JpaSweepPowerBias": (
+        "jpa_sweep_power_bias.py",
+        {
+            "bias_arr": ((101,), float),
+            "pump_pwr_arr": ((11,), int),
+            "freq_arr": ((NR_FREQ,), float),
+            "ref_resp_arr": ((101, NR_FREQ), complex),
+            "ref_pwr_arr": ((101, NR_FREQ), float),
+            "resp_arr": ((11, 101, NR_FREQ), complex),
+            "pwr_arr": ((11, 101, NR_FREQ), float),
+        },
+    ),
+}
+
+OPTIONS = {
+    "default": {},
+    "gzip+shuffle": {"compression": "gzip", "shuffle": True},
+    "lzf+shuffle": {"compression": "lzf", "shuffle": True},
+    "complex64": {"downcast": True},
+    "complex64+gzip": {"downcast": True, "compression": "gzip", "shuffle": True},
+}
+
+
+class _Experiment(Base):
+    def __init__(self, arrays):
+        self.readout_freq = 6e9
+        self.num_averages = 1_000
+        self.__dict__.update(arrays)
+
+
+def save_legacy(experiment, script_path, save_path):
+    # original implementation, kept here as reference
+    source_code = get_sourcecode(script_path)
+    with h5py.File(save_path, "w") as h5f:
+        dt = h5py.string_dtype(encoding="utf-8")
+        ds = h5f.create_dataset("source_code", (len(source_code),), dt)
+        for ii, line in enumerate(source_code):
+            ds[ii] = line
+        for attribute in experiment.__dict__:
+            if np.isscalar(experiment.__dict__[attribute]):
+                h5f.attrs[attribute] = experiment.__dict__[attribute]
+            else:
+                h5f.create_dataset(attribute, data=experiment.__dict__[attribute])
+
+
+def _make_arrays(spec, rng):
+    arrays = {}
+    t = np.arange(NR_SAMPLES) * 1e-9
+    for name, (shape, dtype) in spec.items():
+        if name == "store_arr":
+            # ringing-up readout response, quantization-like noise from averaging
+            shape = shape + (NR_SAMPLES,)
+            trace = 1e-2 * (1.0 - np.exp(-t / 200e-9)) * np.exp(2j * np.pi * 10e6 * t)
+            noise = rng.normal(scale=1e-3, size=shape + (2,)).view(np.complex128)[..., 0]
+            arrays[name] = trace + noise
+        elif dtype is complex:
+            arrays[name] = rng.normal(size=shape + (2,)).view(np.complex128)[..., 0]
+        elif dtype is int:
+            arrays[name] = np.arange(np.prod(shape)).reshape(shape)
+        else:
+            arrays[name] = rng.normal(size=shape)
+    return arrays
+
+
+def _print(*columns):
+    print(f"{columns[0]:>18s}" + "".join(f"{c:>16s}" for c in columns[1:]))
+
+
+def main():
+    rng = np.random.default_rng(1234)
+    tmpdir = tempfile.mkdtemp()
+    save_path = os.path.join(tmpdir, "bench.h5")
+
+    _print("", "legacy", *OPTIONS)
+    for name, (script, spec) in EXPERIMENTS.items():
+        experiment = _Experiment(_make_arrays(spec, rng))
+        results = []
+
+        t0 = time.perf_counter()
+        save_legacy(experiment, script, save_path)
+        results.append((time.perf_counter() - t0, os.path.getsize(save_path)))
+
+        for kwargs in OPTIONS.values():
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                experiment.save(script, save_path, **kwargs)
+            results.append((time.perf_counter() - t0, os.path.getsize(save_path)))
+
+        _print(name, *(f"{1e3 * t:.0f}ms {size / 1e6:.1f}MB" for t, size in results))
+        os.remove(save_path)
+    os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
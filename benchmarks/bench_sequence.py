@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Benchmark `Sequence` against running the same experiments one by one. Needs the instrument.
+
+A calibration round of `T1`, `RamseySingle` and `RamseyEcho` is run three times: one experiment
+after the other, each with its own connection (as from a script); one after the other in a
+`Session`, sharing the connection and the hardware settings; and as one `Sequence`, with a single
+upload and `pls.run`. The table shows the wall time of each, without saving, and the reduction
+with respect to the first. The experiments use typical settings, edit `COMMON` for your setup.
+
+Run from the repository root with:
+    python -m benchmarks.bench_sequence <presto_address>
+"""
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+
+from _session import Session
+from ramsey_echo import RamseyEcho
+from ramsey_single import RamseySingle
+from sequence import Sequence
+from t1 import T1
+
+NR_REPEAT = 3
+DETUNING = 50e3  # Hz, for RamseySingle
+COMMON = dict(
+    readout_freq=6.2e9,
+    control_freq=4.1e9,
+    readout_amp=0.1,
+    readout_duration=2.5e-6,
+    control_duration=20e-9,
+    sample_duration=4e-6,
+    readout_port=1,
+    control_port=4,
+    sample_port=1,
+    wait_delay=200e-6,
+    readout_sample_delay=290e-9,
+    num_averages=1_000,
+)
+
+
+def _experiments():
+    delay_arr = np.linspace(0, 100e-6, 101)
+    common = dict(COMMON, delay_arr=delay_arr)
+    t1 = T1(control_amp=0.5, **common)
+    detuned = dict(common, control_freq=COMMON["control_freq"] + DETUNING)
+    ramsey = RamseySingle(control_amp=0.25, **detuned)
+    echo = RamseyEcho(control_amp_90=0.25, control_amp_180=0.5, **common)
+    return [t1, ramsey, echo]
+
+
+def _timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ret = func(*args, **kwargs)
+    return time.perf_counter() - t0, ret
+
+
+def one_by_one(address):
+    for exp in _experiments():
+        exp.run(address, save=False)
+
+
+def in_session(address):
+    with Session() as session:
+        for exp in _experiments():
+            exp.run(address, save=False, session=session)
+
+
+def in_sequence(address):
+    seq = Sequence(_experiments())
+    seq.run(address, save=False)
+    return seq
+
+
+def main():
+    address = sys.argv[1]
+    nominal = sum(
+        exp.num_averages * len(exp.delay_arr) * (exp.wait_delay + exp.readout_duration)
+        for exp in _experiments()
+    )
+    print(f"nominal acquisition time (waits and readouts only): {nominal:.3f} s")
+    print(f"{'':>12s} {'time [s]':>9s} {'reduction':>10s}")
+    t_ref = None
+    for name, func in [("one by one", one_by_one), ("session", in_session)]:
+        t = np.median([_timeit(func, address)[0] for _ in range(NR_REPEAT)])
+        t_ref = t if t_ref is None else t_ref
+        print(f"{name:>12s} {t:9.3f} {100 * (1 - t / t_ref):9.1f}%")
+    times = [_timeit(in_sequence, address) for _ in range(NR_REPEAT)]
+    t = np.median([t for t, _ in times])
+    print(f"{'sequence':>12s} {t:9.3f} {100 * (1 - t / t_ref):9.1f}%")
+    times[-1][1].report(sequential=t_ref)
+
+
+if __name__ == "__main__":
+    main()
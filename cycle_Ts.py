@@ -9,15 +9,12 @@ import time
 from typing import List, Optional
 
 import h5py
-from matplotlib import _pylab_helpers
-import matplotlib.pyplot as plt
-import matplotlib.widgets as mwidgets
 import numpy as np
 
-from presto.utils import format_precision
-
 from _base import Base
+from _session import Session
 from ramsey_echo import RamseyEcho
+from sequence import Sequence
 from t1 import T1 as T1Class
 
 KEEP_GOING = True
@@ -45,6 +42,7 @@ class CycleTs(Base):
         drag: float = 0.0,
         ref_g: Optional[List[complex]] = None,
         ref_e: Optional[List[complex]] = None,
+        interleaved: bool = False,
     ) -> None:
         self.readout_freq = readout_freq
         self.control_freq = control_freq
@@ -65,6 +63,8 @@ class CycleTs(Base):
         self.drag = drag
         # self.ref_g = ref_g
         # self.ref_e = ref_e
+        # measure T1 and T2 in the same program, with the delays of the two interleaved
+        self.interleaved = interleaved
 
         self.time_start: float = 0.0  # replaced by run
         self._nr_delays = len(self.delay_arr)
@@ -92,6 +92,8 @@ class CycleTs(Base):
         presto_port: Optional[int] = None,
         ext_ref_clk: bool = False,
     ):
+        import matplotlib.pyplot as plt
+        from presto.utils import format_precision
 
         self.time_start = time.time()
         # save initial parameters
@@ -110,52 +112,83 @@ class CycleTs(Base):
         _my_pause()
 
         signal.signal(signal.SIGINT, _handler)
-        count = 0
-        global KEEP_GOING
-        while KEEP_GOING:
-            print("\n\n\n")
-            print(f"******* Run number {count+1:d} *******")
-            count += 1
-
-            print("\n")
-            print("------- measure T1 -------")
-            self._data1, t1, t1_err = self.measure_t1(presto_address, presto_port, ext_ref_clk)
-            print("T1 = {:s} μs".format(format_precision(1e6 * t1, 1e6 * t1_err)))
-
-            # self._data1 = np.vstack((self._data1, data1))
-            self._t1_arr = np.r_[self._t1_arr, t1]
-            self._t1_err_arr = np.r_[self._t1_err_arr, t1_err]
-            self._time1_arr = np.r_[self._time1_arr, time.time()]
-            self.append(1)
-
-            line_t1.set_data(self._time1_arr - self.time_start, 1e6 * self._t1_arr)
-            ax.relim()
-            ax.autoscale()
-            _my_pause(1.0)
-
-            print("\n")
-            print("------- measure T2 -------")
-            self._data2, t2, t2_err = self.measure_t2(presto_address, presto_port, ext_ref_clk)
-            print("T2 = {:s} μs".format(format_precision(1e6 * t2, 1e6 * t2_err)))
-
-            # self._data2 = np.vstack((self._data2, data2))
-            self._t2_arr = np.r_[self._t2_arr, t2]
-            self._t2_err_arr = np.r_[self._t2_err_arr, t2_err]
-            self._time2_arr = np.r_[self._time2_arr, time.time()]
-            self.append(2)
-
-            line_t2.set_data(self._time2_arr - self.time_start, 1e6 * self._t2_arr)
-            ax.relim()
-            ax.autoscale()
-            _my_pause(1.0)
+        # keep the connection and the hardware settings between the T1 and T2 runs
+        with Session() as session:
+            count = 0
+            global KEEP_GOING
+            while KEEP_GOING:
+                print("\n\n\n")
+                print(f"******* Run number {count+1:d} *******")
+                count += 1
+
+                if self.interleaved:
+                    print("\n")
+                    print("------- measure T1 and T2 -------")
+                    (self._data1, t1, t1_err), (self._data2, t2, t2_err) = self.measure_t1_t2(
+                        presto_address, presto_port, ext_ref_clk, session
+                    )
+                    print("T1 = {:s} μs".format(format_precision(1e6 * t1, 1e6 * t1_err)))
+                    print("T2 = {:s} μs".format(format_precision(1e6 * t2, 1e6 * t2_err)))
+
+                    now = time.time()
+                    self._t1_arr = np.r_[self._t1_arr, t1]
+                    self._t1_err_arr = np.r_[self._t1_err_arr, t1_err]
+                    self._time1_arr = np.r_[self._time1_arr, now]
+                    self._t2_arr = np.r_[self._t2_arr, t2]
+                    self._t2_err_arr = np.r_[self._t2_err_arr, t2_err]
+                    self._time2_arr = np.r_[self._time2_arr, now]
+                    self.append(3)
+
+                    line_t1.set_data(self._time1_arr - self.time_start, 1e6 * self._t1_arr)
+                    line_t2.set_data(self._time2_arr - self.time_start, 1e6 * self._t2_arr)
+                    ax.relim()
+                    ax.autoscale()
+                    _my_pause(1.0)
+                    continue
+
+                print("\n")
+                print("------- measure T1 -------")
+                self._data1, t1, t1_err = self.measure_t1(
+                    presto_address, presto_port, ext_ref_clk, session
+                )
+                print("T1 = {:s} μs".format(format_precision(1e6 * t1, 1e6 * t1_err)))
+
+                # self._data1 = np.vstack((self._data1, data1))
+                self._t1_arr = np.r_[self._t1_arr, t1]
+                self._t1_err_arr = np.r_[self._t1_err_arr, t1_err]
+                self._time1_arr = np.r_[self._time1_arr, time.time()]
+                self.append(1)
+
+                line_t1.set_data(self._time1_arr - self.time_start, 1e6 * self._t1_arr)
+                ax.relim()
+                ax.autoscale()
+                _my_pause(1.0)
+
+                print("\n")
+                print("------- measure T2 -------")
+                self._data2, t2, t2_err = self.measure_t2(
+                    presto_address, presto_port, ext_ref_clk, session
+                )
+                print("T2 = {:s} μs".format(format_precision(1e6 * t2, 1e6 * t2_err)))
+
+                # self._data2 = np.vstack((self._data2, data2))
+                self._t2_arr = np.r_[self._t2_arr, t2]
+                self._t2_err_arr = np.r_[self._t2_err_arr, t2_err]
+                self._time2_arr = np.r_[self._time2_arr, time.time()]
+                self.append(2)
+
+                line_t2.set_data(self._time2_arr - self.time_start, 1e6 * self._t2_arr)
+                ax.relim()
+                ax.autoscale()
+                _my_pause(1.0)
 
         print("\n\n\n")
         print("Done")
         input("___ Press Enter to close ___")
 
-    def save(self, save_filename: Optional[str] = None) -> str:
+    def save(self, save_filename: Optional[str] = None, **kwargs) -> str:
         # save parameters
-        self._save_filename = super().save(__file__, save_filename=save_filename)
+        self._save_filename = super().save(__file__, save_filename=save_filename, **kwargs)
         # add growable arrays
         with h5py.File(self._save_filename, "a") as h5f:
             # h5f.create_dataset('data1', data=self._data1, compression="gzip", chunks=True, maxshape=(None, self._nr_delays))
@@ -253,6 +286,7 @@ class CycleTs(Base):
             num_averages = int(h5f.attrs["num_averages"])
             jpa_params = ast.literal_eval(h5f.attrs["jpa_params"])
             drag = float(h5f.attrs["drag"])
+            interleaved = bool(h5f.attrs.get("interleaved", False))  # not saved by older versions
             # ref_g = np.array(h5f['ref_g'])
             # ref_e = np.array(h5f['ref_e'])
 
@@ -284,6 +318,7 @@ class CycleTs(Base):
             num_averages=num_averages,
             jpa_params=jpa_params,
             drag=drag,
+            interleaved=interleaved,
         )
         self.time_start = time_start
         self._time1_arr = time1_arr
@@ -296,6 +331,9 @@ class CycleTs(Base):
         return self
 
     def analyze(self, selector=True):
+        import matplotlib.pyplot as plt
+        import matplotlib.widgets as mwidgets
+
         ret_fig = []
 
         time1_arr = self._time1_arr - self.time_start
@@ -355,8 +393,52 @@ class CycleTs(Base):
 
         return ret_fig
 
-    def measure_t1(self, presto_address, presto_port, ext_ref_clk):
-        m = T1Class(
+    def measure_t1(self, presto_address, presto_port, ext_ref_clk, session=None):
+        m = self._t1_experiment()
+        m.run(presto_address, presto_port, ext_ref_clk, save=False, session=session)
+        data, (popt, perr) = m.analyze_batch(self._ref_templates)
+
+        t1 = np.nan if popt is None else popt[0]
+        t1_err = np.nan if perr is None else perr[0]
+
+        return data, t1, t1_err
+
+    def measure_t2(self, presto_address, presto_port, ext_ref_clk, session=None):
+        m = self._t2_experiment()
+        m.run(presto_address, presto_port, ext_ref_clk, save=False, session=session)
+        data, (popt, perr) = m.analyze_batch(self._ref_templates)
+
+        t2 = np.nan if popt is None else popt[0]
+        t2_err = np.nan if perr is None else perr[0]
+
+        return data, t2, t2_err
+
+    def measure_t1_t2(self, presto_address, presto_port, ext_ref_clk, session=None):
+        """Measure T1 and echo T2 with a single program and a single call to `pls.run`.
+
+        The T1 and echo experiments are run as an interleaved `Sequence`: for each delay, the T1
+        shot is followed by the echo shot, so that the two decays are acquired at the same time.
+        The data is analyzed as in `measure_t1` and `measure_t2`.
+
+        Returns:
+            `(data1, t1, t1_err), (data2, t2, t2_err)`
+        """
+        experiments = [self._t1_experiment(), self._t2_experiment()]
+        Sequence(experiments, interleave=True).run(
+            presto_address, presto_port, ext_ref_clk, save=False, session=session
+        )
+
+        ret = []
+        for m in experiments:
+            data, (popt, perr) = m.analyze_batch(self._ref_templates)
+            tx = np.nan if popt is None else popt[0]
+            tx_err = np.nan if perr is None else perr[0]
+            ret.append((data, tx, tx_err))
+
+        return tuple(ret)
+
+    def _t1_experiment(self) -> T1Class:
+        return T1Class(
             readout_freq=self.readout_freq,
             control_freq=self.control_freq,
             readout_amp=self.readout_amp,
@@ -374,16 +456,9 @@ class CycleTs(Base):
             jpa_params=self.jpa_params,
             drag=self.drag,
         )
-        m.run(presto_address, presto_port, ext_ref_clk, save=False)
-        data, (popt, perr) = m.analyze_batch(self._ref_templates)
 
-        t1 = np.nan if popt is None else popt[0]
-        t1_err = np.nan if perr is None else perr[0]
-
-        return data, t1, t1_err
-
-    def measure_t2(self, presto_address, presto_port, ext_ref_clk):
-        m = RamseyEcho(
+    def _t2_experiment(self) -> RamseyEcho:
+        return RamseyEcho(
             readout_freq=self.readout_freq,
             control_freq=self.control_freq,
             readout_amp=self.readout_amp,
@@ -402,13 +477,6 @@ class CycleTs(Base):
             jpa_params=self.jpa_params,
             drag=self.drag,
         )
-        m.run(presto_address, presto_port, ext_ref_clk, save=False)
-        data, (popt, perr) = m.analyze_batch(self._ref_templates)
-
-        t2 = np.nan if popt is None else popt[0]
-        t2_err = np.nan if perr is None else perr[0]
-
-        return data, t2, t2_err
 
 
 def get_save_filename():
@@ -422,6 +490,8 @@ def get_save_filename():
 
 
 def _my_pause(interval=0.1):
+    from matplotlib import _pylab_helpers
+
     manager = _pylab_helpers.Gcf.get_active()
     if manager is not None:
         canvas = manager.canvas
@@ -1,20 +1,21 @@
 # -*- coding: utf-8 -*-
 """Pulsed frequency sweep on the resonator with and without a π/2 control pulse."""
-import h5py
-import numpy as np
+from functools import partial
+from typing import Optional
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.utils import sin2, untwist_downconversion
+import numpy as np
 
 from _base import Base
+from _bootstrap import bootstrap, check_averaged
+from _session import Session, connect
+from _templates import sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -68,9 +69,14 @@ class ExcitedSweep(Base):
         presto_address: str,
         presto_port: int = None,
         ext_ref_clk: bool = False,
+        session: Optional[Session] = None,
     ) -> str:
+        from presto import pulsed
+
         # Instantiate interface class
-        with pulsed.Pulsed(
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -155,7 +161,7 @@ class ExcitedSweep(Base):
             control_ns = int(
                 round(self.control_duration * pls.get_fs("dac"))
             )  # number of samples in the control template
-            control_envelope = sin2(control_ns, drag=self.drag)
+            control_envelope = sin2_envelope(control_ns, self.drag)
             control_pulse = pls.setup_template(
                 output_port=self.control_port,
                 group=0,
@@ -205,12 +211,12 @@ class ExcitedSweep(Base):
 
         return self.save()
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "ExcitedSweep":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "ExcitedSweep":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq_center = h5f.attrs["readout_freq_center"]
             readout_freq_span = h5f.attrs["readout_freq_span"]
             readout_freq_nr = h5f.attrs["readout_freq_nr"]
@@ -234,7 +240,7 @@ class ExcitedSweep(Base):
             readout_freq_arr = h5f["readout_freq_arr"][()]
             readout_if_arr = h5f["readout_if_arr"][()]
             t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            store_arr = cls._load_array(h5f, "store_arr", lazy)
 
         self = cls(
             readout_freq_center=readout_freq_center,
@@ -263,7 +269,17 @@ class ExcitedSweep(Base):
 
         return self
 
-    def analyze(self, all_plots: bool = False):
+    def analyze(self, all_plots: bool = False, uncertainty: Optional[str] = None):
+        """Plot the data and fit the separation of |g> and |e> with a Gaussian.
+
+        Args:
+            all_plots: also plot the raw traces.
+            uncertainty: `None` for the standard errors of the fit, or a resampling method of
+                `_bootstrap.bootstrap`, e.g. `"residuals"` or `"jackknife"`, for errors that don't
+                assume a perfect model. The confidence interval is printed as well. Not
+                `"repetitions"`: the data are averaged over the repetitions.
+        """
+        check_averaged(uncertainty)
         assert self.t_arr is not None
         assert self.store_arr is not None
         assert self.readout_freq_arr is not None
@@ -273,7 +289,7 @@ class ExcitedSweep(Base):
         assert len(self.readout_if_arr) == self.readout_freq_nr
 
         import matplotlib.pyplot as plt
-        from scipy.optimize import curve_fit
+        from presto.utils import untwist_downconversion
 
         try:
             from resonator_tools import circuit
@@ -284,7 +300,7 @@ class ExcitedSweep(Base):
 
         ret_fig = []
 
-        idx = np.arange(IDX_LOW, IDX_HIGH)
+        idx = slice(IDX_LOW, IDX_HIGH)
         t_low = self.t_arr[IDX_LOW]
         t_high = self.t_arr[IDX_HIGH]
         nr_samples = IDX_HIGH - IDX_LOW
@@ -302,8 +318,7 @@ class ExcitedSweep(Base):
             ret_fig.append(fig1)
 
         # Analyze
-        data = self.store_arr[:, 0, idx]
-        data.shape = (self.readout_freq_nr, 2, nr_samples)
+        data = np.reshape(self.store_arr[:, 0, idx], (self.readout_freq_nr, 2, nr_samples))
         resp_I_arr = np.zeros((2, self.readout_freq_nr), np.complex128)
         resp_Q_arr = np.zeros((2, self.readout_freq_nr), np.complex128)
         dt = self.t_arr[1] - self.t_arr[0]
@@ -344,7 +359,11 @@ class ExcitedSweep(Base):
             np.max(separation),
             0.0,
         ]
-        popt, pcov = curve_fit(_gaussian, self.readout_freq_arr, separation, p0)
+        if uncertainty is None:
+            popt, _ = _fit_gaussian(self.readout_freq_arr, separation, p0)
+        else:
+            fit = partial(_fit_gaussian, p0=p0)
+            popt, _, ci = bootstrap(fit, _gaussian, self.readout_freq_arr, separation, uncertainty)
 
         print("----------------")
         if _has_resonator_tools:
@@ -367,6 +386,9 @@ class ExcitedSweep(Base):
             print(f"ω_r / 2π = {f_r * 1e-9:.6f} GHz")
             print(f"χ / 2π = {chi_hz * 1e-3:.2f} kHz")
         print(f"ω_opt / 2π = {f_o * 1e-9:.6f} GHz")
+        if uncertainty is not None:
+            f_low, f_high = 1e-9 * ci[:, 0]
+            print(f"ω_opt / 2π interval ({uncertainty}): {f_low:.6f} to {f_high:.6f} GHz")
         print("----------------")
 
         fig2, ax2 = plt.subplots(3, 1, sharex=True, tight_layout=True, figsize=(6.4, 6.4))
@@ -423,3 +445,11 @@ class ExcitedSweep(Base):
 
 def _gaussian(x, x0, s, a, o):
     return a * np.exp(-0.5 * ((x - x0) / s) ** 2) + o
+
+
+def _fit_gaussian(x, y, p0):
+    from scipy.optimize import curve_fit
+
+    popt, pcov = curve_fit(_gaussian, x, y, p0)
+    perr = np.sqrt(np.diag(pcov))
+    return popt, perr
@@ -2,23 +2,20 @@
 """
 2D sweep of DC bias and frequency of probe to find the modulation curve of the JPA.
 """
-from typing import List
+from typing import List, Optional
 
 import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import lockin
-from presto.utils import ProgressBar
-
-from _base import Base
+from _base import Base, PixelPipeline
+from _session import converter_configuration
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": DacMode.Mixed42,
-    "dac_fsample": DacFSample.G10,
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": "Mixed42",
+    "dac_fsample": "G10",
 }
 
 
@@ -36,6 +33,7 @@ class JpaSweepBias(Base):
         bias_port: int,
         dither: bool = True,
         num_skip: int = 0,
+        sem_target: Optional[float] = None,
     ) -> None:
         self.freq_center = freq_center
         self.freq_span = freq_span
@@ -48,9 +46,15 @@ class JpaSweepBias(Base):
         self.bias_port = bias_port
         self.dither = dither
         self.num_skip = num_skip
+        # if not None, average each point only until the standard error reaches sem_target
+        self.sem_target = sem_target
 
         self.freq_arr = None  # replaced by run
         self.resp_arr = None  # replaced by run
+        self.resp_sem_arr = None  # replaced by run
+        self.count_arr = None  # replaced by run
+
+        self._save_filename: str = ""  # replaced by run, or by resume
 
     def run(
         self,
@@ -58,11 +62,14 @@ class JpaSweepBias(Base):
         presto_port: int = None,
         ext_ref_clk: bool = False,
     ) -> str:
+        from presto import lockin
+        from presto.utils import ProgressBar
+
         with lockin.Lockin(
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
-            **CONVERTER_CONFIGURATION,
+            **converter_configuration(**CONVERTER_CONFIGURATION),
         ) as lck:
             assert lck.hardware is not None
 
@@ -79,8 +86,32 @@ class JpaSweepBias(Base):
             n_stop = int(round(f_stop / self.df))
             n_arr = np.arange(n_start, n_stop + 1)
             nr_freq = len(n_arr)
-            self.freq_arr = self.df * n_arr
-            self.resp_arr = np.zeros((nr_bias, nr_freq), np.complex128)
+            freq_arr = self.df * n_arr
+
+            # save each bias row as soon as it's done
+            if self._save_filename:
+                # resuming
+                assert np.allclose(freq_arr, self.freq_arr)
+                rows_done = self._load_rows_done()
+            else:
+                self.freq_arr = freq_arr
+                self.resp_arr = None
+                self.resp_sem_arr = None
+                self.count_arr = None
+                self._save_filename = self._save_rows_init(
+                    __file__,
+                    None,
+                    (nr_bias,),
+                    {
+                        "resp_arr": ((nr_bias, nr_freq), np.complex128),
+                        "resp_sem_arr": ((nr_bias, nr_freq), np.float64),
+                        "count_arr": ((nr_bias, nr_freq), np.int64),
+                    },
+                )
+                rows_done = np.zeros(nr_bias, bool)
+            resp_row = np.zeros(nr_freq, np.complex128)
+            sem_row = np.zeros(nr_freq, np.float64)
+            count_row = np.zeros(nr_freq, np.int64)
 
             lck.hardware.set_dc_bias(self.bias_arr[0], self.bias_port)
             lck.hardware.sleep(1.0, False)
@@ -103,40 +134,84 @@ class JpaSweepBias(Base):
 
             lck.apply_settings()
 
-            pb = ProgressBar(nr_bias * nr_freq)
-            pb.start()
-            for jj, bias in enumerate(self.bias_arr):
-                lck.hardware.set_dc_bias(bias, self.bias_port)
-                lck.hardware.sleep(1.0, False)
-
-                for ii, freq in enumerate(self.freq_arr):
-                    lck.hardware.configure_mixer(
-                        freq=freq,
-                        in_ports=self.input_port,
-                        out_ports=self.output_port,
+            # overlap reduction and saving with acquisition of the next points
+            with PixelPipeline(
+                lck,
+                lambda n: self._get_pixels(lck, n),
+                self.df,
+                self.num_averages,
+                self.num_skip,
+                self.sem_target,
+            ) as pipe:
+                pb = ProgressBar(np.sum(~rows_done) * nr_freq)
+                pb.start()
+                for jj, bias in enumerate(self.bias_arr):
+                    if rows_done[jj]:
+                        continue
+                    lck.hardware.set_dc_bias(bias, self.bias_port)
+                    lck.hardware.sleep(1.0, False)
+
+                    for ii, freq in enumerate(self.freq_arr):
+                        pipe.retune(
+                            freq=freq,
+                            in_ports=self.input_port,
+                            out_ports=self.output_port,
+                        )
+
+                        pipe.acquire(ii)
+
+                        pb.increment()
+
+                    for ii, (resp, sem, _, count) in pipe.collect():
+                        resp_row[ii], sem_row[ii], count_row[ii] = resp, sem, count
+                    # save in background while the next row is measured
+                    pipe.submit(
+                        self._save_row,
+                        jj,
+                        resp_arr=resp_row.copy(),
+                        resp_sem_arr=sem_row.copy(),
+                        count_arr=count_row.copy(),
                     )
-                    lck.hardware.sleep(1e-3, False)
-
-                    _d = lck.get_pixels(self.num_skip + self.num_averages, quiet=True)
-                    data_i = _d[self.input_port][1][:, 0]
-                    data_q = _d[self.input_port][2][:, 0]
-                    data = data_i.real + 1j * data_q.real  # using zero IF
-
-                    self.resp_arr[jj, ii] = np.mean(data[-self.num_averages :])
-
-                    pb.increment()
 
-            pb.done()
+                pb.done()
+            pipe.report()
 
             # Mute outputs at the end of the sweep
             og.set_amplitudes(0.0)
             lck.apply_settings()
             lck.hardware.set_dc_bias(0.0, self.bias_port)
 
-        return self.save()
+        save_filename = self._save_filename
+        self._save_filename = ""
+        with h5py.File(save_filename, "r") as h5f:
+            self.resp_arr = h5f["resp_arr"][()]
+            self.resp_sem_arr = h5f["resp_sem_arr"][()]
+            self.count_arr = h5f["count_arr"][()]
+        print(f"Data saved to: {save_filename}")
+        return save_filename
+
+    def _get_pixels(self, lck, n: int) -> np.ndarray:
+        # acquire n pixels, return shape (n,)
+        _d = lck.get_pixels(n, quiet=True)
+        data_i = _d[self.input_port][1][:, 0]
+        data_q = _d[self.input_port][2][:, 0]
+        return data_i.real + 1j * data_q.real  # using zero IF
+
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    @classmethod
+    def resume(
+        cls,
+        load_filename: str,
+        presto_address: str,
+        presto_port: int = None,
+        ext_ref_clk: bool = False,
+    ) -> str:
+        """Continue an interrupted `run`, measuring only the rows missing in `load_filename`."""
+        self = cls.load(load_filename)
+        self._save_filename = load_filename
+        return self.run(presto_address, presto_port, ext_ref_clk)
 
     @classmethod
     def load(cls, load_filename: str) -> "JpaSweepBias":
@@ -151,10 +226,14 @@ class JpaSweepBias(Base):
             bias_port = h5f.attrs["bias_port"]
             dither = h5f.attrs["dither"]
             num_skip = h5f.attrs["num_skip"]
+            sem_target = h5f.attrs.get("sem_target")  # None if not used
 
             bias_arr = h5f["bias_arr"][()]
             freq_arr = h5f["freq_arr"][()]
             resp_arr = h5f["resp_arr"][()]
+            # not saved by older versions
+            resp_sem_arr = h5f["resp_sem_arr"][()] if "resp_sem_arr" in h5f else None
+            count_arr = h5f["count_arr"][()] if "count_arr" in h5f else None
 
         self = cls(
             freq_center=freq_center,
@@ -168,9 +247,12 @@ class JpaSweepBias(Base):
             bias_port=bias_port,
             dither=dither,
             num_skip=num_skip,
+            sem_target=sem_target,
         )
         self.freq_arr = freq_arr
         self.resp_arr = resp_arr
+        self.resp_sem_arr = resp_sem_arr
+        self.count_arr = count_arr
 
         return self
 
@@ -2,24 +2,26 @@
 """
 3D sweep of pump power, DC bias and frequency of probe, to see where we get gain.
 """
-from typing import List, Optional
+import time
+from typing import List, Optional, Tuple
 
 import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import lockin
-from presto.utils import ProgressBar
-
-from _base import Base
+from _base import Base, average_pixels
+from _session import converter_configuration
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": DacMode.Mixed42,
-    "dac_fsample": DacFSample.G10,
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": "Mixed42",
+    "dac_fsample": "G10",
 }
+# settling time after changing each knob, used to choose the loop order
+PUMP_SETTLE = 0.1  # s, after set_lmx
+BIAS_SETTLE = 0.1  # s, after set_dc_bias
+MIXER_SETTLE = 1e-3  # s, after configure_mixer
 
 
 class JpaSweepPowerBias(Base):
@@ -39,6 +41,8 @@ class JpaSweepPowerBias(Base):
         pump_freq: float = None,
         dither: bool = True,
         num_skip: int = 0,
+        sem_target: Optional[float] = None,
+        ref_every_bias: bool = True,
     ) -> None:
         self.freq_center = freq_center
         self.freq_span = freq_span
@@ -54,12 +58,23 @@ class JpaSweepPowerBias(Base):
         self.pump_freq = 2 * self.freq_center if pump_freq is None else pump_freq
         self.dither = dither
         self.num_skip = num_skip
+        # if not None, average each point only until the standard error reaches sem_target
+        self.sem_target = sem_target
+        # the pump-off reference shifts with the bias if the JPA resonance is in the frequency
+        # span: if False, measure it once at the first bias and use it for all biases
+        self.ref_every_bias = ref_every_bias
 
         self.freq_arr = None  # replaced by run
         self.ref_resp_arr = None  # replaced by run
         self.ref_pwr_arr = None  # replaced by run
+        self.ref_sem_arr = None  # replaced by run
+        self.ref_count_arr = None  # replaced by run
         self.resp_arr = None  # replaced by run
         self.pwr_arr = None  # replaced by run
+        self.resp_sem_arr = None  # replaced by run
+        self.count_arr = None  # replaced by run
+
+        self._save_filename: str = ""  # replaced by run, or by resume
 
     def run(
         self,
@@ -67,11 +82,14 @@ class JpaSweepPowerBias(Base):
         presto_port: int = None,
         ext_ref_clk: bool = False,
     ) -> str:
+        from presto import lockin
+        from presto.utils import ProgressBar
+
         with lockin.Lockin(
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
-            **CONVERTER_CONFIGURATION,
+            **converter_configuration(**CONVERTER_CONFIGURATION),
         ) as lck:
             assert lck.hardware is not None
 
@@ -89,12 +107,44 @@ class JpaSweepPowerBias(Base):
             n_stop = int(round(f_stop / self.df))
             n_arr = np.arange(n_start, n_stop + 1)
             nr_freq = len(n_arr)
-            self.freq_arr = self.df * n_arr
-
-            self.ref_resp_arr = np.zeros((nr_bias, nr_freq), np.complex128)
-            self.ref_pwr_arr = np.zeros((nr_bias, nr_freq), np.float64)
-            self.resp_arr = np.zeros((nr_pump_pwr, nr_bias, nr_freq), np.complex128)
-            self.pwr_arr = np.zeros((nr_pump_pwr, nr_bias, nr_freq), np.float64)
+            freq_arr = self.df * n_arr
+
+            # save each bias row as soon as it's done
+            # row (0, jj) is the reference with pump off, row (kk, jj) has pump power kk - 1
+            if self._save_filename:
+                # resuming
+                assert np.allclose(freq_arr, self.freq_arr)
+                rows_done = self._load_rows_done()
+            else:
+                self.freq_arr = freq_arr
+                self.ref_resp_arr = None
+                self.ref_pwr_arr = None
+                self.ref_sem_arr = None
+                self.ref_count_arr = None
+                self.resp_arr = None
+                self.pwr_arr = None
+                self.resp_sem_arr = None
+                self.count_arr = None
+                self._save_filename = self._save_rows_init(
+                    __file__,
+                    None,
+                    (nr_pump_pwr + 1, nr_bias),
+                    {
+                        "ref_resp_arr": ((nr_bias, nr_freq), np.complex128),
+                        "ref_pwr_arr": ((nr_bias, nr_freq), np.float64),
+                        "ref_sem_arr": ((nr_bias, nr_freq), np.float64),
+                        "ref_count_arr": ((nr_bias, nr_freq), np.int64),
+                        "resp_arr": ((nr_pump_pwr, nr_bias, nr_freq), np.complex128),
+                        "pwr_arr": ((nr_pump_pwr, nr_bias, nr_freq), np.float64),
+                        "resp_sem_arr": ((nr_pump_pwr, nr_bias, nr_freq), np.float64),
+                        "count_arr": ((nr_pump_pwr, nr_bias, nr_freq), np.int64),
+                    },
+                )
+                rows_done = np.zeros((nr_pump_pwr + 1, nr_bias), bool)
+            resp_row = np.zeros(nr_freq, np.complex128)
+            pwr_row = np.zeros(nr_freq, np.float64)
+            sem_row = np.zeros(nr_freq, np.float64)
+            count_row = np.zeros(nr_freq, np.int64)
 
             lck.hardware.set_lmx(0.0, 0, self.pump_port)  # start with pump off for reference
             lck.hardware.set_dc_bias(self.bias_arr[0], self.bias_port)
@@ -117,56 +167,141 @@ class JpaSweepPowerBias(Base):
 
             lck.apply_settings()
 
-            pb = ProgressBar((nr_pump_pwr + 1) * nr_bias * nr_freq)
+            # frequency is always the inner loop (one saved row); order the (pump, bias) rows to
+            # minimize the time spent settling, and reverse the frequency sweep every other row
+            rows_skip = rows_done.copy()
+            if not self.ref_every_bias:
+                rows_skip[0, 1:] = True  # copied from row (0, 0)
+            rows, outer = _plan_rows(rows_skip, PUMP_SETTLE, BIAS_SETTLE)
+            pump_pwr_arr = np.r_[-1, self.pump_pwr_arr]  # -1: pump off for reference
+            changes = {"pump": 0, "bias": 0, "mixer": 0, "acquisition": 0}
+            actual = {"pump": 0.0, "bias": 0.0, "mixer": 0.0, "acquisition": 0.0}
+            current = (0, 0)  # pump off and first bias, set above
+            print(f"Sweeping with {outer} in the outer loop")
+
+            pb = ProgressBar(len(rows) * nr_freq)
             pb.start()
-            for kk, pump_pwr in enumerate(np.r_[-1, self.pump_pwr_arr]):
+            for nn, (kk, jj) in enumerate(rows):
+                t0 = time.perf_counter()
+                if kk != current[0]:
+                    if kk == 0:
+                        lck.hardware.set_lmx(0.0, 0, self.pump_port)
+                    else:
+                        lck.hardware.set_lmx(self.pump_freq, pump_pwr_arr[kk], self.pump_port)
+                    lck.hardware.sleep(PUMP_SETTLE, False)
+                    changes["pump"] += 1
+                t1 = time.perf_counter()
+                if jj != current[1]:
+                    lck.hardware.set_dc_bias(self.bias_arr[jj], self.bias_port)
+                    lck.hardware.sleep(BIAS_SETTLE, False)
+                    changes["bias"] += 1
+                t2 = time.perf_counter()
+                actual["pump"] += t1 - t0
+                actual["bias"] += t2 - t1
+                current = (kk, jj)
+
+                freq_idx = range(nr_freq) if nn % 2 == 0 else range(nr_freq - 1, -1, -1)
+                for ii in freq_idx:
+                    t0 = time.perf_counter()
+                    lck.hardware.configure_mixer(
+                        freq=self.freq_arr[ii],
+                        in_ports=self.input_port,
+                        out_ports=self.output_port,
+                    )
+                    lck.hardware.sleep(MIXER_SETTLE, False)
+                    t1 = time.perf_counter()
+
+                    resp_row[ii], sem_row[ii], pwr_row[ii], count_row[ii] = average_pixels(
+                        lambda n: self._get_pixels(lck, n),
+                        self.num_averages,
+                        self.num_skip,
+                        self.sem_target,
+                    )
+                    actual["mixer"] += t1 - t0
+                    actual["acquisition"] += time.perf_counter() - t1
+                    changes["mixer"] += 1
+                    changes["acquisition"] += 1
+
+                    pb.increment()
+
                 if kk == 0:
-                    lck.hardware.set_lmx(0.0, 0, self.pump_port)
-                else:
-                    lck.hardware.set_lmx(self.pump_freq, pump_pwr, self.pump_port)
-                lck.hardware.sleep(0.1, False)
-                for jj, bias in enumerate(self.bias_arr):
-                    lck.hardware.set_dc_bias(bias, self.bias_port)
-                    lck.hardware.sleep(0.1, False)
-
-                    for ii, freq in enumerate(self.freq_arr):
-                        lck.hardware.configure_mixer(
-                            freq=freq,
-                            in_ports=self.input_port,
-                            out_ports=self.output_port,
+                    for bb in [jj] if self.ref_every_bias else range(nr_bias):
+                        self._save_row(
+                            (kk, bb),
+                            bb,
+                            ref_resp_arr=resp_row,
+                            ref_pwr_arr=pwr_row,
+                            ref_sem_arr=sem_row,
+                            ref_count_arr=count_row,
                         )
-                        lck.hardware.sleep(1e-3, False)
-
-                        _d = lck.get_pixels(self.num_skip + self.num_averages, quiet=True)
-                        data_i = _d[self.input_port][1][:, 0]
-                        data_q = _d[self.input_port][2][:, 0]
-                        data = data_i.real + 1j * data_q.real  # using zero IF
-
-                        if kk == 0:
-                            self.ref_resp_arr[jj, ii] = np.mean(data[-self.num_averages :])
-                            self.ref_pwr_arr[jj, ii] = np.mean(
-                                np.abs(data[-self.num_averages :]) ** 2
-                            )
-                        else:
-                            self.resp_arr[kk - 1, jj, ii] = np.mean(data[-self.num_averages :])
-                            self.pwr_arr[kk - 1, jj, ii] = np.mean(
-                                np.abs(data[-self.num_averages :]) ** 2
-                            )
-
-                        pb.increment()
+                else:
+                    self._save_row(
+                        (kk, jj),
+                        (kk - 1, jj),
+                        resp_arr=resp_row,
+                        pwr_arr=pwr_row,
+                        resp_sem_arr=sem_row,
+                        count_arr=count_row,
+                    )
 
             pb.done()
 
+            t_pixels = (self.num_skip + self.num_averages) / self.df  # at most, with sem_target
+            estimate = {
+                "pump": changes["pump"] * PUMP_SETTLE,
+                "bias": changes["bias"] * BIAS_SETTLE,
+                "mixer": changes["mixer"] * MIXER_SETTLE,
+                "acquisition": changes["acquisition"] * t_pixels,
+            }
+            print(f"{'':>12s} {'changes':>8s} {'estimated':>10s} {'actual':>10s}")
+            for knob in actual:
+                print(
+                    f"{knob:>12s} {changes[knob]:8d} "
+                    f"{estimate[knob]:9.1f}s {actual[knob]:9.1f}s"
+                )
+
             # Mute outputs at the end of the sweep
             og.set_amplitudes(0.0)
             lck.apply_settings()
             lck.hardware.set_dc_bias(0.0, self.bias_port)
             lck.hardware.set_lmx(0.0, 0, self.pump_port)
 
-        return self.save()
+        save_filename = self._save_filename
+        self._save_filename = ""
+        with h5py.File(save_filename, "r") as h5f:
+            self.ref_resp_arr = h5f["ref_resp_arr"][()]
+            self.ref_pwr_arr = h5f["ref_pwr_arr"][()]
+            self.ref_sem_arr = h5f["ref_sem_arr"][()]
+            self.ref_count_arr = h5f["ref_count_arr"][()]
+            self.resp_arr = h5f["resp_arr"][()]
+            self.pwr_arr = h5f["pwr_arr"][()]
+            self.resp_sem_arr = h5f["resp_sem_arr"][()]
+            self.count_arr = h5f["count_arr"][()]
+        print(f"Data saved to: {save_filename}")
+        return save_filename
+
+    def _get_pixels(self, lck, n: int) -> np.ndarray:
+        # acquire n pixels, return shape (n,)
+        _d = lck.get_pixels(n, quiet=True)
+        data_i = _d[self.input_port][1][:, 0]
+        data_q = _d[self.input_port][2][:, 0]
+        return data_i.real + 1j * data_q.real  # using zero IF
+
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    @classmethod
+    def resume(
+        cls,
+        load_filename: str,
+        presto_address: str,
+        presto_port: int = None,
+        ext_ref_clk: bool = False,
+    ) -> str:
+        """Continue an interrupted `run`, measuring only the rows missing in `load_filename`."""
+        self = cls.load(load_filename)
+        self._save_filename = load_filename
+        return self.run(presto_address, presto_port, ext_ref_clk)
 
     @classmethod
     def load(cls, load_filename: str) -> "JpaSweepPowerBias":
@@ -183,6 +318,8 @@ class JpaSweepPowerBias(Base):
             pump_freq = h5f.attrs["pump_freq"]
             dither = h5f.attrs["dither"]
             num_skip = h5f.attrs["num_skip"]
+            sem_target = h5f.attrs.get("sem_target")  # None if not used
+            ref_every_bias = h5f.attrs.get("ref_every_bias", True)  # not saved by older versions
 
             bias_arr = h5f["bias_arr"][()]
             pump_pwr_arr = h5f["pump_pwr_arr"][()]
@@ -191,6 +328,11 @@ class JpaSweepPowerBias(Base):
             ref_pwr_arr = h5f["ref_pwr_arr"][()]
             resp_arr = h5f["resp_arr"][()]
             pwr_arr = h5f["pwr_arr"][()]
+            # not saved by older versions
+            ref_sem_arr = h5f["ref_sem_arr"][()] if "ref_sem_arr" in h5f else None
+            ref_count_arr = h5f["ref_count_arr"][()] if "ref_count_arr" in h5f else None
+            resp_sem_arr = h5f["resp_sem_arr"][()] if "resp_sem_arr" in h5f else None
+            count_arr = h5f["count_arr"][()] if "count_arr" in h5f else None
 
         self = cls(
             freq_center=freq_center,
@@ -207,12 +349,18 @@ class JpaSweepPowerBias(Base):
             pump_freq=pump_freq,
             dither=dither,
             num_skip=num_skip,
+            sem_target=sem_target,
+            ref_every_bias=ref_every_bias,
         )
         self.freq_arr = freq_arr
         self.ref_resp_arr = ref_resp_arr
         self.ref_pwr_arr = ref_pwr_arr
+        self.ref_sem_arr = ref_sem_arr
+        self.ref_count_arr = ref_count_arr
         self.resp_arr = resp_arr
         self.pwr_arr = pwr_arr
+        self.resp_sem_arr = resp_sem_arr
+        self.count_arr = count_arr
 
         return self
 
@@ -311,3 +459,40 @@ class JpaSweepPowerBias(Base):
                 ret_fig.append(fig)
 
         return ret_fig
+
+
+def _plan_rows(rows_done: np.ndarray, pump_settle: float, bias_settle: float) -> Tuple[list, str]:
+    """Choose the order of the (pump, bias) rows still to measure.
+
+    Both loop orders are tried in serpentine fashion, i.e. the inner of the two loops is reversed
+    at every step of the outer one so that the setting that is not stepped doesn't change either.
+    The order with the least total settling time is kept.
+
+    Returns:
+        list of `(kk, jj)` indices into `rows_done`, and "pump" or "bias" for the outer loop
+    """
+    nr_pump, nr_bias = rows_done.shape
+    best = None
+    for outer in ["pump", "bias"]:
+        rows = []
+        reverse = False
+        if outer == "pump":
+            grid = [[(kk, jj) for jj in range(nr_bias)] for kk in range(nr_pump)]
+        else:
+            grid = [[(kk, jj) for kk in range(nr_pump)] for jj in range(nr_bias)]
+        for line in grid:
+            line = [row for row in line if not rows_done[row]]
+            if line:
+                rows.extend(line[::-1] if reverse else line)
+                reverse = not reverse
+
+        # start from pump off and first bias, as set before the loop
+        cost = 0.0
+        previous = (0, 0)
+        for row in rows:
+            cost += pump_settle * (row[0] != previous[0]) + bias_settle * (row[1] != previous[1])
+            previous = row
+        if best is None or cost < best[0]:
+            best = (cost, rows, outer)
+
+    return best[1], best[2]
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Run the same pulsed experiment on several qubits at once.
+
+Each qubit is driven on its own control port, and the readout resonators are read out at the same
+time with frequency-multiplexed pulses on the common readout port. The stored traces are
+demultiplexed on the host, so that each experiment gets its own data and can be saved and analyzed
+as if it was run alone.
+
+Example:
+    q1 = T1(readout_freq=6.166_6e9, control_freq=3.557_9e9, control_port=3, ...)
+    q2 = T1(readout_freq=6.028_4e9, control_freq=4.091_8e9, control_port=4, ...)
+    Parallel([q1, q2]).run(presto_address)
+    q1.analyze()
+    q2.analyze()
+"""
+from typing import List, Optional, Union
+
+import numpy as np
+
+from _session import Session, connect
+from _templates import phase_q, sin2_envelope
+from rabi_amp import RabiAmp
+from ramsey_single import RamseySingle
+from t1 import T1
+
+DAC_CURRENT = 32_000  # uA
+CONVERTER_CONFIGURATION = {
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
+}
+MAX_QUBITS = 2  # one readout pulse per carrier group on the readout port
+
+# must be the same for all the experiments
+SHARED_ATTRIBUTES = [
+    "readout_port",
+    "sample_port",
+    "readout_duration",
+    "control_duration",
+    "sample_duration",
+    "readout_sample_delay",
+    "num_averages",
+    "jpa_params",
+]
+
+
+class Parallel:
+    """Run experiments of the same kind on different qubits in a single program.
+
+    Supported experiments are `T1`, `RamseySingle` and `RabiAmp`, without `integrate` or `reset`.
+    All the experiments must share the readout and sample ports, the durations, the number of
+    averages and the JPA parameters, and sweep the same delays (or the same number of amplitudes).
+    Each experiment keeps its own readout and control frequencies and amplitudes, and its own
+    control port. The readout pulses add up on the readout port, so the sum of the readout
+    amplitudes must be at most 1. The longest `wait_delay` is used for all.
+
+    Args:
+        experiments: one experiment per qubit, at most `MAX_QUBITS`.
+    """
+
+    def __init__(self, experiments: List[Union[T1, RamseySingle, RabiAmp]]) -> None:
+        self.experiments = list(experiments)
+        _check(self.experiments)
+
+    def run(
+        self,
+        presto_address: str,
+        presto_port: int = None,
+        ext_ref_clk: bool = False,
+        save: bool = True,
+        session: Optional[Session] = None,
+    ) -> List[str]:
+        """Measure all the qubits, then save each experiment to its own file.
+
+        Returns:
+            the save filenames, in the order of the experiments; empty strings if not `save`
+        """
+        from presto import pulsed
+
+        exps = self.experiments
+        first = exps[0]
+        readout_freqs = [exp.readout_freq for exp in exps]
+        readout_nco = 0.5 * (min(readout_freqs) + max(readout_freqs))
+        control_ports = [exp.control_port for exp in exps]
+
+        # Instantiate interface class
+        with connect(
+            session,
+            pulsed.Pulsed,
+            address=presto_address,
+            port=presto_port,
+            ext_ref_clk=ext_ref_clk,
+            **CONVERTER_CONFIGURATION,
+        ) as pls:
+            assert pls.hardware is not None
+
+            pls.hardware.set_adc_attenuation(first.sample_port, 0.0)
+            pls.hardware.set_dac_current(first.readout_port, DAC_CURRENT)
+            pls.hardware.set_inv_sinc(first.readout_port, 0)
+            for port in control_ports:
+                pls.hardware.set_dac_current(port, DAC_CURRENT)
+                pls.hardware.set_inv_sinc(port, 0)
+            pls.hardware.configure_mixer(
+                freq=readout_nco,
+                in_ports=first.sample_port,
+                out_ports=first.readout_port,
+                sync=False,  # sync in last call
+            )
+            for ii, exp in enumerate(exps):
+                pls.hardware.configure_mixer(
+                    freq=exp.control_freq,
+                    out_ports=exp.control_port,
+                    sync=ii == len(exps) - 1,  # sync here
+                )
+            if first.jpa_params is not None:
+                pls.hardware.set_lmx(
+                    first.jpa_params["pump_freq"],
+                    first.jpa_params["pump_pwr"],
+                    first.jpa_params["pump_port"],
+                )
+                pls.hardware.set_dc_bias(first.jpa_params["bias"], first.jpa_params["bias_port"])
+                pls.hardware.sleep(1.0, False)
+
+            # ************************************
+            # *** Setup measurement parameters ***
+            # ************************************
+
+            # one carrier group per resonator on the readout port
+            readout_pulses = []
+            for group, exp in enumerate(exps):
+                readout_if = exp.readout_freq - readout_nco
+                pls.setup_freq_lut(
+                    output_ports=exp.readout_port,
+                    group=group,
+                    frequencies=abs(readout_if),
+                    phases=0.0,
+                    phases_q=phase_q(readout_if),
+                )
+                pls.setup_scale_lut(
+                    output_ports=exp.readout_port,
+                    group=group,
+                    scales=exp.readout_amp,
+                )
+                readout_pulses.append(
+                    pls.setup_long_drive(
+                        output_port=exp.readout_port,
+                        group=group,
+                        duration=exp.readout_duration,
+                        amplitude=1.0,
+                        amplitude_q=1.0,
+                        rise_time=0e-9,
+                        fall_time=0e-9,
+                    )
+                )
+
+            # each qubit on its own control port, at zero IF
+            control_pulses = []
+            for exp in exps:
+                pls.setup_freq_lut(
+                    output_ports=exp.control_port,
+                    group=0,
+                    frequencies=0.0,
+                    phases=0.0,
+                    phases_q=0.0,
+                )
+                pls.setup_scale_lut(
+                    output_ports=exp.control_port,
+                    group=0,
+                    scales=exp.control_amp_arr if isinstance(exp, RabiAmp) else exp.control_amp,
+                )
+                control_ns = int(
+                    round(exp.control_duration * pls.get_fs("dac"))
+                )  # number of samples in the control template
+                control_envelope = sin2_envelope(control_ns, exp.drag)
+                control_pulses.append(
+                    pls.setup_template(
+                        output_port=exp.control_port,
+                        group=0,
+                        template=control_envelope,
+                        template_q=control_envelope if exp.drag == 0.0 else None,
+                        envelope=True,
+                    )
+                )
+
+            # Setup sampling window
+            pls.set_store_ports(first.sample_port)
+            pls.set_store_duration(first.sample_duration)
+
+            # ******************************
+            # *** Program pulse sequence ***
+            # ******************************
+            wait_delay = max(exp.wait_delay for exp in exps)
+
+            def readout(T):
+                pls.reset_phase(T, first.readout_port)
+                for pulse in readout_pulses:
+                    pls.output_pulse(T, pulse)
+                pls.store(T + first.readout_sample_delay)
+                return T + first.readout_duration
+
+            T = 0.0  # s, start at time zero ...
+            if isinstance(first, RabiAmp):
+                pls.reset_phase(T, control_ports)
+                for _ in range(first.num_pulses):
+                    for pulse in control_pulses:
+                        pls.output_pulse(T, pulse)
+                    T += first.control_duration
+                T = readout(T)
+                # Move to next Rabi amplitude, on all qubits
+                pls.next_scale(T, control_ports)
+                T += wait_delay
+                repeat_count = len(first.control_amp_arr)
+            else:
+                for delay in first.delay_arr:
+                    # pi pulse (T1) or first pi/2 pulse (Ramsey)
+                    pls.reset_phase(T, control_ports)
+                    for pulse in control_pulses:
+                        pls.output_pulse(T, pulse)
+                    T += first.control_duration
+                    T += delay
+                    if isinstance(first, RamseySingle):
+                        # second pi/2 pulse
+                        for pulse in control_pulses:
+                            pls.output_pulse(T, pulse)
+                        T += first.control_duration
+                    T = readout(T)
+                    # Wait for decay
+                    T += wait_delay
+                repeat_count = 1
+
+            if first.jpa_params is not None:
+                # adjust period to minimize effect of JPA idler
+                idler_freq = first.jpa_params["pump_freq"] - readout_nco
+                idler_if = abs(idler_freq - readout_nco)  # NCO at readout_nco
+                idler_period = 1 / idler_if
+                T_clk = int(round(T * pls.get_clk_f()))
+                idler_period_clk = int(round(idler_period * pls.get_clk_f()))
+                # first make T a multiple of idler period
+                if T_clk % idler_period_clk > 0:
+                    T_clk += idler_period_clk - (T_clk % idler_period_clk)
+                # then make it off by one clock cycle
+                T_clk += 1
+                T = T_clk * pls.get_clk_T()
+
+            # **************************
+            # *** Run the experiment ***
+            # **************************
+            pls.run(
+                period=T,
+                repeat_count=repeat_count,
+                num_averages=first.num_averages,
+                print_time=True,
+            )
+            t_arr, store_arr = pls.get_store_data()
+
+            if first.jpa_params is not None and session is None:
+                pls.hardware.set_lmx(0.0, 0.0, first.jpa_params["pump_port"])
+                pls.hardware.set_dc_bias(0.0, first.jpa_params["bias_port"])
+
+        # demultiplex: move each resonator to zero IF, the analysis averages out the others
+        for exp in exps:
+            readout_if = exp.readout_freq - readout_nco
+            exp.t_arr = t_arr
+            exp.store_arr = store_arr * np.exp(-2j * np.pi * readout_if * t_arr)
+
+        if save:
+            return [exp.save() for exp in exps]
+        else:
+            return ["" for _ in exps]
+
+
+def _check(experiments: list) -> None:
+    if not 0 < len(experiments) <= MAX_QUBITS:
+        raise ValueError(f"expected 1 to {MAX_QUBITS} experiments, got {len(experiments)}")
+    first = experiments[0]
+    if not isinstance(first, (T1, RamseySingle, RabiAmp)):
+        raise TypeError(f"unsupported experiment {type(first).__name__}")
+    control_ports = set()
+    for exp in experiments:
+        if type(exp) is not type(first):
+            raise TypeError("all experiments must be of the same kind")
+        if exp.integrate or exp.reset is not None:
+            raise ValueError("integrate and reset are not supported in parallel")
+        for attribute in SHARED_ATTRIBUTES:
+            if getattr(exp, attribute) != getattr(first, attribute):
+                raise ValueError(f"{attribute} must be the same for all experiments")
+        if isinstance(first, RabiAmp):
+            if len(exp.control_amp_arr) != len(first.control_amp_arr):
+                raise ValueError("control_amp_arr must have the same length for all experiments")
+            if exp.num_pulses != first.num_pulses:
+                raise ValueError("num_pulses must be the same for all experiments")
+        elif not np.array_equal(exp.delay_arr, first.delay_arr):
+            raise ValueError("delay_arr must be the same for all experiments")
+        if exp.control_port in control_ports:
+            raise ValueError("each experiment must have its own control port")
+        control_ports.add(exp.control_port)
+    readout_amp = sum(abs(exp.readout_amp) for exp in experiments)
+    if readout_amp > 1.0:
+        raise ValueError(
+            f"the readout pulses add up on the readout port, the sum of readout_amp must be at "
+            f"most 1, got {readout_amp}"
+        )
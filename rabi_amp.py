@@ -6,23 +6,23 @@ The control pulse has a sin^2 envelope, while the readout pulse is square.
 """
 import ast
 import math
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
-import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.utils import format_precision, rotate_opt, sin2
-
-from _base import Base
+from _base import Base, get_integration_data, setup_integration
+from _bootstrap import bootstrap, check_averaged
+from _reset import ActiveReset
+from _rotate import rotate_opt
+from _session import Session, connect
+from _templates import sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -47,6 +47,9 @@ class RabiAmp(Base):
         num_pulses: int = 1,
         jpa_params: dict = None,
         drag: float = 0.0,
+        integrate: bool = False,
+        nr_raw_traces: int = 0,
+        reset: Optional[ActiveReset] = None,
     ) -> None:
         self.readout_freq = readout_freq
         self.control_freq = control_freq
@@ -63,9 +66,18 @@ class RabiAmp(Base):
         self.num_averages = num_averages
         self.num_pulses = num_pulses
         self.drag = drag
+        # integrate the readout on the instrument, transferring one complex number per shot
+        self.integrate = integrate
+        # with integrate, store anyway the full traces of the first nr_raw_traces readouts in
+        # the sequence
+        self.nr_raw_traces = nr_raw_traces
+        # if not None, reset the qubit actively at the end of each shot instead of waiting for
+        # wait_delay
+        self.reset = reset
 
         self.t_arr = None  # replaced by run
         self.store_arr = None  # replaced by run
+        self.integrated_arr = None  # replaced by run, if integrate
 
         self.jpa_params = jpa_params
 
@@ -74,9 +86,14 @@ class RabiAmp(Base):
         presto_address: str,
         presto_port: int = None,
         ext_ref_clk: bool = False,
+        session: Optional[Session] = None,
     ) -> str:
+        from presto import pulsed
+
         # Instantiate interface class
-        with pulsed.Pulsed(
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -159,7 +176,7 @@ class RabiAmp(Base):
             control_ns = int(
                 round(self.control_duration * pls.get_fs("dac"))
             )  # number of samples in the control template
-            control_envelope = sin2(control_ns, drag=self.drag)
+            control_envelope = sin2_envelope(control_ns, self.drag)
             control_pulse = pls.setup_template(
                 output_port=self.control_port,
                 group=0,
@@ -169,8 +186,25 @@ class RabiAmp(Base):
             )
 
             # Setup sampling window
-            pls.set_store_ports(self.sample_port)
-            pls.set_store_duration(self.sample_duration)
+            nr_stored = 1  # readouts in the sequence
+            if self.integrate:
+                matches, match_delay = setup_integration(
+                    pls, self.sample_port, IDX_LOW, IDX_HIGH
+                )
+                nr_stored = min(self.nr_raw_traces, nr_stored)
+            if nr_stored > 0:
+                pls.set_store_ports(self.sample_port)
+                pls.set_store_duration(self.sample_duration)
+            if self.reset is not None:
+                self.reset.setup(
+                    pls,
+                    self.sample_port,
+                    self.control_port,
+                    self.control_freq,
+                    readout_pulse,
+                    self.readout_duration,
+                    control_envelope,
+                )
 
             # ******************************
             # *** Program pulse sequence ***
@@ -184,12 +218,18 @@ class RabiAmp(Base):
             # Readout
             pls.reset_phase(T, self.readout_port)
             pls.output_pulse(T, readout_pulse)
-            pls.store(T + self.readout_sample_delay)
+            if nr_stored > 0:
+                pls.store(T + self.readout_sample_delay)
+            if self.integrate:
+                pls.match(T + self.readout_sample_delay + match_delay, matches)
             T += self.readout_duration
             # Move to next Rabi amplitude
             pls.next_scale(T, self.control_port)  # every iteration will have a different amplitude
             # Wait for decay
-            T += self.wait_delay
+            if self.reset is None:
+                T += self.wait_delay
+            else:
+                T = self.reset.program(pls, T)
 
             if self.jpa_params is not None:
                 # adjust period to minimize effect of JPA idler
@@ -218,20 +258,27 @@ class RabiAmp(Base):
                 num_averages=self.num_averages,
                 print_time=True,
             )
-            self.t_arr, self.store_arr = pls.get_store_data()
+            if nr_stored > 0:
+                self.t_arr, self.store_arr = pls.get_store_data()
+            if self.reset is not None:
+                self.reset.get_data(pls, nr_amps)
+            if self.integrate:
+                self.integrated_arr = get_integration_data(
+                    pls, matches, nr_amps, IDX_HIGH - IDX_LOW
+                )
 
-            if self.jpa_params is not None:
+            if self.jpa_params is not None and session is None:
                 pls.hardware.set_lmx(0.0, 0.0, self.jpa_params["pump_port"])
                 pls.hardware.set_dc_bias(0.0, self.jpa_params["bias_port"])
 
         return self.save()
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "RabiAmp":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "RabiAmp":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq = h5f.attrs["readout_freq"]
             control_freq = h5f.attrs["control_freq"]
             readout_amp = h5f.attrs["readout_amp"]
@@ -249,8 +296,14 @@ class RabiAmp(Base):
 
             jpa_params = ast.literal_eval(h5f.attrs["jpa_params"])
 
-            t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            # not saved when integrating on the instrument without raw traces
+            t_arr = h5f["t_arr"][()] if "t_arr" in h5f else None
+            store_arr = cls._load_array(h5f, "store_arr", lazy) if "store_arr" in h5f else None
+            integrated_arr = h5f["integrated_arr"][()] if "integrated_arr" in h5f else None
+            # not saved by older versions
+            integrate = h5f.attrs.get("integrate", False)
+            nr_raw_traces = h5f.attrs.get("nr_raw_traces", 0)
+            reset = ActiveReset.load(h5f)
 
             try:
                 drag = h5f.attrs["drag"]
@@ -274,27 +327,59 @@ class RabiAmp(Base):
             num_pulses=num_pulses,
             jpa_params=jpa_params,
             drag=drag,
+            integrate=integrate,
+            nr_raw_traces=nr_raw_traces,
+            reset=reset,
         )
         self.t_arr = t_arr
         self.store_arr = store_arr
+        self.integrated_arr = integrated_arr
+        self._filename = load_filename  # where the analysis is cached
 
         return self
 
-    def analyze(self, all_plots: bool = False):
-        if self.t_arr is None:
+    def analyze_batch(self, recompute: bool = False):
+        """Fit the Rabi oscillations without plotting, e.g. for many files.
+
+        Args:
+            recompute: analyze the raw data even if the results are cached in the data file, see
+                `_cache`.
+
+        Returns:
+            `(data, (popt, perr))`, the fitted parameters of `_func`. The period of one pulse is
+            `popt[3] * num_pulses`.
+        """
+        if self.store_arr is None and self.integrated_arr is None:
             raise RuntimeError
-        if self.store_arr is None:
+        results = self._fit(None, recompute)
+        return results["data"], (results["popt"], results["perr"])
+
+    def analyze(
+        self, all_plots: bool = False, uncertainty: Optional[str] = None, recompute: bool = False
+    ):
+        """Plot the data and fit the Rabi oscillations.
+
+        Args:
+            all_plots: also plot the raw traces and all the quadratures.
+            uncertainty: `None` for the standard errors of the fit, or a resampling method of
+                `_bootstrap.bootstrap`, e.g. `"residuals"` or `"jackknife"`, for errors that don't
+                assume a perfect model. The confidence interval is printed as well. Not
+                `"repetitions"`: the data are averaged over the repetitions.
+            recompute: analyze the raw data even if the results are cached in the data file, see
+                `_cache`.
+        """
+        check_averaged(uncertainty)
+        if self.store_arr is None and self.integrated_arr is None:
             raise RuntimeError
 
         import matplotlib.pyplot as plt
+        from presto.utils import format_precision
 
         ret_fig = []
 
-        idx = np.arange(IDX_LOW, IDX_HIGH)
-        t_low = self.t_arr[IDX_LOW]
-        t_high = self.t_arr[IDX_HIGH]
-
-        if all_plots:
+        if all_plots and self.store_arr is not None:
+            t_low = self.t_arr[IDX_LOW]
+            t_high = self.t_arr[IDX_HIGH]
             # Plot raw store data for first iteration as a check
             fig1, ax1 = plt.subplots(2, 1, sharex=True, tight_layout=True)
             ax11, ax12 = ax1
@@ -306,12 +391,9 @@ class RabiAmp(Base):
             fig1.show()
             ret_fig.append(fig1)
 
-        # Analyze Rabi
-        resp_arr = np.mean(self.store_arr[:, 0, idx], axis=-1)
-        data = rotate_opt(resp_arr)
-
-        # Fit data
-        popt_x, perr_x = _fit_period(self.control_amp_arr, np.real(data))
+        results = self._fit(uncertainty, recompute)
+        data = results["data"]
+        popt_x, perr_x, ci_x = results["popt"], results["perr"], results["ci"]
         period = popt_x[3] * self.num_pulses
         period_err = perr_x[3] * self.num_pulses
         pi_amp = period / 2
@@ -322,6 +404,9 @@ class RabiAmp(Base):
         print(f"Tau pulse amplitude: {format_precision(period, period_err)} FS")
         print(f"Pi pulse amplitude: {format_precision(pi_amp, period_err / 2)} FS")
         print(f"Pi/2 pulse amplitude: {format_precision(pi_2_amp, period_err / 4)} FS")
+        if uncertainty is not None:
+            pi_low, pi_high = ci_x[:, 3] * self.num_pulses / 2
+            print(f"Pi pulse interval ({uncertainty}): {pi_low:.5f} to {pi_high:.5f} FS")
 
         print(f"control_amp_180 = {pi_amp:.5f}")
         print(f"control_amp_90 = {pi_2_amp:.5f}")
@@ -368,6 +453,28 @@ class RabiAmp(Base):
 
         return ret_fig
 
+    def _fit(self, uncertainty: Optional[str], recompute: bool) -> dict:
+        # rotate and fit, shared by analyze and analyze_batch
+        def _analyze():
+            resp_arr = self._readout_resp(IDX_LOW, IDX_HIGH)
+            data, angle = rotate_opt(resp_arr, return_x=True)
+
+            # Fit data
+            if uncertainty is None:
+                popt_x, perr_x = _fit_period(self.control_amp_arr, np.real(data))
+                ci_x = None
+            else:
+                popt_x, perr_x, ci_x = bootstrap(
+                    _fit_period, _func, self.control_amp_arr, np.real(data), uncertainty
+                )
+            return {"data": data, "angle": angle, "popt": popt_x, "perr": perr_x, "ci": ci_x}
+
+        inputs = self._readout_inputs(IDX_LOW, IDX_HIGH)
+        inputs["control_amp_arr"] = self.control_amp_arr
+        params = {"idx_low": IDX_LOW, "idx_high": IDX_HIGH, "model": "period"}
+        params["uncertainty"] = uncertainty
+        return self._cached("analyze", inputs, params, _analyze, recompute)
+
 
 def _func(t, offset, amplitude, T2, period, phase):
     frequency = 1 / period
@@ -1,23 +1,23 @@
 # -*- coding: utf-8 -*-
 """Measure a Ramsey chevron pattern by changing the delay between two π/2 pulses and their frequency."""
 import ast
-from typing import List
+from typing import List, Optional
 
-import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.utils import rotate_opt, sin2
-
-from _base import Base
+from _base import Base, get_integration_data, setup_integration
+from _fit import fit_damped_cosine
+from _reset import ActiveReset
+from _rotate import rotate_opt
+from _session import Session, connect
+from _templates import sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -44,6 +44,9 @@ class RamseyChevron(Base):
         num_averages: int,
         jpa_params: dict = None,
         drag: float = 0.0,
+        integrate: bool = False,
+        nr_raw_traces: int = 0,
+        reset: Optional[ActiveReset] = None,
     ) -> None:
         self.readout_freq = readout_freq
         self.control_freq_center = control_freq_center
@@ -63,19 +66,33 @@ class RamseyChevron(Base):
         self.num_averages = num_averages
         self.jpa_params = jpa_params
         self.drag = drag
+        # integrate the readout on the instrument, transferring one complex number per shot
+        self.integrate = integrate
+        # with integrate, store anyway the full traces of the first nr_raw_traces readouts in
+        # the sequence
+        self.nr_raw_traces = nr_raw_traces
+        # if not None, reset the qubit actively at the end of each shot instead of waiting for
+        # wait_delay
+        self.reset = reset
 
         self.control_freq_arr = None  # replaced by run
         self.t_arr = None  # replaced by run
         self.store_arr = None  # replaced by run
+        self.integrated_arr = None  # replaced by run, if integrate
 
     def run(
         self,
         presto_address: str,
         presto_port: int = None,
         ext_ref_clk: bool = False,
+        session: Optional[Session] = None,
     ) -> str:
+        from presto import pulsed
+
         # Instantiate interface class
-        with pulsed.Pulsed(
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -166,7 +183,7 @@ class RamseyChevron(Base):
             )
             # number of samples in the control template
             control_ns = int(round(self.control_duration * pls.get_fs("dac")))
-            control_envelope = self.control_amp * sin2(control_ns, drag=self.drag)
+            control_envelope = self.control_amp * sin2_envelope(control_ns, self.drag)
 
             # we loose 3 dB by using a nonzero IF
             # so multiply the envelope by sqrt(2)
@@ -186,14 +203,31 @@ class RamseyChevron(Base):
             )
 
             # Setup sampling window
-            pls.set_store_ports(self.sample_port)
-            pls.set_store_duration(self.sample_duration)
+            nr_stored = len(self.delay_arr)  # readouts in the sequence
+            if self.integrate:
+                matches, match_delay = setup_integration(
+                    pls, self.sample_port, IDX_LOW, IDX_HIGH
+                )
+                nr_stored = min(self.nr_raw_traces, nr_stored)
+            if nr_stored > 0:
+                pls.set_store_ports(self.sample_port)
+                pls.set_store_duration(self.sample_duration)
+            if self.reset is not None:
+                self.reset.setup(
+                    pls,
+                    self.sample_port,
+                    self.control_port,
+                    control_nco,
+                    readout_pulse,
+                    self.readout_duration,
+                    control_envelope,
+                )
 
             # ******************************
             # *** Program pulse sequence ***
             # ******************************
             T = 0.0  # s, start at time zero ...
-            for delay in self.delay_arr:
+            for ii, delay in enumerate(self.delay_arr):
                 # first pi/2 pulse
                 pls.reset_phase(T, self.control_port)
                 pls.output_pulse(T, control_pulse)
@@ -206,12 +240,18 @@ class RamseyChevron(Base):
                 # Readout
                 pls.reset_phase(T, self.readout_port)
                 pls.output_pulse(T, readout_pulse)
-                pls.store(T + self.readout_sample_delay)
+                if ii < nr_stored:
+                    pls.store(T + self.readout_sample_delay)
+                if self.integrate:
+                    pls.match(T + self.readout_sample_delay + match_delay, matches)
                 T += self.readout_duration
                 # Move to next iteration
-                T += self.wait_delay
+                if self.reset is None:
+                    T += self.wait_delay
+                else:
+                    T = self.reset.program(pls, T)
             pls.next_frequency(T, self.control_port)
-            T += self.wait_delay
+            T += self.wait_delay if self.reset is None else self.reset.final_delay
 
             if self.jpa_params is not None:
                 # adjust period to minimize effect of JPA idler
@@ -236,20 +276,27 @@ class RamseyChevron(Base):
                 num_averages=self.num_averages,
                 print_time=True,
             )
-            self.t_arr, self.store_arr = pls.get_store_data()
+            if nr_stored > 0:
+                self.t_arr, self.store_arr = pls.get_store_data()
+            if self.reset is not None:
+                self.reset.get_data(pls, self.control_freq_nr * len(self.delay_arr))
+            if self.integrate:
+                self.integrated_arr = get_integration_data(
+                    pls, matches, self.control_freq_nr * len(self.delay_arr), IDX_HIGH - IDX_LOW
+                )
 
-            if self.jpa_params is not None:
+            if self.jpa_params is not None and session is None:
                 pls.hardware.set_lmx(0.0, 0.0, self.jpa_params["pump_port"])
                 pls.hardware.set_dc_bias(0.0, self.jpa_params["bias_port"])
 
         return self.save()
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "RamseyChevron":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "RamseyChevron":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq = h5f.attrs["readout_freq"]
             control_freq_center = h5f.attrs["control_freq_center"]
             control_freq_span = h5f.attrs["control_freq_span"]
@@ -270,8 +317,14 @@ class RamseyChevron(Base):
             jpa_params = ast.literal_eval(h5f.attrs["jpa_params"])
 
             control_freq_arr = h5f["control_freq_arr"][()]
-            t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            # not saved when integrating on the instrument without raw traces
+            t_arr = h5f["t_arr"][()] if "t_arr" in h5f else None
+            store_arr = cls._load_array(h5f, "store_arr", lazy) if "store_arr" in h5f else None
+            integrated_arr = h5f["integrated_arr"][()] if "integrated_arr" in h5f else None
+            # not saved by older versions
+            integrate = h5f.attrs.get("integrate", False)
+            nr_raw_traces = h5f.attrs.get("nr_raw_traces", 0)
+            reset = ActiveReset.load(h5f)
 
             try:
                 drag = h5f.attrs["drag"]
@@ -297,16 +350,19 @@ class RamseyChevron(Base):
             num_averages=num_averages,
             jpa_params=jpa_params,
             drag=drag,
+            integrate=integrate,
+            nr_raw_traces=nr_raw_traces,
+            reset=reset,
         )
         self.control_freq_arr = control_freq_arr
         self.t_arr = t_arr
         self.store_arr = store_arr
+        self.integrated_arr = integrated_arr
 
         return self
 
     def analyze(self, all_plots: bool = False):
-        assert self.t_arr is not None
-        assert self.store_arr is not None
+        assert self.store_arr is not None or self.integrated_arr is not None
         assert self.control_freq_arr is not None
         assert len(self.control_freq_arr) == self.control_freq_nr
 
@@ -314,11 +370,9 @@ class RamseyChevron(Base):
 
         ret_fig = []
 
-        idx = np.arange(IDX_LOW, IDX_HIGH)
-        t_low = self.t_arr[IDX_LOW]
-        t_high = self.t_arr[IDX_HIGH]
-
-        if all_plots:
+        if all_plots and self.store_arr is not None:
+            t_low = self.t_arr[IDX_LOW]
+            t_high = self.t_arr[IDX_HIGH]
             # Plot raw store data for first iteration as a check
             fig1, ax1 = plt.subplots(2, 1, sharex=True, tight_layout=True)
             ax11, ax12 = ax1
@@ -331,7 +385,7 @@ class RamseyChevron(Base):
             ret_fig.append(fig1)
 
         # Analyze T1
-        resp_arr = np.mean(self.store_arr[:, 0, idx], axis=-1)
+        resp_arr = self._readout_resp(IDX_LOW, IDX_HIGH)
         resp_arr.shape = (self.control_freq_nr, len(self.delay_arr))
         data = rotate_opt(resp_arr)
         plot_data = data.real
@@ -380,13 +434,9 @@ class RamseyChevron(Base):
         fig2.show()
         ret_fig.append(fig2)
 
-        fit_freq = np.zeros_like(self.control_freq_arr)
-        for jj in range(self.control_freq_nr):
-            try:
-                res, _err = _fit_simple(self.delay_arr, plot_data[jj])
-                fit_freq[jj] = np.abs(res[3])
-            except Exception:
-                fit_freq[jj] = np.nan
+        # fit all the rows at once, NaN where the fit fails
+        popt, _ = fit_damped_cosine(self.delay_arr, plot_data)
+        fit_freq = popt[:, 3]
 
         n_fit = self.control_freq_nr // 4
         pfit1 = np.polyfit(self.control_freq_arr[:n_fit], fit_freq[:n_fit], 1)
@@ -423,33 +473,3 @@ class RamseyChevron(Base):
 
 def _func(t, offset, amplitude, T2, frequency, phase):
     return offset + amplitude * np.exp(-t / T2) * np.cos(2.0 * np.pi * frequency * t + phase)
-
-
-def _fit_simple(x, y):
-    from scipy.optimize import curve_fit
-
-    pkpk = np.max(y) - np.min(y)
-    offset = np.min(y) + pkpk / 2
-    amplitude = 0.5 * pkpk
-    T2 = 0.5 * (np.max(x) - np.min(x))
-    freqs = np.fft.rfftfreq(len(x), x[1] - x[0])
-    fft = np.fft.rfft(y)
-    fft[0] = 0
-    idx_max = np.argmax(np.abs(fft))
-    frequency = freqs[idx_max]
-    phase = np.angle(fft[idx_max])
-    p0 = (
-        offset,
-        amplitude,
-        T2,
-        frequency,
-        phase,
-    )
-    popt, pcov = curve_fit(
-        _func,
-        x,
-        y,
-        p0=p0,
-    )
-    perr = np.sqrt(np.diag(pcov))
-    return popt, perr
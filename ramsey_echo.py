@@ -3,21 +3,22 @@
 import ast
 from typing import List, Optional
 
-import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.utils import format_precision, rotate_opt, sin2
-
-from _base import Base, project
+from _base import Base, get_integration_data, project, setup_integration
+from _bootstrap import bootstrap, check_averaged
+from _fit import fit_decay
+from _reset import ActiveReset
+from _rotate import rotate_opt
+from _session import Session, connect
+from _templates import Templates, sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -43,6 +44,9 @@ class RamseyEcho(Base):
         num_averages: int,
         jpa_params: Optional[dict] = None,
         drag: float = 0.0,
+        integrate: bool = False,
+        nr_raw_traces: int = 0,
+        reset: Optional[ActiveReset] = None,
     ) -> None:
         self.readout_freq = readout_freq
         self.control_freq = control_freq
@@ -61,9 +65,18 @@ class RamseyEcho(Base):
         self.num_averages = num_averages
         self.jpa_params = jpa_params
         self.drag = drag
+        # integrate the readout on the instrument, transferring one complex number per shot
+        self.integrate = integrate
+        # with integrate, store anyway the full traces of the first nr_raw_traces readouts in
+        # the sequence
+        self.nr_raw_traces = nr_raw_traces
+        # if not None, reset the qubit actively at the end of each shot instead of waiting for
+        # wait_delay
+        self.reset = reset
 
         self.t_arr = None  # replaced by run
         self.store_arr = None  # replaced by run
+        self.integrated_arr = None  # replaced by run, if integrate
 
     def run(
         self,
@@ -71,9 +84,14 @@ class RamseyEcho(Base):
         presto_port: int = None,
         ext_ref_clk: bool = False,
         save: bool = True,
+        session: Optional[Session] = None,
     ) -> str:
+        from presto import pulsed
+
         # Instantiate interface class
-        with pulsed.Pulsed(
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -156,15 +174,16 @@ class RamseyEcho(Base):
             control_ns = int(
                 round(self.control_duration * pls.get_fs("dac"))
             )  # number of samples in the control template
-            control_envelope = sin2(control_ns, drag=self.drag)
-            control_pulse_90 = pls.setup_template(
+            control_envelope = sin2_envelope(control_ns, self.drag)
+            templates = Templates(pls)  # one template if the amplitudes are the same
+            control_pulse_90 = templates.setup(
                 output_port=self.control_port,
                 group=0,
                 template=self.control_amp_90 * control_envelope,
                 template_q=self.control_amp_90 * control_envelope if self.drag == 0.0 else None,
                 envelope=True,
             )
-            control_pulse_180 = pls.setup_template(
+            control_pulse_180 = templates.setup(
                 output_port=self.control_port,
                 group=0,
                 template=self.control_amp_180 * control_envelope,
@@ -173,14 +192,31 @@ class RamseyEcho(Base):
             )
 
             # Setup sampling window
-            pls.set_store_ports(self.sample_port)
-            pls.set_store_duration(self.sample_duration)
+            nr_stored = len(self.delay_arr)  # readouts in the sequence
+            if self.integrate:
+                matches, match_delay = setup_integration(
+                    pls, self.sample_port, IDX_LOW, IDX_HIGH
+                )
+                nr_stored = min(self.nr_raw_traces, nr_stored)
+            if nr_stored > 0:
+                pls.set_store_ports(self.sample_port)
+                pls.set_store_duration(self.sample_duration)
+            if self.reset is not None:
+                self.reset.setup(
+                    pls,
+                    self.sample_port,
+                    self.control_port,
+                    self.control_freq,
+                    readout_pulse,
+                    self.readout_duration,
+                    control_envelope,
+                )
 
             # ******************************
             # *** Program pulse sequence ***
             # ******************************
             T = 0.0  # s, start at time zero ...
-            for delay in self.delay_arr:
+            for ii, delay in enumerate(self.delay_arr):
                 # first pi/2 pulse
                 pls.reset_phase(T, self.control_port)
                 pls.output_pulse(T, control_pulse_90)
@@ -198,10 +234,16 @@ class RamseyEcho(Base):
                 # Readout
                 pls.reset_phase(T, self.readout_port)
                 pls.output_pulse(T, readout_pulse)
-                pls.store(T + self.readout_sample_delay)
+                if ii < nr_stored:
+                    pls.store(T + self.readout_sample_delay)
+                if self.integrate:
+                    pls.match(T + self.readout_sample_delay + match_delay, matches)
                 T += self.readout_duration
                 # Wait for decay
-                T += self.wait_delay
+                if self.reset is None:
+                    T += self.wait_delay
+                else:
+                    T = self.reset.program(pls, T)
 
             if self.jpa_params is not None:
                 # adjust period to minimize effect of JPA idler
@@ -226,9 +268,16 @@ class RamseyEcho(Base):
                 num_averages=self.num_averages,
                 print_time=True,
             )
-            self.t_arr, self.store_arr = pls.get_store_data()
+            if nr_stored > 0:
+                self.t_arr, self.store_arr = pls.get_store_data()
+            if self.reset is not None:
+                self.reset.get_data(pls, len(self.delay_arr))
+            if self.integrate:
+                self.integrated_arr = get_integration_data(
+                    pls, matches, len(self.delay_arr), IDX_HIGH - IDX_LOW
+                )
 
-            if self.jpa_params is not None:
+            if self.jpa_params is not None and session is None:
                 pls.hardware.set_lmx(0.0, 0.0, self.jpa_params["pump_port"])
                 pls.hardware.set_dc_bias(0.0, self.jpa_params["bias_port"])
 
@@ -237,12 +286,12 @@ class RamseyEcho(Base):
         else:
             return ""
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "RamseyEcho":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "RamseyEcho":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq = h5f.attrs["readout_freq"]
             control_freq = h5f.attrs["control_freq"]
             readout_amp = h5f.attrs["readout_amp"]
@@ -262,8 +311,14 @@ class RamseyEcho(Base):
 
             jpa_params = ast.literal_eval(h5f.attrs["jpa_params"])
 
-            t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            # not saved when integrating on the instrument without raw traces
+            t_arr = h5f["t_arr"][()] if "t_arr" in h5f else None
+            store_arr = cls._load_array(h5f, "store_arr", lazy) if "store_arr" in h5f else None
+            integrated_arr = h5f["integrated_arr"][()] if "integrated_arr" in h5f else None
+            # not saved by older versions
+            integrate = h5f.attrs.get("integrate", False)
+            nr_raw_traces = h5f.attrs.get("nr_raw_traces", 0)
+            reset = ActiveReset.load(h5f)
 
         self = cls(
             readout_freq=readout_freq,
@@ -283,45 +338,86 @@ class RamseyEcho(Base):
             num_averages=num_averages,
             jpa_params=jpa_params,
             drag=drag,
+            integrate=integrate,
+            nr_raw_traces=nr_raw_traces,
+            reset=reset,
         )
         self.t_arr = t_arr
         self.store_arr = store_arr
+        self.integrated_arr = integrated_arr
+        self._filename = load_filename  # where the analysis is cached
 
         return self
 
-    def analyze_batch(self, reference_templates: Optional[tuple] = None):
-        assert self.t_arr is not None
-        assert self.store_arr is not None
+    def analyze_batch(
+        self, reference_templates: Optional[tuple] = None, recompute: bool = False
+    ):
+        """Fit the decay without plotting, e.g. for many files.
+
+        Args:
+            reference_templates: if not `None`, `(ref_g, ref_e)` to project the full traces on,
+                instead of rotating the response integrated over the window.
+            recompute: analyze the raw data even if the results are cached in the data file, see
+                `_cache`.
 
+        Returns:
+            `(data, (popt, perr))`, with `popt` and `perr` `None` if the fit failed.
+        """
         if reference_templates is None:
-            idx = np.arange(IDX_LOW, IDX_HIGH)
-            resp_arr = np.mean(self.store_arr[:, 0, idx], axis=-1)
-            data = np.real(rotate_opt(resp_arr))
+            assert self.store_arr is not None or self.integrated_arr is not None
+            inputs = self._readout_inputs(IDX_LOW, IDX_HIGH)
+            params = {"idx_low": IDX_LOW, "idx_high": IDX_HIGH}
         else:
-            resp_arr = self.store_arr[:, 0, :]
-            data = project(resp_arr, reference_templates)
-
-        try:
-            popt, perr = _fit_simple(self.delay_arr, data)
-        except Exception as err:
-            print(f"unable to fit T2: {err}")
-            popt, perr = None, None
-
-        return data, (popt, perr)
-
-    def analyze(self, all_plots: bool = False):
-        assert self.t_arr is not None
-        assert self.store_arr is not None
+            if self.integrated_arr is not None:
+                raise ValueError("reference templates need the full traces, run without integrate")
+            assert self.store_arr is not None
+            inputs = {"store_arr": self.store_arr[:, 0, :]}
+            params = {"ref_g": reference_templates[0], "ref_e": reference_templates[1]}
+        inputs["delay_arr"] = self.delay_arr
+        params["model"] = "decay"
+
+        def _analyze():
+            if reference_templates is None:
+                resp_arr = self._readout_resp(IDX_LOW, IDX_HIGH)
+                data = rotate_opt(resp_arr, real=True)
+            else:
+                data = project(inputs["store_arr"], reference_templates)
+
+            try:
+                popt, perr = _fit_simple(self.delay_arr, data)
+            except Exception as err:
+                print(f"unable to fit T2: {err}")
+                popt, perr = None, None
+            return {"data": data, "popt": popt, "perr": perr}
+
+        results = self._cached("analyze_batch", inputs, params, _analyze, recompute)
+        return results["data"], (results["popt"], results["perr"])
+
+    def analyze(
+        self, all_plots: bool = False, uncertainty: Optional[str] = None, recompute: bool = False
+    ):
+        """Plot the data and fit the echo decay.
+
+        Args:
+            all_plots: also plot the raw traces and all the quadratures.
+            uncertainty: `None` for the standard errors of the fit, or a resampling method of
+                `_bootstrap.bootstrap`, e.g. `"residuals"` or `"jackknife"`, for errors that don't
+                assume a perfect model. The confidence interval is printed as well. Not
+                `"repetitions"`: the data are averaged over the repetitions.
+            recompute: analyze the raw data even if the results are cached in the data file, see
+                `_cache`.
+        """
+        check_averaged(uncertainty)
+        assert self.store_arr is not None or self.integrated_arr is not None
 
         import matplotlib.pyplot as plt
+        from presto.utils import format_precision
 
         ret_fig = []
 
-        idx = np.arange(IDX_LOW, IDX_HIGH)
-        t_low = self.t_arr[IDX_LOW]
-        t_high = self.t_arr[IDX_HIGH]
-
-        if all_plots:
+        if all_plots and self.store_arr is not None:
+            t_low = self.t_arr[IDX_LOW]
+            t_high = self.t_arr[IDX_HIGH]
             # Plot raw store data for first iteration as a check
             fig1, ax1 = plt.subplots(2, 1, sharex=True, tight_layout=True)
             ax11, ax12 = ax1
@@ -334,21 +430,40 @@ class RamseyEcho(Base):
             ret_fig.append(fig1)
 
         # Analyze T2
-        resp_arr = np.mean(self.store_arr[:, 0, idx], axis=-1)
-        data = rotate_opt(resp_arr)
-
-        # Fit data to I quadrature
-        try:
-            popt, perr = _fit_simple(self.delay_arr, np.real(data))
-
+        def _analyze():
+            resp_arr = self._readout_resp(IDX_LOW, IDX_HIGH)
+            data, angle = rotate_opt(resp_arr, return_x=True)
+
+            # Fit data to I quadrature
+            popt, perr, ci = None, None, None
+            try:
+                if uncertainty is None:
+                    popt, perr = _fit_simple(self.delay_arr, np.real(data))
+                else:
+                    popt, perr, ci = bootstrap(
+                        _fit_simple, _decay, self.delay_arr, np.real(data), uncertainty
+                    )
+            except Exception:
+                pass
+            return {"data": data, "angle": angle, "popt": popt, "perr": perr, "ci": ci}
+
+        inputs = self._readout_inputs(IDX_LOW, IDX_HIGH)
+        inputs["delay_arr"] = self.delay_arr
+        params = {"idx_low": IDX_LOW, "idx_high": IDX_HIGH, "model": "decay"}
+        params["uncertainty"] = uncertainty
+        results = self._cached("analyze", inputs, params, _analyze, recompute)
+        data = results["data"]
+        popt, perr, ci = results["popt"], results["perr"], results["ci"]
+
+        success = popt is not None
+        if success:
             T2 = popt[0]
             T2_err = perr[0]
             print(f"T2_echo time: {1e6*T2} ± {1e6*T2_err} μs")
-
-            success = True
-        except Exception:
+            if uncertainty is not None:
+                print(f"T2_echo interval ({uncertainty}): {1e6*ci[0, 0]} to {1e6*ci[1, 0]} μs")
+        else:
             print("Unable to fit data!")
-            success = False
 
         if all_plots:
             fig2, ax2 = plt.subplots(4, 1, sharex=True, figsize=(6.4, 6.4), tight_layout=True)
@@ -400,11 +515,7 @@ def _decay(t, *p):
 
 
 def _fit_simple(t, x):
-    from scipy.optimize import curve_fit
-
-    T = 0.5 * (t[-1] - t[0])
-    xe, xg = x[0], x[-1]
-    p0 = (T, xe, xg)
-    popt, pcov = curve_fit(_decay, t, x, p0)
-    perr = np.sqrt(np.diag(pcov))
+    popt, perr = fit_decay(t, x)
+    if np.any(np.isnan(popt)):
+        raise RuntimeError("fit did not converge")
     return popt, perr
@@ -6,23 +6,25 @@ pulse is square.
 
 """
 import ast
-from typing import List
+from typing import List, Optional
 
-import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.utils import rotate_opt, sin2
-
-from _base import Base
+from _adaptive import run_adaptive
+from _base import Base, get_integration_data, setup_integration
+from _bootstrap import bootstrap, check_averaged
+from _fit import fit_damped_cosine
+from _reset import ActiveReset
+from _rotate import rotate_opt
+from _session import Session, connect
+from _templates import sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -47,6 +49,9 @@ class RamseySingle(Base):
         num_averages: int,
         jpa_params: dict = None,
         drag: float = 0.0,
+        integrate: bool = False,
+        nr_raw_traces: int = 0,
+        reset: Optional[ActiveReset] = None,
     ) -> None:
         self.readout_freq = readout_freq
         self.control_freq = control_freq
@@ -64,18 +69,37 @@ class RamseySingle(Base):
         self.num_averages = num_averages
         self.jpa_params = jpa_params
         self.drag = drag
+        # integrate the readout on the instrument, transferring one complex number per shot
+        self.integrate = integrate
+        # with integrate, store anyway the full traces of the first nr_raw_traces readouts in
+        # the sequence
+        self.nr_raw_traces = nr_raw_traces
+        # if not None, reset the qubit actively at the end of each shot instead of waiting for
+        # wait_delay
+        self.reset = reset
 
         self.t_arr = None  # replaced by run
         self.store_arr = None  # replaced by run
+        self.integrated_arr = None  # replaced by run, if integrate
+        self.count_arr = None  # replaced by run_adaptive
+        self.delay_hist_arr = None  # replaced by run_adaptive
+        self.popt_hist_arr = None  # replaced by run_adaptive
+        self.perr_hist_arr = None  # replaced by run_adaptive
 
     def run(
         self,
         presto_address: str,
         presto_port: int = None,
         ext_ref_clk: bool = False,
+        save: bool = True,
+        session: Optional[Session] = None,
     ) -> str:
+        from presto import pulsed
+
         # Instantiate interface class
-        with pulsed.Pulsed(
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -157,7 +181,7 @@ class RamseySingle(Base):
             control_ns = int(
                 round(self.control_duration * pls.get_fs("dac"))
             )  # number of samples in the control template
-            control_envelope = sin2(control_ns, drag=self.drag)
+            control_envelope = sin2_envelope(control_ns, self.drag)
             control_pulse = pls.setup_template(
                 output_port=self.control_port,
                 group=0,
@@ -167,14 +191,31 @@ class RamseySingle(Base):
             )
 
             # Setup sampling window
-            pls.set_store_ports(self.sample_port)
-            pls.set_store_duration(self.sample_duration)
+            nr_stored = len(self.delay_arr)  # readouts in the sequence
+            if self.integrate:
+                matches, match_delay = setup_integration(
+                    pls, self.sample_port, IDX_LOW, IDX_HIGH
+                )
+                nr_stored = min(self.nr_raw_traces, nr_stored)
+            if nr_stored > 0:
+                pls.set_store_ports(self.sample_port)
+                pls.set_store_duration(self.sample_duration)
+            if self.reset is not None:
+                self.reset.setup(
+                    pls,
+                    self.sample_port,
+                    self.control_port,
+                    self.control_freq,
+                    readout_pulse,
+                    self.readout_duration,
+                    control_envelope,
+                )
 
             # ******************************
             # *** Program pulse sequence ***
             # ******************************
             T = 0.0  # s, start at time zero ...
-            for delay in self.delay_arr:
+            for ii, delay in enumerate(self.delay_arr):
                 # first pi/2 pulse
                 pls.reset_phase(T, self.control_port)
                 pls.output_pulse(T, control_pulse)
@@ -187,10 +228,16 @@ class RamseySingle(Base):
                 # Readout
                 pls.reset_phase(T, self.readout_port)
                 pls.output_pulse(T, readout_pulse)
-                pls.store(T + self.readout_sample_delay)
+                if ii < nr_stored:
+                    pls.store(T + self.readout_sample_delay)
+                if self.integrate:
+                    pls.match(T + self.readout_sample_delay + match_delay, matches)
                 T += self.readout_duration
                 # Move to next iteration, waiting for decay
-                T += self.wait_delay
+                if self.reset is None:
+                    T += self.wait_delay
+                else:
+                    T = self.reset.program(pls, T)
 
             if self.jpa_params is not None:
                 # adjust period to minimize effect of JPA idler
@@ -215,20 +262,110 @@ class RamseySingle(Base):
                 num_averages=self.num_averages,
                 print_time=True,
             )
-            self.t_arr, self.store_arr = pls.get_store_data()
+            if nr_stored > 0:
+                self.t_arr, self.store_arr = pls.get_store_data()
+            if self.reset is not None:
+                self.reset.get_data(pls, len(self.delay_arr))
+            if self.integrate:
+                self.integrated_arr = get_integration_data(
+                    pls, matches, len(self.delay_arr), IDX_HIGH - IDX_LOW
+                )
 
-            if self.jpa_params is not None:
+            if self.jpa_params is not None and session is None:
                 pls.hardware.set_lmx(0.0, 0.0, self.jpa_params["pump_port"])
                 pls.hardware.set_dc_bias(0.0, self.jpa_params["bias_port"])
 
-        return self.save()
+        if save:
+            return self.save()
+        else:
+            return ""
+
+    def run_adaptive(
+        self,
+        presto_address: str,
+        presto_port: int = None,
+        ext_ref_clk: bool = False,
+        rel_target: float = 0.05,
+        nr_delays: int = 10,
+        batch_averages: int = 100,
+        max_batches: int = 100,
+        save: bool = True,
+        session: Optional[Session] = None,
+    ) -> str:
+        """Measure choosing the delays adaptively, until the relative error on T2* is below target.
+
+        `delay_arr` is the grid of candidate delays, and `num_averages` is not used. Each batch
+        measures `nr_delays` delays with `batch_averages` averages, chosen to maximize the expected
+        information on the fit parameters, see `_adaptive.run_adaptive`.
+
+        After the run, `delay_arr` holds the delays that were measured, `integrated_arr` the
+        response averaged over all the batches and `count_arr` the number of averages at each
+        delay. The history is in `delay_hist_arr` (delays measured in each batch),
+        `popt_hist_arr` and `perr_hist_arr` (estimate of
+        `(offset, amplitude, T2, frequency, phase)` after each batch).
+        """
+        if session is None:
+            # keep the connection and the hardware settings between the batches
+            with Session() as session:
+                return self.run_adaptive(
+                    presto_address,
+                    presto_port,
+                    ext_ref_clk,
+                    rel_target,
+                    nr_delays,
+                    batch_averages,
+                    max_batches,
+                    save,
+                    session,
+                )
+
+        candidates = self.delay_arr
+        num_averages = self.num_averages
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+        def measure(delay_arr):
+            self.delay_arr = delay_arr
+            self.num_averages = batch_averages
+            self.integrated_arr = None
+            self.run(presto_address, presto_port, ext_ref_clk, save=False, session=session)
+            return self._readout_resp(IDX_LOW, IDX_HIGH)
+
+        try:
+            result = run_adaptive(
+                candidates,
+                measure,
+                _func,
+                _fit_simple,
+                2,
+                rel_target,
+                nr_delays,
+                batch_averages,
+                max_batches,
+            )
+        finally:
+            self.delay_arr = candidates
+            self.num_averages = num_averages
+        (
+            self.delay_arr,
+            self.integrated_arr,
+            self.count_arr,
+            self.delay_hist_arr,
+            self.popt_hist_arr,
+            self.perr_hist_arr,
+        ) = result
+        self.t_arr = None
+        self.store_arr = None
+
+        if save:
+            return self.save()
+        else:
+            return ""
+
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "RamseySingle":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "RamseySingle":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq = h5f.attrs["readout_freq"]
             control_freq = h5f.attrs["control_freq"]
             readout_amp = h5f.attrs["readout_amp"]
@@ -246,8 +383,19 @@ class RamseySingle(Base):
 
             jpa_params = ast.literal_eval(h5f.attrs["jpa_params"])
 
-            t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            # not saved when integrating on the instrument without raw traces
+            t_arr = h5f["t_arr"][()] if "t_arr" in h5f else None
+            store_arr = cls._load_array(h5f, "store_arr", lazy) if "store_arr" in h5f else None
+            integrated_arr = h5f["integrated_arr"][()] if "integrated_arr" in h5f else None
+            # only saved by run_adaptive
+            count_arr = h5f["count_arr"][()] if "count_arr" in h5f else None
+            delay_hist_arr = h5f["delay_hist_arr"][()] if "delay_hist_arr" in h5f else None
+            popt_hist_arr = h5f["popt_hist_arr"][()] if "popt_hist_arr" in h5f else None
+            perr_hist_arr = h5f["perr_hist_arr"][()] if "perr_hist_arr" in h5f else None
+            # not saved by older versions
+            integrate = h5f.attrs.get("integrate", False)
+            nr_raw_traces = h5f.attrs.get("nr_raw_traces", 0)
+            reset = ActiveReset.load(h5f)
 
             try:
                 drag = h5f.attrs["drag"]
@@ -271,27 +419,61 @@ class RamseySingle(Base):
             num_averages=num_averages,
             jpa_params=jpa_params,
             drag=drag,
+            integrate=integrate,
+            nr_raw_traces=nr_raw_traces,
+            reset=reset,
         )
         self.t_arr = t_arr
         self.store_arr = store_arr
+        self.integrated_arr = integrated_arr
+        self.count_arr = count_arr
+        self.delay_hist_arr = delay_hist_arr
+        self.popt_hist_arr = popt_hist_arr
+        self.perr_hist_arr = perr_hist_arr
+        self._filename = load_filename  # where the analysis is cached
 
         return self
 
-    def analyze(self, all_plots: bool = False):
-        if self.t_arr is None:
+    def analyze_batch(self, recompute: bool = False):
+        """Fit the Ramsey fringes without plotting, e.g. for many files.
+
+        Args:
+            recompute: analyze the raw data even if the results are cached in the data file, see
+                `_cache`.
+
+        Returns:
+            `(data, (popt, perr))`, with `popt` and `perr` `None` if the fit failed.
+        """
+        if self.store_arr is None and self.integrated_arr is None:
             raise RuntimeError
-        if self.store_arr is None:
+        results = self._fit(None, recompute)
+        return results["data"], (results["popt"], results["perr"])
+
+    def analyze(
+        self, all_plots: bool = False, uncertainty: Optional[str] = None, recompute: bool = False
+    ):
+        """Plot the data and fit the Ramsey fringes.
+
+        Args:
+            all_plots: also plot the raw traces and all the quadratures.
+            uncertainty: `None` for the standard errors of the fit, or a resampling method of
+                `_bootstrap.bootstrap`, e.g. `"residuals"` or `"jackknife"`, for errors that don't
+                assume a perfect model. The confidence interval is printed as well. Not
+                `"repetitions"`: the data are averaged over the repetitions.
+            recompute: analyze the raw data even if the results are cached in the data file, see
+                `_cache`.
+        """
+        check_averaged(uncertainty)
+        if self.store_arr is None and self.integrated_arr is None:
             raise RuntimeError
 
         import matplotlib.pyplot as plt
 
         ret_fig = []
 
-        idx = np.arange(IDX_LOW, IDX_HIGH)
-        t_low = self.t_arr[IDX_LOW]
-        t_high = self.t_arr[IDX_HIGH]
-
-        if all_plots:
+        if all_plots and self.store_arr is not None:
+            t_low = self.t_arr[IDX_LOW]
+            t_high = self.t_arr[IDX_HIGH]
             # Plot raw store data for first iteration as a check
             fig1, ax1 = plt.subplots(2, 1, sharex=True, tight_layout=True)
             ax11, ax12 = ax1
@@ -303,26 +485,23 @@ class RamseySingle(Base):
             fig1.show()
             ret_fig.append(fig1)
 
-        # Analyze T2
-        resp_arr = np.mean(self.store_arr[:, 0, idx], axis=-1)
-        data = rotate_opt(resp_arr)
-
-        # Fit data to I quadrature
-        try:
-            popt, perr = _fit_simple(self.delay_arr, np.real(data))
+        results = self._fit(uncertainty, recompute)
+        data = results["data"]
+        popt, perr, ci = results["popt"], results["perr"], results["ci"]
 
+        success = popt is not None
+        if success:
             T2 = popt[2]
             T2_err = perr[2]
             print("T2 time: {} +- {} us".format(1e6 * T2, 1e6 * T2_err))
             det = popt[3]
             det_err = perr[3]
             print("detuning: {} +- {} Hz".format(det, det_err))
-
-            success = True
-        except Exception as err:
+            if uncertainty is not None:
+                print(f"T2 interval ({uncertainty}): {1e6 * ci[0, 2]} to {1e6 * ci[1, 2]} us")
+                print(f"detuning interval ({uncertainty}): {ci[0, 3]} to {ci[1, 3]} Hz")
+        else:
             print("Unable to fit data!")
-            print(err)
-            success = False
 
         if all_plots:
             fig2, ax2 = plt.subplots(4, 1, sharex=True, figsize=(6.4, 6.4), tight_layout=True)
@@ -367,36 +546,38 @@ class RamseySingle(Base):
 
         return ret_fig
 
+    def _fit(self, uncertainty: Optional[str], recompute: bool) -> dict:
+        # rotate and fit, shared by analyze and analyze_batch
+        def _analyze():
+            resp_arr = self._readout_resp(IDX_LOW, IDX_HIGH)
+            data, angle = rotate_opt(resp_arr, return_x=True)
+
+            # Fit data to I quadrature
+            popt, perr, ci = None, None, None
+            try:
+                if uncertainty is None:
+                    popt, perr = _fit_simple(self.delay_arr, np.real(data))
+                else:
+                    popt, perr, ci = bootstrap(
+                        _fit_simple, _func, self.delay_arr, np.real(data), uncertainty
+                    )
+            except Exception as err:
+                print(err)
+            return {"data": data, "angle": angle, "popt": popt, "perr": perr, "ci": ci}
+
+        inputs = self._readout_inputs(IDX_LOW, IDX_HIGH)
+        inputs["delay_arr"] = self.delay_arr
+        params = {"idx_low": IDX_LOW, "idx_high": IDX_HIGH, "model": "damped_cosine"}
+        params["uncertainty"] = uncertainty
+        return self._cached("analyze", inputs, params, _analyze, recompute)
+
 
 def _func(t, offset, amplitude, T2, frequency, phase):
     return offset + amplitude * np.exp(-t / T2) * np.cos(2.0 * np.pi * frequency * t + phase)
 
 
 def _fit_simple(x, y):
-    from scipy.optimize import curve_fit
-
-    pkpk = np.max(y) - np.min(y)
-    offset = np.min(y) + pkpk / 2
-    amplitude = 0.5 * pkpk
-    T2 = 0.5 * (np.max(x) - np.min(x))
-    freqs = np.fft.rfftfreq(len(x), x[1] - x[0])
-    fft = np.fft.rfft(y)
-    fft[0] = 0
-    idx_max = np.argmax(np.abs(fft))
-    frequency = freqs[idx_max]
-    phase = np.angle(fft[idx_max])
-    p0 = (
-        offset,
-        amplitude,
-        T2,
-        frequency,
-        phase,
-    )
-    popt, pcov = curve_fit(
-        _func,
-        x,
-        y,
-        p0=p0,
-    )
-    perr = np.sqrt(np.diag(pcov))
+    popt, perr = fit_damped_cosine(x, y)
+    if np.any(np.isnan(popt)):
+        raise RuntimeError("fit did not converge")
     return popt, perr
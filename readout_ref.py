@@ -4,24 +4,29 @@
 Acquire reference templates for template matching.
 """
 import ast
-from typing import Optional
+from typing import Optional, Union
 
-import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.pulsed import MAX_TEMPLATE_LEN
-from presto.utils import sin2, to_pm_pi
-
 from _base import Base
+from _match import (
+    assignment_error,
+    distance_window,
+    estimate_noise_var,
+    matched_templates,
+    search_windows,
+    separation,
+)
+from _rotate import rotation_angle
+from _session import Session, connect
+from _templates import sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -73,9 +78,14 @@ class ReadoutRef(Base):
         presto_address: str,
         presto_port: int = None,
         ext_ref_clk: bool = False,
+        session: Optional[Session] = None,
     ) -> str:
+        from presto import pulsed
+
         # Instantiate interface class
-        with pulsed.Pulsed(
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -182,7 +192,7 @@ class ReadoutRef(Base):
             control_ns = int(
                 round(self.control_duration * pls.get_fs("dac"))
             )  # number of samples in the control template
-            control_envelope = sin2(control_ns, drag=self.drag)
+            control_envelope = sin2_envelope(control_ns, self.drag)
             control_pulse = pls.setup_template(
                 output_port=self.control_port,
                 group=0,
@@ -239,18 +249,18 @@ class ReadoutRef(Base):
             )
             self.t_arr, self.store_arr = pls.get_store_data()
 
-            if self.jpa_params is not None:
+            if self.jpa_params is not None and session is None:
                 pls.hardware.set_lmx(0.0, 0.0, self.jpa_params["pump_port"])
                 pls.hardware.set_dc_bias(0.0, self.jpa_params["bias_port"])
 
         return self.save()
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "ReadoutRef":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "ReadoutRef":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq = h5f.attrs["readout_freq"]
             control_freq = h5f.attrs["control_freq"]
             readout_amp = h5f.attrs["readout_amp"]
@@ -270,7 +280,7 @@ class ReadoutRef(Base):
             clear = ast.literal_eval(h5f.attrs["clear"])
 
             t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            store_arr = cls._load_array(h5f, "store_arr", lazy)
 
         self = cls(
             readout_freq=readout_freq,
@@ -295,20 +305,55 @@ class ReadoutRef(Base):
 
         return self
 
-    def analyze(self, plot: bool = True, rotate: bool = False, match_len: Optional[int] = None):
+    def analyze(
+        self,
+        plot: bool = True,
+        rotate: bool = False,
+        match_len: Optional[int] = None,
+        noise_var: Optional[Union[float, np.ndarray]] = None,
+    ):
+        """Choose the template-matching window and compute the reference templates.
+
+        The plain templates `ref_g` and `ref_e` are taken from the window of `match_len` samples
+        with the largest summed distance between the traces, as before. For the matched filter,
+        every window of every even length up to `match_len` is scored with the separation between
+        |g> and |e> it would give, see `_match`, and the best window of `match_len` samples is
+        returned separately: it can start elsewhere, so use it with its own delay.
+
+        Args:
+            plot: plot the traces and the chosen window.
+            rotate: rotate the traces so that their difference is along I.
+            match_len: length of the templates in samples, by default the longest the instrument
+                supports.
+            noise_var: single-shot noise variance of each complex sample, scalar or one per sample
+                in the traces. Estimated from the averaged traces if `None`, assuming white noise.
+
+        Returns:
+            a dictionary with the traces, the templates `ref_g` and `ref_e` and their
+            `readout_match_delay`; the matched-filter templates `ref_g_matched` and
+            `ref_e_matched` (within full scale) and their `matched_match_t_in_store` and
+            `matched_readout_match_delay`; the expected `separation` and
+            `assignment_error` with the templates, the matched filter and a boxcar; and for each
+            length in `match_len_arr` the best matched-filter `separation_arr` and
+            `boxcar_separation_arr`.
+        """
+        from presto.pulsed import MAX_TEMPLATE_LEN
+
         assert self.t_arr is not None
         assert self.store_arr is not None
 
         ret_fig = []
 
-        nr_samples = len(self.t_arr)
-
         trace_g = self.store_arr[0, 0, :]
         trace_e = self.store_arr[1, 0, :]
         if rotate:
             trace_g, trace_e = _rotate_opt(trace_g, trace_e)
 
-        distance = np.abs(trace_e - trace_g)
+        delta = trace_e - trace_g
+        distance = np.abs(delta)
+        if noise_var is None:
+            noise_var = estimate_noise_var(np.stack((trace_g, trace_e)), self.num_averages)
+        noise_var = np.broadcast_to(np.asarray(noise_var, np.float64), delta.shape)
 
         max_match_len = MAX_TEMPLATE_LEN // 2  # I and Q
         if match_len is None:
@@ -316,22 +361,44 @@ class ReadoutRef(Base):
         else:
             match_len = int(match_len)
             if match_len > max_match_len:  # I and Q
-                raise ValueError("maximum match length is {max_match_len}, got {match_len}")
-
-        max_idx = 0
-        max_dist = 0.0
-        for idx in range(0, nr_samples - match_len, 2):
-            dist = np.sum(distance[idx : idx + match_len])
-            if dist > max_dist:
-                max_dist = dist
-                max_idx = idx
-
-        ref_g = trace_g[max_idx : max_idx + match_len]
-        ref_e = trace_e[max_idx : max_idx + match_len]
+                raise ValueError(f"maximum match length is {max_match_len}, got {match_len}")
+
+        # score all the windows of all the lengths at once
+        match_len_arr = np.arange(2, match_len + 1, 2)
+        if match_len_arr[-1] != match_len:
+            match_len_arr = np.r_[match_len_arr, match_len]
+        idx_arr, separation_arr, boxcar_idx_arr, boxcar_separation_arr = search_windows(
+            delta, noise_var, match_len_arr
+        )
+        matched_idx = int(idx_arr[-1])
+        boxcar_idx = int(boxcar_idx_arr[-1])
+        # the plain templates keep the window with the largest summed distance
+        max_idx = distance_window(delta, match_len)
+
+        window = slice(max_idx, max_idx + match_len)
+        ref_g = trace_g[window]
+        ref_e = trace_e[window]
+        matched_window = slice(matched_idx, matched_idx + match_len)
+        ref_g_matched, ref_e_matched = matched_templates(
+            trace_g[matched_window], trace_e[matched_window], noise_var[matched_window]
+        )
+        separation_dict = {
+            "templates": separation(ref_e - ref_g, delta[window], noise_var[window]),
+            "matched": separation(
+                ref_e_matched - ref_g_matched, delta[matched_window], noise_var[matched_window]
+            ),
+            "boxcar": float(boxcar_separation_arr[-1]),
+        }
+        error_dict = {key: assignment_error(snr) for key, snr in separation_dict.items()}
+
         match_t_in_store = self.t_arr[max_idx]
         readout_match_delay = self.readout_sample_delay + match_t_in_store
+        matched_match_t_in_store = self.t_arr[matched_idx]
         print(f"Match starts at {1e9 * match_t_in_store:.0f} ns in store")
         print(f"Readout-match delay: {1e9 * readout_match_delay:.0f} ns")
+        print(f"Matched filter starts at {1e9 * matched_match_t_in_store:.0f} ns in store")
+        for key, snr in separation_dict.items():
+            print(f"Separation with {key}: {snr:.2f}, {100 * error_dict[key]:.2g}% error")
         ret_dict = {
             "trace_g": trace_g,
             "trace_e": trace_e,
@@ -339,6 +406,17 @@ class ReadoutRef(Base):
             "ref_e": ref_e,
             "match_t_in_store": match_t_in_store,
             "readout_match_delay": readout_match_delay,
+            "ref_g_matched": ref_g_matched,
+            "ref_e_matched": ref_e_matched,
+            "matched_match_t_in_store": matched_match_t_in_store,
+            "matched_readout_match_delay": self.readout_sample_delay + matched_match_t_in_store,
+            "noise_var": noise_var,
+            "separation": separation_dict,
+            "assignment_error": error_dict,
+            "boxcar_match_t_in_store": self.t_arr[boxcar_idx],
+            "match_len_arr": match_len_arr,
+            "separation_arr": separation_arr,
+            "boxcar_separation_arr": boxcar_separation_arr,
         }
 
         if plot:
@@ -394,42 +472,22 @@ class ReadoutRef(Base):
             fig2.show()
             ret_fig.append(fig2)
 
+            fig3, ax3 = plt.subplots(tight_layout=True)
+            ax3.plot(match_len_arr, separation_arr, label="matched filter")
+            ax3.plot(match_len_arr, boxcar_separation_arr, label="boxcar")
+            ax3.axvline(match_len, ls="--", c="tab:gray")
+            ax3.set_xlabel("Match length [samples]")
+            ax3.set_ylabel("Separation [σ]")
+            ax3.legend()
+            fig3.show()
+            ret_fig.append(fig3)
+
             return ret_dict, ret_fig
         else:
             return ret_dict
 
 
 def _rotate_opt(trace_g, trace_e):
-    data = trace_e - trace_g  # complex distance
-
-    # calculate the mean of data.imag**2 in steps of 1 deg
-    N = 360
-    _mean = np.zeros(N)
-    for ii in range(N):
-        _data = data * np.exp(1j * 2 * np.pi / N * ii)
-        _mean[ii] = np.mean(_data.imag**2)
-
-    # the mean goes like cos(x)**2
-    # FFT and find the phase at frequency "2"
-    fft = np.fft.rfft(_mean) / N
-    # first solution
-    x_fft1 = -np.angle(fft[2])  # compensate for measured phase
-    x_fft1 -= np.pi  # we want to be at the zero of cos(2x)
-    x_fft1 /= 2  # move from frequency "2" to "1"
-    # there's a second solution np.pi away (a minus sign)
-    x_fft2 = x_fft1 + np.pi
-
-    # convert to +/- interval
-    x_fft1 = to_pm_pi(x_fft1)
-    x_fft2 = to_pm_pi(x_fft2)
-    # choose the closest to zero
-    if np.abs(x_fft1) < np.abs(x_fft2):
-        x_fft = x_fft1
-    else:
-        x_fft = x_fft2
-
-    # rotate the data and return a copy
-    trace_g = trace_g * np.exp(1j * x_fft)
-    trace_e = trace_e * np.exp(1j * x_fft)
-
-    return trace_g, trace_e
+    # rotate both traces so that their (complex) distance is along I
+    rot = np.exp(1j * rotation_angle(trace_e - trace_g))
+    return trace_g * rot, trace_e * rot
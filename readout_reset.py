@@ -5,23 +5,21 @@ Perform pulsed readout starting from ground and excited state using template mat
 reference traces. Use feedback to correct the state of the qubit.
 """
 import ast
-from typing import List
+from typing import List, Optional
 
-import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.utils import sin2
-
 from _base import Base
+from _mixture import fit_gaussian_mixture
+from _session import Session, connect
+from _templates import Templates, sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -142,9 +140,14 @@ class ReadoutReset(Base):
         presto_address: str,
         presto_port: int = None,
         ext_ref_clk: bool = False,
+        session: Optional[Session] = None,
     ) -> str:
+        from presto import pulsed
+
         # Instantiate interface class
-        with pulsed.Pulsed(
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -249,27 +252,32 @@ class ReadoutReset(Base):
             control_ns = int(
                 round(self.control_duration * pls.get_fs("dac"))
             )  # number of samples in the control template
-            control_envelope = sin2(control_ns, drag=self.drag)
-            control_pulse = pls.setup_template(
+            control_envelope = sin2_envelope(control_ns, self.drag)
+            templates = Templates(pls)
+            control_pulse = templates.setup(
                 output_port=self.control_port,
                 group=0,
                 template=control_envelope,
                 template_q=control_envelope if self.drag == 0.0 else None,
                 envelope=True,
             )
-            control_pulse_to_g = pls.setup_template(
+            # same content, but made conditional below on opposite outcomes: they can't be shared
+            # with each other nor with the unconditional control_pulse
+            control_pulse_to_g = templates.setup(
                 output_port=self.control_port,
                 group=0,
                 template=control_envelope,
                 template_q=control_envelope if self.drag == 0.0 else None,
                 envelope=True,
+                unique=True,
             )
-            control_pulse_to_e = pls.setup_template(
+            control_pulse_to_e = templates.setup(
                 output_port=self.control_port,
                 group=0,
                 template=control_envelope,
                 template_q=control_envelope if self.drag == 0.0 else None,
                 envelope=True,
+                unique=True,
             )
 
             # Setup sampling window
@@ -375,18 +383,18 @@ class ReadoutReset(Base):
                 [match_g, match_e]
             )
 
-            if self.jpa_params is not None:
+            if self.jpa_params is not None and session is None:
                 pls.hardware.set_lmx(0.0, 0.0, self.jpa_params["pump_port"])
                 pls.hardware.set_dc_bias(0.0, self.jpa_params["bias_port"])
 
         return self.save()
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "ReadoutReset":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "ReadoutReset":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq = h5f.attrs["readout_freq"]
             control_freq = h5f.attrs["control_freq"]
             readout_amp = h5f.attrs["readout_amp"]
@@ -408,7 +416,7 @@ class ReadoutReset(Base):
             clear = ast.literal_eval(h5f.attrs["clear"])
 
             t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            store_arr = cls._load_array(h5f, "store_arr", lazy)
             ref_g = h5f["ref_g"][()]
             ref_e = h5f["ref_e"][()]
             match_g_arr = h5f["match_g_arr"][()]
@@ -440,10 +448,29 @@ class ReadoutReset(Base):
         self.store_arr = store_arr
         self.match_g_arr = match_g_arr
         self.match_e_arr = match_e_arr
+        self._filename = load_filename  # where the analysis is cached
 
         return self
 
-    def analyze(self, fix_sum: bool = True, logscale: bool = False):
+    def analyze(
+        self,
+        fix_sum: bool = True,
+        logscale: bool = False,
+        method: str = "em",
+        recompute: bool = False,
+    ):
+        """Plot the traces and the template-matching results before and after the reset.
+
+        Args:
+            fix_sum: after the reset, fit only the populations and keep the Gaussians found before
+                the reset.
+            logscale: plot the histograms on a logarithmic scale.
+            method: `"em"` to fit the Gaussian mixture to the single shots with
+                expectation-maximization, or `"hist"` to fit it to the histogram with `curve_fit`.
+            recompute: fit the data even if the results are cached in the data file, see `_cache`.
+        """
+        if method not in ("em", "hist"):
+            raise ValueError(f"method must be 'em' or 'hist', got {method!r}")
         assert self.t_arr is not None
         assert self.store_arr is not None
         assert self.match_g_arr is not None
@@ -522,25 +549,40 @@ class ReadoutReset(Base):
             init_2 = np.array(
                 [mean_low_2, std_low_2, weight_low_2, mean_high_2, std_high_2, weight_high_2]
             )
-            if fix_sum:
-                # skip second weight
-                popt_1, pcov_1 = curve_fit(double_gaussian_fixed, xdata, H_1, p0=init_1[:-1])
-
-                def double_gaussian_fixed_no_ms(x, w0):
-                    w1 = 1.0 - w0
-                    return double_gaussian(x, popt_1[0], popt_1[1], w0, popt_1[3], popt_1[4], w1)
-
-                # popt_2, pcov_2 = curve_fit(double_gaussian_fixed, xdata, H_2, p0=init_2[:-1])
-                _popt_2, pcov_2 = curve_fit(double_gaussian_fixed_no_ms, xdata, H_2, p0=init_2[2])
-                # add back second weight for ease of use
-                popt_1 = np.r_[popt_1, 1.0 - popt_1[2]]
-                # popt_2 = np.r_[popt_2, 1.0 - popt_2[2]]
-                popt_2 = popt_1.copy()
-                popt_2[2] = _popt_2[0]
-                popt_2[5] = 1 - _popt_2[0]
-            else:
-                popt_1, pcov_1 = curve_fit(double_gaussian, xdata, H_1, p0=init_1)
-                popt_2, pcov_2 = curve_fit(double_gaussian, xdata, H_2, p0=init_2)
+
+            def _fit():
+                if method == "em":
+                    popt_1, popt_2 = _fit_em(match_diff_1, match_diff_2, init_1, init_2, fix_sum)
+                elif fix_sum:
+                    # skip second weight
+                    popt_1, pcov_1 = curve_fit(double_gaussian_fixed, xdata, H_1, p0=init_1[:-1])
+
+                    def double_gaussian_fixed_no_ms(x, w0):
+                        w1 = 1.0 - w0
+                        return double_gaussian(
+                            x, popt_1[0], popt_1[1], w0, popt_1[3], popt_1[4], w1
+                        )
+
+                    # popt_2, pcov_2 = curve_fit(double_gaussian_fixed, xdata, H_2, p0=init_2[:-1])
+                    _popt_2, pcov_2 = curve_fit(
+                        double_gaussian_fixed_no_ms, xdata, H_2, p0=init_2[2]
+                    )
+                    # add back second weight for ease of use
+                    popt_1 = np.r_[popt_1, 1.0 - popt_1[2]]
+                    # popt_2 = np.r_[popt_2, 1.0 - popt_2[2]]
+                    popt_2 = popt_1.copy()
+                    popt_2[2] = _popt_2[0]
+                    popt_2[5] = 1 - _popt_2[0]
+                else:
+                    popt_1, pcov_1 = curve_fit(double_gaussian, xdata, H_1, p0=init_1)
+                    popt_2, pcov_2 = curve_fit(double_gaussian, xdata, H_2, p0=init_2)
+                return {"popt_1": popt_1, "popt_2": popt_2}
+
+            inputs = {"match_diff_1": match_diff_1, "match_diff_2": match_diff_2}
+            params = {"fix_sum": fix_sum, "method": method}
+            name = f"analyze_{'ge'[idx_excited]}"
+            results = self._cached(name, inputs, params, _fit, recompute)
+            popt_1, popt_2 = results["popt_1"], results["popt_2"]
 
             # *** Effective temperature ***
             # Teff_1 = Planck * control_freq / (Boltzmann * np.log(1 / popt_1[5] - 1))
@@ -668,6 +710,25 @@ def _threshold(ref1, ref2):
     return 0.5 * (np.sum(np.abs(ref2) ** 2) - np.sum(np.abs(ref1) ** 2))
 
 
+def _fit_em(shots_1, shots_2, init_1, init_2, fix_sum):
+    # parameters [m0, s0, w0, m1, s1, w1] of the two readouts, as from the fit to the histograms
+    def _fit(shots, init, **kwargs):
+        kwargs.setdefault("means", init[[0, 3]])
+        kwargs.setdefault("covariances", init[[1, 4]] ** 2)
+        w, m, v = fit_gaussian_mixture(shots, weights=init[[2, 5]], **kwargs)
+        s = np.sqrt(v)
+        return np.array([m[0], s[0], w[0], m[1], s[1], w[1]])
+
+    popt_1 = _fit(shots_1, init_1)
+    if fix_sum:
+        means = popt_1[[0, 3]]
+        covariances = popt_1[[1, 4]] ** 2
+        popt_2 = _fit(shots_2, init_2, means=means, covariances=covariances, weights_only=True)
+    else:
+        popt_2 = _fit(shots_2, init_2)
+    return popt_1, popt_2
+
+
 def single_gaussian(x, m, s, w):
     return w * np.exp(-((x - m) ** 2) / (2 * s**2)) / np.sqrt(2 * np.pi * s**2)
 
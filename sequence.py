@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""Run several pulsed experiments on the same qubit one after the other in a single program.
+
+A calibration round, e.g. T1, Ramsey and echo, is usually run as separate experiments, each with
+its own connection, hardware setup, upload and `pls.run`. Here the delay sweeps of all the
+experiments are programmed back to back in one period, or interleaved one delay at a time, with one
+readout pulse and one store window shared by all of them, and control templates shared where they
+have the same amplitude and frequency, e.g. the pi pulse of `T1` and of `RamseyEcho`. The stored
+traces are split on the host, so that each experiment gets its own data and can be saved and
+analyzed as if it was run alone. `CycleTs` measures T1 and echo T2 with an interleaved sequence.
+
+Example:
+    t1 = T1(control_amp=0.5, delay_arr=delay_arr, ...)
+    ramsey = RamseySingle(control_freq=control_freq + 50e3, control_amp=0.25, ...)
+    echo = RamseyEcho(control_amp_90=0.25, control_amp_180=0.5, ...)
+    seq = Sequence([t1, ramsey, echo])
+    seq.run(presto_address)
+    t1.analyze()
+    seq.report()
+"""
+import time
+from typing import Dict, List, Optional, Union
+
+from _session import Session, connect
+from _templates import Templates, phase_q, sin2_envelope
+from ramsey_echo import RamseyEcho
+from ramsey_single import RamseySingle
+from t1 import T1
+
+DAC_CURRENT = 32_000  # uA
+CONVERTER_CONFIGURATION = {
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
+}
+MAX_CONTROL_FREQS = 2  # one carrier group per control frequency on the control port
+
+# must be the same for all the experiments
+SHARED_ATTRIBUTES = [
+    "readout_freq",
+    "readout_amp",
+    "readout_port",
+    "control_port",
+    "sample_port",
+    "readout_duration",
+    "control_duration",
+    "sample_duration",
+    "readout_sample_delay",
+    "num_averages",
+    "jpa_params",
+    "drag",
+]
+
+Experiment = Union[T1, RamseySingle, RamseyEcho]
+
+
+class Sequence:
+    """Run experiments on the same qubit in a single program, one after the other.
+
+    Supported experiments are `T1`, `RamseySingle` and `RamseyEcho`, without `integrate` or
+    `reset`. All the experiments must share the readout settings, the ports, the durations, the
+    number of averages, the JPA parameters and `drag`. Each experiment keeps its own delays,
+    control amplitudes and `wait_delay`. The control frequencies can differ, e.g. for a detuned
+    Ramsey, with at most `MAX_CONTROL_FREQS` different frequencies.
+
+    Args:
+        experiments: the experiments, programmed in this order.
+        interleave: program one shot of each experiment for each delay, in turn, instead of all
+            the delays of one experiment after the other, so that slow drifts affect all of them
+            in the same way. The experiments must have the same number of delays.
+
+    Attributes:
+        timing: after `run`, the time spent in total (without saving), in the acquisition
+            (`pls.run`) and in the rest (connecting, setting up and uploading), in seconds.
+    """
+
+    def __init__(self, experiments: List[Experiment], interleave: bool = False) -> None:
+        self.experiments = list(experiments)
+        self.interleave = interleave
+        _check(self.experiments, interleave)
+        self.timing: Dict[str, float] = {}
+
+    def run(
+        self,
+        presto_address: str,
+        presto_port: int = None,
+        ext_ref_clk: bool = False,
+        save: bool = True,
+        session: Optional[Session] = None,
+    ) -> List[str]:
+        """Measure all the experiments, then save each experiment to its own file.
+
+        Returns:
+            the save filenames, in the order of the experiments; empty strings if not `save`
+        """
+        from presto import pulsed
+
+        t_start = time.perf_counter()
+        exps = self.experiments
+        first = exps[0]
+        control_freqs = sorted({exp.control_freq for exp in exps})
+        control_nco = 0.5 * (control_freqs[0] + control_freqs[-1])
+
+        # Instantiate interface class
+        with connect(
+            session,
+            pulsed.Pulsed,
+            address=presto_address,
+            port=presto_port,
+            ext_ref_clk=ext_ref_clk,
+            **CONVERTER_CONFIGURATION,
+        ) as pls:
+            assert pls.hardware is not None
+
+            pls.hardware.set_adc_attenuation(first.sample_port, 0.0)
+            pls.hardware.set_dac_current(first.readout_port, DAC_CURRENT)
+            pls.hardware.set_dac_current(first.control_port, DAC_CURRENT)
+            pls.hardware.set_inv_sinc(first.readout_port, 0)
+            pls.hardware.set_inv_sinc(first.control_port, 0)
+            pls.hardware.configure_mixer(
+                freq=first.readout_freq,
+                in_ports=first.sample_port,
+                out_ports=first.readout_port,
+                sync=False,  # sync in next call
+            )
+            pls.hardware.configure_mixer(
+                freq=control_nco,
+                out_ports=first.control_port,
+                sync=True,  # sync here
+            )
+            if first.jpa_params is not None:
+                pls.hardware.set_lmx(
+                    first.jpa_params["pump_freq"],
+                    first.jpa_params["pump_pwr"],
+                    first.jpa_params["pump_port"],
+                )
+                pls.hardware.set_dc_bias(first.jpa_params["bias"], first.jpa_params["bias_port"])
+                pls.hardware.sleep(1.0, False)
+
+            # ************************************
+            # *** Setup measurement parameters ***
+            # ************************************
+
+            # one readout pulse shared by all the experiments
+            pls.setup_freq_lut(
+                output_ports=first.readout_port,
+                group=0,
+                frequencies=0.0,
+                phases=0.0,
+                phases_q=0.0,
+            )
+            pls.setup_scale_lut(
+                output_ports=first.readout_port,
+                group=0,
+                scales=first.readout_amp,
+            )
+            readout_pulse = pls.setup_long_drive(
+                output_port=first.readout_port,
+                group=0,
+                duration=first.readout_duration,
+                amplitude=1.0,
+                amplitude_q=1.0,
+                rise_time=0e-9,
+                fall_time=0e-9,
+            )
+
+            # one carrier group per control frequency, the amplitudes are in the templates
+            for group, control_freq in enumerate(control_freqs):
+                control_if = control_freq - control_nco
+                pls.setup_freq_lut(
+                    output_ports=first.control_port,
+                    group=group,
+                    frequencies=abs(control_if),
+                    phases=0.0,
+                    phases_q=phase_q(control_if),
+                )
+                pls.setup_scale_lut(
+                    output_ports=first.control_port,
+                    group=group,
+                    scales=1.0,
+                )
+            control_ns = int(
+                round(first.control_duration * pls.get_fs("dac"))
+            )  # number of samples in the control template
+            control_envelope = sin2_envelope(control_ns, first.drag)
+            templates = Templates(pls)  # shared when same group and amplitude
+            control_pulses = []
+            for exp in exps:
+                group = control_freqs.index(exp.control_freq)
+                pulses = {}
+                for name, amp in _amplitudes(exp).items():
+                    pulses[name] = templates.setup(
+                        output_port=first.control_port,
+                        group=group,
+                        template=amp * control_envelope,
+                        template_q=amp * control_envelope if first.drag == 0.0 else None,
+                        envelope=True,
+                    )
+                control_pulses.append(pulses)
+            print(f"Control templates for {len(exps)} experiments:")
+            templates.report()
+
+            # Setup sampling window
+            pls.set_store_ports(first.sample_port)
+            pls.set_store_duration(first.sample_duration)
+
+            # ******************************
+            # *** Program pulse sequence ***
+            # ******************************
+            def readout(T):
+                pls.reset_phase(T, first.readout_port)
+                pls.output_pulse(T, readout_pulse)
+                pls.store(T + first.readout_sample_delay)
+                return T + first.readout_duration
+
+            # (experiment, control pulses, delay) of each shot, in the order of the readouts
+            if self.interleave:
+                shots = [
+                    (exp, pulses, exp.delay_arr[ii])
+                    for ii in range(len(first.delay_arr))
+                    for exp, pulses in zip(exps, control_pulses)
+                ]
+            else:
+                shots = [
+                    (exp, pulses, delay)
+                    for exp, pulses in zip(exps, control_pulses)
+                    for delay in exp.delay_arr
+                ]
+
+            T = 0.0  # s, start at time zero ...
+            for exp, pulses, delay in shots:
+                pls.reset_phase(T, first.control_port)
+                if isinstance(exp, T1):
+                    # pi pulse
+                    pls.output_pulse(T, pulses["pi"])
+                    T += exp.control_duration
+                    T += delay
+                elif isinstance(exp, RamseySingle):
+                    # two pi/2 pulses
+                    pls.output_pulse(T, pulses["pi_2"])
+                    T += exp.control_duration
+                    T += delay
+                    pls.output_pulse(T, pulses["pi_2"])
+                    T += exp.control_duration
+                else:
+                    # two pi/2 pulses with a pi pulse halfway
+                    pls.output_pulse(T, pulses["pi_2"])
+                    T += exp.control_duration
+                    T += delay / 2
+                    pls.output_pulse(T, pulses["pi"])
+                    T += exp.control_duration
+                    T += delay / 2
+                    pls.output_pulse(T, pulses["pi_2"])
+                    T += exp.control_duration
+                T = readout(T)
+                # Wait for decay
+                T += exp.wait_delay
+
+            if first.jpa_params is not None:
+                # adjust period to minimize effect of JPA idler
+                idler_freq = first.jpa_params["pump_freq"] - first.readout_freq
+                idler_if = abs(idler_freq - first.readout_freq)  # NCO at readout_freq
+                idler_period = 1 / idler_if
+                T_clk = int(round(T * pls.get_clk_f()))
+                idler_period_clk = int(round(idler_period * pls.get_clk_f()))
+                # first make T a multiple of idler period
+                if T_clk % idler_period_clk > 0:
+                    T_clk += idler_period_clk - (T_clk % idler_period_clk)
+                # then make it off by one clock cycle
+                T_clk += 1
+                T = T_clk * pls.get_clk_T()
+
+            # **************************
+            # *** Run the experiment ***
+            # **************************
+            t_run = time.perf_counter()
+            pls.run(
+                period=T,
+                repeat_count=1,
+                num_averages=first.num_averages,
+                print_time=True,
+            )
+            acquisition = time.perf_counter() - t_run
+            t_arr, store_arr = pls.get_store_data()
+
+            if first.jpa_params is not None and session is None:
+                pls.hardware.set_lmx(0.0, 0.0, first.jpa_params["pump_port"])
+                pls.hardware.set_dc_bias(0.0, first.jpa_params["bias_port"])
+
+        # split the readouts, in the order they were programmed
+        assert len(store_arr) == sum(len(exp.delay_arr) for exp in exps)
+        start = 0
+        for ii, exp in enumerate(exps):
+            exp.t_arr = t_arr
+            if self.interleave:
+                exp.store_arr = store_arr[ii :: len(exps)]
+            else:
+                exp.store_arr = store_arr[start : start + len(exp.delay_arr)]
+                start += len(exp.delay_arr)
+
+        total = time.perf_counter() - t_start
+        self.timing = {"total": total, "acquisition": acquisition, "overhead": total - acquisition}
+
+        if save:
+            return [exp.save() for exp in exps]
+        else:
+            return ["" for _ in exps]
+
+    def report(self, sequential: Optional[float] = None) -> None:
+        """Print the time spent by the last `run`.
+
+        Args:
+            sequential: if not `None`, the total time of running the same experiments one by one,
+                e.g. the sum of their `run` times, to print the reduction.
+        """
+        print(
+            f"Sequence of {len(self.experiments)} experiments: "
+            f"{self.timing['total']:.3f} s total, "
+            f"{self.timing['acquisition']:.3f} s acquisition, "
+            f"{self.timing['overhead']:.3f} s connection, setup and upload"
+        )
+        if sequential is not None:
+            saved = sequential - self.timing["total"]
+            print(
+                f"one by one: {sequential:.3f} s, saved {saved:.3f} s "
+                f"({100 * saved / sequential:.1f}%)"
+            )
+
+
+def _amplitudes(exp: Experiment) -> Dict[str, float]:
+    # control pulses of each experiment: name -> amplitude
+    if isinstance(exp, T1):
+        return {"pi": float(exp.control_amp)}
+    elif isinstance(exp, RamseySingle):
+        return {"pi_2": float(exp.control_amp)}
+    else:
+        return {"pi_2": float(exp.control_amp_90), "pi": float(exp.control_amp_180)}
+
+
+def _check(experiments: list, interleave: bool = False) -> None:
+    if len(experiments) == 0:
+        raise ValueError("expected at least one experiment")
+    first = experiments[0]
+    for exp in experiments:
+        if not isinstance(exp, (T1, RamseySingle, RamseyEcho)):
+            raise TypeError(f"unsupported experiment {type(exp).__name__}")
+        if exp.integrate or exp.reset is not None:
+            raise ValueError("integrate and reset are not supported in a sequence")
+        for attribute in SHARED_ATTRIBUTES:
+            if getattr(exp, attribute) != getattr(first, attribute):
+                raise ValueError(f"{attribute} must be the same for all experiments")
+    if interleave and len({len(exp.delay_arr) for exp in experiments}) > 1:
+        raise ValueError("interleaved experiments must have the same number of delays")
+    nr_freqs = len({exp.control_freq for exp in experiments})
+    if nr_freqs > MAX_CONTROL_FREQS:
+        raise ValueError(f"at most {MAX_CONTROL_FREQS} control frequencies, got {nr_freqs}")
@@ -2,22 +2,23 @@
 """
 Simple frequency sweep using the Lockin mode.
 """
+from typing import Optional
+
 import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import lockin
-from presto.utils import ProgressBar
-
-from _base import Base
+from _base import Base, PixelPipeline
+from _session import converter_configuration
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": DacMode.Mixed42,
-    "dac_fsample": DacFSample.G10,
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": "Mixed42",
+    "dac_fsample": "G10",
 }
+IF_MULTITONE = 10e6  # Hz, IF of the lowest tone when nr_tones > 1
+ADAPTIVE_THRESHOLD = 3.0  # refine where the response slope is more than this times the median
 
 
 class Sweep(Base):
@@ -32,6 +33,9 @@ class Sweep(Base):
         input_port: int,
         dither: bool = True,
         num_skip: int = 0,
+        nr_tones: int = 1,
+        adaptive_step: int = 1,
+        sem_target: Optional[float] = None,
     ) -> None:
         self.freq_center = freq_center
         self.freq_span = freq_span
@@ -42,9 +46,20 @@ class Sweep(Base):
         self.input_port = input_port
         self.dither = dither
         self.num_skip = num_skip
+        self.nr_tones = nr_tones  # frequencies measured simultaneously, each with amplitude amp
+        if self.nr_tones * self.amp > 1.0:
+            raise ValueError("total amplitude nr_tones * amp must be at most 1.0 FS")
+        # 1: uniform grid, else start every `adaptive_step` points and refine around resonances
+        self.adaptive_step = adaptive_step
+        if self.adaptive_step > 1 and self.nr_tones > 1:
+            raise ValueError("adaptive sampling is only available with nr_tones=1")
+        # if not None, average each point only until the standard error reaches sem_target
+        self.sem_target = sem_target
 
         self.freq_arr = None  # replaced by run
         self.resp_arr = None  # replaced by run
+        self.resp_sem_arr = None  # replaced by run
+        self.count_arr = None  # replaced by run
 
     def run(
         self,
@@ -52,11 +67,14 @@ class Sweep(Base):
         presto_port: int = None,
         ext_ref_clk: bool = False,
     ) -> str:
+        from presto import lockin
+        from presto.utils import ProgressBar
+
         with lockin.Lockin(
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
-            **CONVERTER_CONFIGURATION,
+            **converter_configuration(**CONVERTER_CONFIGURATION),
         ) as lck:
             assert lck.hardware is not None
 
@@ -74,55 +92,147 @@ class Sweep(Base):
             nr_freq = len(n_arr)
             self.freq_arr = self.df * n_arr
             self.resp_arr = np.zeros(nr_freq, np.complex128)
+            self.resp_sem_arr = np.zeros(nr_freq, np.float64)
+            self.count_arr = np.zeros(nr_freq, np.int64)
+
+            # tile the sweep in blocks of nr_tones frequencies, measured at the same time
+            # with one mixer setting: at zero IF for a single tone, else in the higher sideband
+            if self.nr_tones > 1:
+                if_offset = self.df * round(IF_MULTITONE / self.df)
+            else:
+                if_offset = 0.0
+            if_arr = if_offset + self.df * np.arange(self.nr_tones)
+            nr_blocks = (nr_freq + self.nr_tones - 1) // self.nr_tones
 
             lck.hardware.configure_mixer(
-                freq=self.freq_arr[0],
+                freq=self.freq_arr[0] - if_offset,
                 in_ports=self.input_port,
                 out_ports=self.output_port,
             )
             lck.set_df(self.df)
-            og = lck.add_output_group(self.output_port, 1)
-            og.set_frequencies(0.0)
-            og.set_amplitudes(self.amp)
-            og.set_phases(0.0, 0.0)
+            og = lck.add_output_group(self.output_port, self.nr_tones)
+            og.set_frequencies(if_arr)
+            og.set_amplitudes(np.full(self.nr_tones, self.amp))
+            if self.nr_tones > 1:
+                og.set_phases(np.zeros(self.nr_tones), np.full(self.nr_tones, -np.pi / 2))  # HSB
+            else:
+                og.set_phases(0.0, 0.0)
 
             lck.set_dither(self.dither, self.output_port)
-            ig = lck.add_input_group(self.input_port, 1)
-            ig.set_frequencies(0.0)
+            ig = lck.add_input_group(self.input_port, self.nr_tones)
+            ig.set_frequencies(if_arr)
 
             lck.apply_settings()
 
-            pb = ProgressBar(nr_freq)
-            pb.start()
-            for ii in range(len(n_arr)):
-                f = self.freq_arr[ii]
+            # overlap reduction of each point with acquisition of the next
+            with PixelPipeline(
+                lck,
+                lambda n: self._get_pixels(lck, n),
+                self.df,
+                self.num_averages,
+                self.num_skip,
+                self.sem_target,
+            ) as pipe:
+                if self.adaptive_step > 1:
+                    self._sweep_adaptive(pipe)
+                else:
+                    pb = ProgressBar(nr_blocks)
+                    pb.start()
+                    for bb in range(nr_blocks):
+                        start = bb * self.nr_tones
+                        stop = min(start + self.nr_tones, nr_freq)  # last block can be incomplete
+
+                        pipe.retune(
+                            freq=self.freq_arr[start] - if_offset,
+                            in_ports=self.input_port,
+                            out_ports=self.output_port,
+                        )
+                        pipe.acquire((start, stop))
+
+                        pb.increment()
+
+                    for (start, stop), (resp, sem, _, count) in pipe.collect():
+                        self.resp_arr[start:stop] = resp[: stop - start]
+                        self.resp_sem_arr[start:stop] = sem[: stop - start]
+                        self.count_arr[start:stop] = count
+
+                    pb.done()
+            pipe.report()
+
+            # Mute outputs at the end of the sweep
+            og.set_amplitudes(0.0)
+            lck.apply_settings()
+
+        return self.save()
 
-                lck.hardware.configure_mixer(
-                    freq=f,
+    def _sweep_adaptive(self, pipe: PixelPipeline) -> None:
+        from presto.utils import ProgressBar
+
+        # measure first on a coarse grid, then halve the spacing only in the intervals where the
+        # response changes quickly, down to df. Keep only the measured points in freq_arr/resp_arr
+        nr_freq = len(self.freq_arr)
+        measured = np.zeros(nr_freq, bool)
+        idx = np.unique(np.r_[np.arange(0, nr_freq, self.adaptive_step), nr_freq - 1])
+        threshold = None
+        nr_pass = 0
+        while len(idx) > 0:
+            nr_pass += 1
+            print(f"Pass {nr_pass}: measuring {len(idx)} frequencies")
+            pb = ProgressBar(len(idx))
+            pb.start()
+            for ii in idx:
+                pipe.retune(
+                    freq=self.freq_arr[ii],
                     in_ports=self.input_port,
                     out_ports=self.output_port,
                 )
-                lck.hardware.sleep(1e-3, False)
-
-                _d = lck.get_pixels(self.num_skip + self.num_averages, quiet=True)
-                data_i = _d[self.input_port][1][:, 0]
-                data_q = _d[self.input_port][2][:, 0]
-                data = data_i.real + 1j * data_q.real  # using zero IF
-
-                self.resp_arr[ii] = np.mean(data[-self.num_averages :])
+                pipe.acquire(ii)
 
                 pb.increment()
 
+            for ii, (resp, sem, _, count) in pipe.collect():
+                self.resp_arr[ii] = resp[0]
+                self.resp_sem_arr[ii] = sem[0]
+                self.count_arr[ii] = count
+                measured[ii] = True
             pb.done()
 
-            # Mute outputs at the end of the sweep
-            og.set_amplitudes(0.0)
-            lck.apply_settings()
-
-        return self.save()
-
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+            done = np.flatnonzero(measured)
+            gap = np.diff(done)
+            slope = np.abs(np.diff(self.resp_arr[done])) / gap  # change per df
+            if threshold is None:
+                # from the coarse pass: typical slope along the baseline
+                threshold = ADAPTIVE_THRESHOLD * np.median(slope)
+            refine = slope > threshold
+            # also refine the neighbouring intervals, not to miss the tails of a resonance
+            refine[1:] |= refine[:-1]
+            refine[:-1] |= refine[1:]
+            refine &= gap > 1
+            idx = (done[:-1][refine] + done[1:][refine]) // 2
+
+        print(
+            f"Adaptive sampling: measured {len(done)} of {nr_freq} frequencies "
+            f"({100 * (1 - len(done) / nr_freq):.0f}% saved)"
+        )
+        self.freq_arr = self.freq_arr[done]
+        self.resp_arr = self.resp_arr[done]
+        self.resp_sem_arr = self.resp_sem_arr[done]
+        self.count_arr = self.count_arr[done]
+
+    def _get_pixels(self, lck, n: int) -> np.ndarray:
+        from presto.utils import untwist_downconversion
+
+        # acquire n pixels, return shape (n, nr_tones)
+        _d = lck.get_pixels(n, quiet=True)
+        data_i = _d[self.input_port][1]
+        data_q = _d[self.input_port][2]
+        if self.nr_tones > 1:
+            _, data = untwist_downconversion(data_i, data_q)
+            return data
+        return data_i.real + 1j * data_q.real  # using zero IF
+
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
     def load(cls, load_filename: str) -> "Sweep":
@@ -136,9 +246,15 @@ class Sweep(Base):
             input_port = h5f.attrs["input_port"]
             dither = h5f.attrs["dither"]
             num_skip = h5f.attrs["num_skip"]
+            nr_tones = h5f.attrs.get("nr_tones", 1)  # not saved by older versions
+            adaptive_step = h5f.attrs.get("adaptive_step", 1)  # not saved by older versions
+            sem_target = h5f.attrs.get("sem_target")  # None if not used
 
             freq_arr = h5f["freq_arr"][()]
             resp_arr = h5f["resp_arr"][()]
+            # not saved by older versions
+            resp_sem_arr = h5f["resp_sem_arr"][()] if "resp_sem_arr" in h5f else None
+            count_arr = h5f["count_arr"][()] if "count_arr" in h5f else None
 
         self = cls(
             freq_center=freq_center,
@@ -150,9 +266,14 @@ class Sweep(Base):
             input_port=input_port,
             dither=dither,
             num_skip=num_skip,
+            nr_tones=nr_tones,
+            adaptive_step=adaptive_step,
+            sem_target=sem_target,
         )
         self.freq_arr = freq_arr
         self.resp_arr = resp_arr
+        self.resp_sem_arr = resp_sem_arr
+        self.count_arr = count_arr
 
         return self
 
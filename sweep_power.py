@@ -2,24 +2,22 @@
 """
 2D sweep of drive power and frequency in Lockin mode.
 """
-from typing import List
+from typing import List, Optional
 
 import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import lockin
-from presto.utils import ProgressBar
-
-from _base import Base
+from _base import Base, PixelPipeline
+from _session import converter_configuration
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": DacMode.Mixed42,
-    "dac_fsample": DacFSample.G10,
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": "Mixed42",
+    "dac_fsample": "G10",
 }
+IF_MULTITONE = 10e6  # Hz, IF of the lowest tone when nr_tones > 1
 
 
 class SweepPower(Base):
@@ -34,6 +32,8 @@ class SweepPower(Base):
         input_port: int,
         dither: bool = True,
         num_skip: int = 0,
+        nr_tones: int = 1,
+        sem_target: Optional[float] = None,
     ) -> None:
         self.freq_center = freq_center
         self.freq_span = freq_span
@@ -44,9 +44,18 @@ class SweepPower(Base):
         self.input_port = input_port
         self.dither = dither
         self.num_skip = num_skip
+        self.nr_tones = nr_tones  # frequencies measured simultaneously, each with amplitude amp
+        if self.nr_tones * np.max(self.amp_arr) > 1.0:
+            raise ValueError("total amplitude nr_tones * amp must be at most 1.0 FS")
+        # if not None, average each point only until the standard error reaches sem_target
+        self.sem_target = sem_target
 
         self.freq_arr = None  # replaced by run
         self.resp_arr = None  # replaced by run
+        self.resp_sem_arr = None  # replaced by run
+        self.count_arr = None  # replaced by run
+
+        self._save_filename: str = ""  # replaced by run, or by resume
 
     def run(
         self,
@@ -54,11 +63,14 @@ class SweepPower(Base):
         presto_port: int = None,
         ext_ref_clk: bool = False,
     ) -> str:
+        from presto import lockin
+        from presto.utils import ProgressBar
+
         with lockin.Lockin(
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
-            **CONVERTER_CONFIGURATION,
+            **converter_configuration(**CONVERTER_CONFIGURATION),
         ) as lck:
             assert lck.hardware is not None
 
@@ -76,59 +88,149 @@ class SweepPower(Base):
             n_stop = int(round(f_stop / self.df))
             n_arr = np.arange(n_start, n_stop + 1)
             nr_freq = len(n_arr)
-            self.freq_arr = self.df * n_arr
-            self.resp_arr = np.zeros((nr_amps, nr_freq), np.complex128)
+            freq_arr = self.df * n_arr
+
+            # save each amplitude row as soon as it's done
+            if self._save_filename:
+                # resuming
+                assert np.allclose(freq_arr, self.freq_arr)
+                rows_done = self._load_rows_done()
+            else:
+                self.freq_arr = freq_arr
+                self.resp_arr = None
+                self.resp_sem_arr = None
+                self.count_arr = None
+                self._save_filename = self._save_rows_init(
+                    __file__,
+                    None,
+                    (nr_amps,),
+                    {
+                        "resp_arr": ((nr_amps, nr_freq), np.complex128),
+                        "resp_sem_arr": ((nr_amps, nr_freq), np.float64),
+                        "count_arr": ((nr_amps, nr_freq), np.int64),
+                    },
+                )
+                rows_done = np.zeros(nr_amps, bool)
+            resp_row = np.zeros(nr_freq, np.complex128)
+            sem_row = np.zeros(nr_freq, np.float64)
+            count_row = np.zeros(nr_freq, np.int64)
+
+            # tile the sweep in blocks of nr_tones frequencies, measured at the same time
+            # with one mixer setting: at zero IF for a single tone, else in the higher sideband
+            if self.nr_tones > 1:
+                if_offset = self.df * round(IF_MULTITONE / self.df)
+            else:
+                if_offset = 0.0
+            if_arr = if_offset + self.df * np.arange(self.nr_tones)
+            nr_blocks = (nr_freq + self.nr_tones - 1) // self.nr_tones
 
             lck.hardware.configure_mixer(
-                freq=self.freq_arr[0],
+                freq=self.freq_arr[0] - if_offset,
                 in_ports=self.input_port,
                 out_ports=self.output_port,
             )
             lck.set_df(self.df)
-            og = lck.add_output_group(self.output_port, 1)
-            og.set_frequencies(0.0)
-            og.set_amplitudes(self.amp_arr[0])
-            og.set_phases(0.0, 0.0)
+            og = lck.add_output_group(self.output_port, self.nr_tones)
+            og.set_frequencies(if_arr)
+            og.set_amplitudes(np.full(self.nr_tones, self.amp_arr[0]))
+            if self.nr_tones > 1:
+                og.set_phases(np.zeros(self.nr_tones), np.full(self.nr_tones, -np.pi / 2))  # HSB
+            else:
+                og.set_phases(0.0, 0.0)
 
             lck.set_dither(self.dither, self.output_port)
-            ig = lck.add_input_group(self.input_port, 1)
-            ig.set_frequencies(0.0)
+            ig = lck.add_input_group(self.input_port, self.nr_tones)
+            ig.set_frequencies(if_arr)
 
             lck.apply_settings()
 
-            pb = ProgressBar(nr_amps * nr_freq)
-            pb.start()
-            for jj, amp in enumerate(self.amp_arr):
-                og.set_amplitudes(amp)
-                lck.apply_settings()
-
-                for ii, freq in enumerate(self.freq_arr):
-                    lck.hardware.configure_mixer(
-                        freq=freq,
-                        in_ports=self.input_port,
-                        out_ports=self.output_port,
+            # overlap reduction and saving with acquisition of the next points
+            with PixelPipeline(
+                lck,
+                lambda n: self._get_pixels(lck, n),
+                self.df,
+                self.num_averages,
+                self.num_skip,
+                self.sem_target,
+            ) as pipe:
+                pb = ProgressBar(np.sum(~rows_done) * nr_blocks)
+                pb.start()
+                for jj, amp in enumerate(self.amp_arr):
+                    if rows_done[jj]:
+                        continue
+                    og.set_amplitudes(np.full(self.nr_tones, amp))
+                    lck.apply_settings()
+
+                    for bb in range(nr_blocks):
+                        start = bb * self.nr_tones
+                        stop = min(start + self.nr_tones, nr_freq)  # last block can be incomplete
+
+                        pipe.retune(
+                            freq=self.freq_arr[start] - if_offset,
+                            in_ports=self.input_port,
+                            out_ports=self.output_port,
+                        )
+
+                        pipe.acquire((start, stop))
+
+                        pb.increment()
+
+                    for (start, stop), (resp, sem, _, count) in pipe.collect():
+                        resp_row[start:stop] = resp[: stop - start]
+                        sem_row[start:stop] = sem[: stop - start]
+                        count_row[start:stop] = count
+                    # save in background while the next row is measured
+                    pipe.submit(
+                        self._save_row,
+                        jj,
+                        resp_arr=resp_row.copy(),
+                        resp_sem_arr=sem_row.copy(),
+                        count_arr=count_row.copy(),
                     )
-                    lck.hardware.sleep(1e-3, False)
-
-                    _d = lck.get_pixels(self.num_skip + self.num_averages, quiet=True)
-                    data_i = _d[self.input_port][1][:, 0]
-                    data_q = _d[self.input_port][2][:, 0]
-                    data = data_i.real + 1j * data_q.real  # using zero IF
 
-                    self.resp_arr[jj, ii] = np.mean(data[-self.num_averages :])
-
-                    pb.increment()
-
-            pb.done()
+                pb.done()
+            pipe.report()
 
             # Mute outputs at the end of the sweep
             og.set_amplitudes(0.0)
             lck.apply_settings()
 
-        return self.save()
+        save_filename = self._save_filename
+        self._save_filename = ""
+        with h5py.File(save_filename, "r") as h5f:
+            self.resp_arr = h5f["resp_arr"][()]
+            self.resp_sem_arr = h5f["resp_sem_arr"][()]
+            self.count_arr = h5f["count_arr"][()]
+        print(f"Data saved to: {save_filename}")
+        return save_filename
+
+    def _get_pixels(self, lck, n: int) -> np.ndarray:
+        from presto.utils import untwist_downconversion
+
+        # acquire n pixels, return shape (n, nr_tones)
+        _d = lck.get_pixels(n, quiet=True)
+        data_i = _d[self.input_port][1]
+        data_q = _d[self.input_port][2]
+        if self.nr_tones > 1:
+            _, data = untwist_downconversion(data_i, data_q)
+            return data
+        return data_i.real + 1j * data_q.real  # using zero IF
+
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    @classmethod
+    def resume(
+        cls,
+        load_filename: str,
+        presto_address: str,
+        presto_port: int = None,
+        ext_ref_clk: bool = False,
+    ) -> str:
+        """Continue an interrupted `run`, measuring only the rows missing in `load_filename`."""
+        self = cls.load(load_filename)
+        self._save_filename = load_filename
+        return self.run(presto_address, presto_port, ext_ref_clk)
 
     @classmethod
     def load(cls, load_filename: str) -> "SweepPower":
@@ -141,10 +243,15 @@ class SweepPower(Base):
             input_port = h5f.attrs["input_port"]
             dither = h5f.attrs["dither"]
             num_skip = h5f.attrs["num_skip"]
+            sem_target = h5f.attrs.get("sem_target")  # None if not used
+            nr_tones = h5f.attrs.get("nr_tones", 1)  # not saved by older versions
 
             amp_arr = h5f["amp_arr"][()]
             freq_arr = h5f["freq_arr"][()]
             resp_arr = h5f["resp_arr"][()]
+            # not saved by older versions
+            resp_sem_arr = h5f["resp_sem_arr"][()] if "resp_sem_arr" in h5f else None
+            count_arr = h5f["count_arr"][()] if "count_arr" in h5f else None
 
         self = cls(
             freq_center=freq_center,
@@ -156,9 +263,13 @@ class SweepPower(Base):
             input_port=input_port,
             dither=dither,
             num_skip=num_skip,
+            nr_tones=nr_tones,
+            sem_target=sem_target,
         )
         self.freq_arr = freq_arr
         self.resp_arr = resp_arr
+        self.resp_sem_arr = resp_sem_arr
+        self.count_arr = count_arr
 
         return self
 
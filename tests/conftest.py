@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Simulated data files for the tests."""
+import numpy as np
+import pytest
+
+COMMON = dict(
+    readout_freq=6.2e9,
+    control_freq=4.1e9,
+    readout_amp=0.1,
+    readout_duration=2e-6,
+    control_duration=20e-9,
+    sample_duration=3e-6,
+    readout_port=1,
+    control_port=4,
+    sample_port=1,
+    wait_delay=100e-6,
+    readout_sample_delay=0.0,
+    num_averages=100,
+)
+T1_TRUE = 30e-6  # s
+COMPRESSED = dict(compression="gzip", shuffle=True, downcast=True)  # save options
+
+
+@pytest.fixture
+def t1_file(tmp_path):
+    """Save a simulated T1 measurement in `tmp_path`: `t1_file(basename, **save_kwargs)`."""
+    pytest.importorskip("presto")  # Base.save saves the source code with presto.utils
+    from t1 import T1
+
+    def save(basename="t1_20260101_120000.h5", **save_kwargs):
+        rng = np.random.default_rng(0)
+        delay_arr = np.linspace(0, 150e-6, 51)
+        experiment = T1(control_amp=0.5, delay_arr=delay_arr, **COMMON)
+        resp = np.exp(-delay_arr / T1_TRUE) * np.exp(0.3j)
+        noise = rng.normal(size=(len(delay_arr), 1, 3000))
+        experiment.t_arr = np.arange(3000) * 1e-9
+        experiment.store_arr = resp[:, None, None] + 0.01 * noise
+        return experiment.save(save_filename=str(tmp_path / basename), **save_kwargs)
+
+    return save
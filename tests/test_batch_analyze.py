@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""Summary of a data directory with `batch_analyze`."""
+import h5py
+import pytest
+from conftest import COMPRESSED, T1_TRUE
+
+import batch_analyze
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_analyze_files_caches_compressed(t1_file, capsys, max_workers):
+    filenames = [t1_file("t1_20260101_120000.h5", **COMPRESSED)]
+
+    rows = batch_analyze.analyze_files(filenames, max_workers=max_workers)
+    assert "unable to cache" not in capsys.readouterr().out
+    assert len(rows) == 1
+    assert "error" not in rows[0]
+    assert rows[0]["experiment"] == "t1"
+    assert rows[0]["T1"] == pytest.approx(T1_TRUE, rel=0.05)
+    with h5py.File(filenames[0], "r") as h5f:
+        assert "analyze_batch" in h5f["analysis"]
+
+    # the second pass reads the cache
+    assert batch_analyze.analyze_files(filenames, max_workers=max_workers) == rows
+
+
+def test_write_summary(t1_file, tmp_path):
+    rows = batch_analyze.analyze_files([t1_file()], max_workers=1)
+    output = str(tmp_path / "summary.csv")
+    batch_analyze.write_summary(rows, output)
+    with open(output) as f:
+        header = f.readline().strip().split(",")
+    assert header[:3] == ["file", "experiment", "timestamp"]
+    assert "T1" in header and "T1_err" in header
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""Round trip of the analysis cache in the data file, see `_cache`."""
+import h5py
+import numpy as np
+import pytest
+from conftest import COMPRESSED, T1_TRUE
+
+from t1 import T1
+
+
+@pytest.mark.parametrize("save_kwargs", [{}, COMPRESSED])
+def test_lazy_analyze_batch_is_cached(t1_file, capsys, save_kwargs):
+    filename = t1_file(**save_kwargs)
+
+    _, (popt, _) = T1.load(filename, lazy=True).analyze_batch()
+    assert "unable to cache" not in capsys.readouterr().out
+    with h5py.File(filename, "r") as h5f:
+        assert "analysis" in h5f
+        assert "analyze_batch" in h5f["analysis"]
+    assert popt[0] == pytest.approx(T1_TRUE, rel=0.05)
+
+    # read back from the cache, on a new lazy load
+    _, (popt_cached, _) = T1.load(filename, lazy=True).analyze_batch()
+    assert np.array_equal(popt_cached, popt)
@@ -2,23 +2,21 @@
 """
 Two-tone spectroscopy in Lockin mode: 2D sweep of pump power and frequency, with fixed probe.
 """
-from typing import List
+from typing import List, Optional
 
 import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import lockin
-from presto.utils import ProgressBar, rotate_opt
-
-from _base import Base
+from _base import Base, PixelPipeline
+from _rotate import rotate_opt
+from _session import converter_configuration
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 
 
@@ -37,6 +35,7 @@ class TwoTonePower(Base):
         num_averages: int,
         dither: bool = True,
         num_skip: int = 0,
+        sem_target: Optional[float] = None,
     ) -> None:
         self.readout_freq = readout_freq
         self.control_freq_center = control_freq_center
@@ -50,9 +49,15 @@ class TwoTonePower(Base):
         self.num_averages = num_averages
         self.dither = dither
         self.num_skip = num_skip
+        # if not None, average each point only until the standard error reaches sem_target
+        self.sem_target = sem_target
 
         self.control_freq_arr = None  # replaced by run
         self.resp_arr = None  # replaced by run
+        self.resp_sem_arr = None  # replaced by run
+        self.count_arr = None  # replaced by run
+
+        self._save_filename: str = ""  # replaced by run, or by resume
 
     def run(
         self,
@@ -60,11 +65,14 @@ class TwoTonePower(Base):
         presto_port: int = None,
         ext_ref_clk: bool = False,
     ) -> str:
+        from presto import lockin
+        from presto.utils import ProgressBar
+
         with lockin.Lockin(
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
-            **CONVERTER_CONFIGURATION,
+            **converter_configuration(**CONVERTER_CONFIGURATION),
         ) as lck:
             assert lck.hardware is not None
 
@@ -86,8 +94,32 @@ class TwoTonePower(Base):
             n_stop = int(round(f_stop / self.df))
             n_arr = np.arange(n_start, n_stop + 1)
             nr_freq = len(n_arr)
-            self.control_freq_arr = self.df * n_arr
-            self.resp_arr = np.zeros((nr_amps, nr_freq), np.complex128)
+            control_freq_arr = self.df * n_arr
+
+            # save each amplitude row as soon as it's done
+            if self._save_filename:
+                # resuming
+                assert np.allclose(control_freq_arr, self.control_freq_arr)
+                rows_done = self._load_rows_done()
+            else:
+                self.control_freq_arr = control_freq_arr
+                self.resp_arr = None
+                self.resp_sem_arr = None
+                self.count_arr = None
+                self._save_filename = self._save_rows_init(
+                    __file__,
+                    None,
+                    (nr_amps,),
+                    {
+                        "resp_arr": ((nr_amps, nr_freq), np.complex128),
+                        "resp_sem_arr": ((nr_amps, nr_freq), np.float64),
+                        "count_arr": ((nr_amps, nr_freq), np.int64),
+                    },
+                )
+                rows_done = np.zeros(nr_amps, bool)
+            resp_row = np.zeros(nr_freq, np.complex128)
+            sem_row = np.zeros(nr_freq, np.float64)
+            count_row = np.zeros(nr_freq, np.int64)
 
             lck.hardware.configure_mixer(
                 freq=self.readout_freq,
@@ -114,29 +146,46 @@ class TwoTonePower(Base):
 
             lck.apply_settings()
 
-            pb = ProgressBar(nr_amps * nr_freq)
-            pb.start()
-            for jj, control_amp in enumerate(self.control_amp_arr):
-                ogc.set_amplitudes(control_amp)
-                lck.apply_settings()
-
-                for ii, control_freq in enumerate(self.control_freq_arr):
-                    lck.hardware.configure_mixer(
-                        freq=control_freq,
-                        out_ports=self.control_port,
+            # overlap reduction and saving with acquisition of the next points
+            with PixelPipeline(
+                lck,
+                lambda n: self._get_pixels(lck, n),
+                self.df,
+                self.num_averages,
+                self.num_skip,
+                self.sem_target,
+            ) as pipe:
+                pb = ProgressBar(np.sum(~rows_done) * nr_freq)
+                pb.start()
+                for jj, control_amp in enumerate(self.control_amp_arr):
+                    if rows_done[jj]:
+                        continue
+                    ogc.set_amplitudes(control_amp)
+                    lck.apply_settings()
+
+                    for ii, control_freq in enumerate(self.control_freq_arr):
+                        pipe.retune(
+                            freq=control_freq,
+                            out_ports=self.control_port,
+                        )
+
+                        pipe.acquire(ii)
+
+                        pb.increment()
+
+                    for ii, (resp, sem, _, count) in pipe.collect():
+                        resp_row[ii], sem_row[ii], count_row[ii] = resp, sem, count
+                    # save in background while the next row is measured
+                    pipe.submit(
+                        self._save_row,
+                        jj,
+                        resp_arr=resp_row.copy(),
+                        resp_sem_arr=sem_row.copy(),
+                        count_arr=count_row.copy(),
                     )
-                    lck.hardware.sleep(1e-3, False)
-
-                    _d = lck.get_pixels(self.num_skip + self.num_averages, quiet=True)
-                    data_i = _d[self.input_port][1][:, 0]
-                    data_q = _d[self.input_port][2][:, 0]
-                    data = data_i.real + 1j * data_q.real  # using zero IF
-
-                    self.resp_arr[jj, ii] = np.mean(data[-self.num_averages :])
 
-                    pb.increment()
-
-            pb.done()
+                pb.done()
+            pipe.report()
 
             # Mute outputs at the end of the sweep
             ogr.set_amplitudes(0.0)
@@ -148,10 +197,37 @@ class TwoTonePower(Base):
         #     mla.lockin.set_dc_offset(jpa_bias_port, 0.0)
         #     mla.disconnect()
 
-        return self.save()
+        save_filename = self._save_filename
+        self._save_filename = ""
+        with h5py.File(save_filename, "r") as h5f:
+            self.resp_arr = h5f["resp_arr"][()]
+            self.resp_sem_arr = h5f["resp_sem_arr"][()]
+            self.count_arr = h5f["count_arr"][()]
+        print(f"Data saved to: {save_filename}")
+        return save_filename
+
+    def _get_pixels(self, lck, n: int) -> np.ndarray:
+        # acquire n pixels, return shape (n,)
+        _d = lck.get_pixels(n, quiet=True)
+        data_i = _d[self.input_port][1][:, 0]
+        data_q = _d[self.input_port][2][:, 0]
+        return data_i.real + 1j * data_q.real  # using zero IF
+
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    @classmethod
+    def resume(
+        cls,
+        load_filename: str,
+        presto_address: str,
+        presto_port: int = None,
+        ext_ref_clk: bool = False,
+    ) -> str:
+        """Continue an interrupted `run`, measuring only the rows missing in `load_filename`."""
+        self = cls.load(load_filename)
+        self._save_filename = load_filename
+        return self.run(presto_address, presto_port, ext_ref_clk)
 
     @classmethod
     def load(cls, load_filename: str) -> "TwoTonePower":
@@ -167,10 +243,14 @@ class TwoTonePower(Base):
             num_averages = h5f.attrs["num_averages"]
             dither = h5f.attrs["dither"]
             num_skip = h5f.attrs["num_skip"]
+            sem_target = h5f.attrs.get("sem_target")  # None if not used
 
             control_amp_arr = h5f["control_amp_arr"][()]
             control_freq_arr = h5f["control_freq_arr"][()]
             resp_arr = h5f["resp_arr"][()]
+            # not saved by older versions
+            resp_sem_arr = h5f["resp_sem_arr"][()] if "resp_sem_arr" in h5f else None
+            count_arr = h5f["count_arr"][()] if "count_arr" in h5f else None
 
         self = cls(
             readout_freq=readout_freq,
@@ -185,9 +265,12 @@ class TwoTonePower(Base):
             num_averages=num_averages,
             dither=dither,
             num_skip=num_skip,
+            sem_target=sem_target,
         )
         self.control_freq_arr = control_freq_arr
         self.resp_arr = resp_arr
+        self.resp_sem_arr = resp_sem_arr
+        self.count_arr = count_arr
 
         return self
 
@@ -218,7 +301,7 @@ class TwoTonePower(Base):
                 data = np.abs(self.resp_arr)
                 title = "Response amplitude"
             else:  # "quadrature"
-                data = rotate_opt(self.resp_arr).real
+                data = rotate_opt(self.resp_arr, real=True)
                 title = "Response quadrature"
             data_max = np.abs(data).max()
             unit = ""
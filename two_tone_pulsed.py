@@ -3,22 +3,24 @@
 Two-tone spectroscopy with Pulsed mode: sweep of pump frequency, with fixed pump power and fixed probe.
 """
 import ast
+from functools import partial
+from typing import Optional
 
-import h5py
 import numpy as np
 
-from presto.hardware import AdcFSample, AdcMode, DacFSample, DacMode
-from presto import pulsed
-from presto.utils import rotate_opt, sin2
-
-from _base import Base
+from _base import Base, get_integration_data, setup_integration
+from _bootstrap import bootstrap, check_averaged
+from _reset import ActiveReset
+from _rotate import rotate_opt
+from _session import Session, connect
+from _templates import sin2_envelope
 
 DAC_CURRENT = 32_000  # uA
 CONVERTER_CONFIGURATION = {
-    "adc_mode": AdcMode.Mixed,
-    "adc_fsample": AdcFSample.G4,
-    "dac_mode": [DacMode.Mixed42, DacMode.Mixed02, DacMode.Mixed02, DacMode.Mixed02],
-    "dac_fsample": [DacFSample.G10, DacFSample.G6, DacFSample.G6, DacFSample.G6],
+    "adc_mode": "Mixed",
+    "adc_fsample": "G4",
+    "dac_mode": ["Mixed42", "Mixed02", "Mixed02", "Mixed02"],
+    "dac_fsample": ["G10", "G6", "G6", "G6"],
 }
 IDX_LOW = 1_500
 IDX_HIGH = 2_000
@@ -44,6 +46,9 @@ class TwoTonePulsed(Base):
         num_averages: int,
         jpa_params: dict = None,
         drag: float = 0.0,
+        integrate: bool = False,
+        nr_raw_traces: int = 0,
+        reset: Optional[ActiveReset] = None,
     ) -> None:
         self.readout_freq = readout_freq
         self.control_freq_center = control_freq_center
@@ -61,9 +66,18 @@ class TwoTonePulsed(Base):
         self.readout_sample_delay = readout_sample_delay
         self.num_averages = num_averages
         self.drag = drag
+        # integrate the readout on the instrument, transferring one complex number per shot
+        self.integrate = integrate
+        # with integrate, store anyway the full traces of the first nr_raw_traces readouts in
+        # the sequence
+        self.nr_raw_traces = nr_raw_traces
+        # if not None, reset the qubit actively at the end of each shot instead of waiting for
+        # wait_delay
+        self.reset = reset
 
         self.t_arr = None  # replaced by run
         self.store_arr = None  # replaced by run
+        self.integrated_arr = None  # replaced by run, if integrate
         self.control_freq_arr = None  # replaced by run
 
         self.jpa_params = jpa_params
@@ -73,8 +87,13 @@ class TwoTonePulsed(Base):
         presto_address: str,
         presto_port: int = None,
         ext_ref_clk: bool = False,
+        session: Optional[Session] = None,
     ) -> str:
-        with pulsed.Pulsed(
+        from presto import pulsed
+
+        with connect(
+            session,
+            pulsed.Pulsed,
             address=presto_address,
             port=presto_port,
             ext_ref_clk=ext_ref_clk,
@@ -167,7 +186,7 @@ class TwoTonePulsed(Base):
             control_ns = int(
                 round(self.control_duration * pls.get_fs("dac"))
             )  # number of samples in the control template
-            control_envelope = sin2(control_ns, drag=self.drag)
+            control_envelope = sin2_envelope(control_ns, self.drag)
             control_pulse = pls.setup_template(
                 output_port=self.control_port,
                 group=0,
@@ -177,8 +196,25 @@ class TwoTonePulsed(Base):
             )
 
             # Setup sampling window
-            pls.set_store_ports(self.sample_port)
-            pls.set_store_duration(self.sample_duration)
+            nr_stored = 1  # readouts in the sequence
+            if self.integrate:
+                matches, match_delay = setup_integration(
+                    pls, self.sample_port, IDX_LOW, IDX_HIGH
+                )
+                nr_stored = min(self.nr_raw_traces, nr_stored)
+            if nr_stored > 0:
+                pls.set_store_ports(self.sample_port)
+                pls.set_store_duration(self.sample_duration)
+            if self.reset is not None:
+                self.reset.setup(
+                    pls,
+                    self.sample_port,
+                    self.control_port,
+                    control_nco,
+                    readout_pulse,
+                    self.readout_duration,
+                    control_envelope,
+                )
 
             # ******************************
             # *** Program pulse sequence ***
@@ -192,14 +228,20 @@ class TwoTonePulsed(Base):
             pls.reset_phase(T, self.readout_port)
             pls.output_pulse(T, readout_pulse)
             # Sampling window
-            pls.store(T + self.readout_sample_delay)
+            if nr_stored > 0:
+                pls.store(T + self.readout_sample_delay)
+            if self.integrate:
+                pls.match(T + self.readout_sample_delay + match_delay, matches)
             # Move to next Rabi amplitude
             T += self.readout_duration
             pls.next_frequency(
                 T, self.control_port
             )  # every iteration will have a different frequency
             # Wait for decay
-            T += self.wait_delay
+            if self.reset is None:
+                T += self.wait_delay
+            else:
+                T = self.reset.program(pls, T)
 
             if self.jpa_params is not None:
                 # adjust period to minimize effect of JPA idler
@@ -226,20 +268,27 @@ class TwoTonePulsed(Base):
                 num_averages=self.num_averages,
                 print_time=True,
             )
-            self.t_arr, self.store_arr = pls.get_store_data()
+            if nr_stored > 0:
+                self.t_arr, self.store_arr = pls.get_store_data()
+            if self.reset is not None:
+                self.reset.get_data(pls, self.control_freq_nr)
+            if self.integrate:
+                self.integrated_arr = get_integration_data(
+                    pls, matches, self.control_freq_nr, IDX_HIGH - IDX_LOW
+                )
 
-            if self.jpa_params is not None:
+            if self.jpa_params is not None and session is None:
                 pls.hardware.set_lmx(0.0, 0.0, self.jpa_params["pump_port"])
                 pls.hardware.set_dc_bias(0.0, self.jpa_params["bias_port"])
 
         return self.save()
 
-    def save(self, save_filename: str = None) -> str:
-        return super().save(__file__, save_filename=save_filename)
+    def save(self, save_filename: str = None, **kwargs) -> str:
+        return super().save(__file__, save_filename=save_filename, **kwargs)
 
     @classmethod
-    def load(cls, load_filename: str) -> "TwoTonePulsed":
-        with h5py.File(load_filename, "r") as h5f:
+    def load(cls, load_filename: str, lazy: bool = False) -> "TwoTonePulsed":
+        with cls._open_load(load_filename, lazy) as h5f:
             readout_freq = h5f.attrs["readout_freq"]
             control_freq_center = h5f.attrs["control_freq_center"]
             control_freq_span = h5f.attrs["control_freq_span"]
@@ -258,8 +307,14 @@ class TwoTonePulsed(Base):
 
             jpa_params = ast.literal_eval(h5f.attrs["jpa_params"])
 
-            t_arr = h5f["t_arr"][()]
-            store_arr = h5f["store_arr"][()]
+            # not saved when integrating on the instrument without raw traces
+            t_arr = h5f["t_arr"][()] if "t_arr" in h5f else None
+            store_arr = cls._load_array(h5f, "store_arr", lazy) if "store_arr" in h5f else None
+            integrated_arr = h5f["integrated_arr"][()] if "integrated_arr" in h5f else None
+            # not saved by older versions
+            integrate = h5f.attrs.get("integrate", False)
+            nr_raw_traces = h5f.attrs.get("nr_raw_traces", 0)
+            reset = ActiveReset.load(h5f)
             control_freq_arr = h5f["control_freq_arr"][()]
 
             try:
@@ -285,28 +340,38 @@ class TwoTonePulsed(Base):
             num_averages=num_averages,
             jpa_params=jpa_params,
             drag=drag,
+            integrate=integrate,
+            nr_raw_traces=nr_raw_traces,
+            reset=reset,
         )
         self.t_arr = t_arr
         self.store_arr = store_arr
+        self.integrated_arr = integrated_arr
         self.control_freq_arr = control_freq_arr
 
         return self
 
-    def analyze(self, all_plots: bool = False):
-        assert self.t_arr is not None
-        assert self.store_arr is not None
+    def analyze(self, all_plots: bool = False, uncertainty: Optional[str] = None):
+        """Plot the data and fit the qubit line with a Gaussian.
+
+        Args:
+            all_plots: also plot the raw traces.
+            uncertainty: `None` for the standard errors of the fit, or a resampling method of
+                `_bootstrap.bootstrap`, e.g. `"residuals"` or `"jackknife"`, for errors that don't
+                assume a perfect model. The confidence interval is printed as well. Not
+                `"repetitions"`: the data are averaged over the repetitions.
+        """
+        check_averaged(uncertainty)
+        assert self.store_arr is not None or self.integrated_arr is not None
         assert self.control_freq_arr is not None
 
         import matplotlib.pyplot as plt
-        from scipy.optimize import curve_fit
 
         ret_fig = []
 
-        idx = np.arange(IDX_LOW, IDX_HIGH)
-        t_low = self.t_arr[IDX_LOW]
-        t_high = self.t_arr[IDX_HIGH]
-
-        if all_plots:
+        if all_plots and self.store_arr is not None:
+            t_low = self.t_arr[IDX_LOW]
+            t_high = self.t_arr[IDX_HIGH]
             # Plot raw store data for first iteration as a check
             fig1, ax1 = plt.subplots(2, 1, sharex=True, tight_layout=True)
             ax11, ax12 = ax1
@@ -319,7 +384,7 @@ class TwoTonePulsed(Base):
             ret_fig.append(fig1)
 
         # Analyze
-        resp_arr = np.mean(self.store_arr[:, 0, idx], axis=-1)
+        resp_arr = self._readout_resp(IDX_LOW, IDX_HIGH)
         data = rotate_opt(resp_arr)
 
         fig2, ax2 = plt.subplots(4, 1, sharex=True, figsize=(6.4, 6.4), tight_layout=True)
@@ -332,10 +397,18 @@ class TwoTonePulsed(Base):
             data_max = data.real.max()
             data_rng = data_max - data_min
             p0 = [self.control_freq_center, self.control_freq_span / 4, data_rng, data_min]
-            popt, pcov = curve_fit(_gaussian, self.control_freq_arr, data.real, p0)
+            if uncertainty is None:
+                popt, _ = _fit_gaussian(self.control_freq_arr, data.real, p0)
+            else:
+                fit = partial(_fit_gaussian, p0=p0)
+                popt, _, ci = bootstrap(
+                    fit, _gaussian, self.control_freq_arr, data.real, uncertainty
+                )
             ax23.plot(1e-9 * self.control_freq_arr, _gaussian(self.control_freq_arr, *popt), "--")
             print(f"f0 = {popt[0]} Hz")
             print(f"sigma = {abs(popt[1])} Hz")
+            if uncertainty is not None:
+                print(f"f0 interval ({uncertainty}): {ci[0, 0]} to {ci[1, 0]} Hz")
         except Exception:
             print("fit failed")
         ax24.plot(1e-9 * self.control_freq_arr, np.imag(data))
@@ -357,3 +430,11 @@ def _lorentzian(x, x0, gamma, a, o):
 
 def _gaussian(x, x0, s, a, o):
     return a * np.exp(-0.5 * ((x - x0) / s) ** 2) + o
+
+
+def _fit_gaussian(x, y, p0):
+    from scipy.optimize import curve_fit
+
+    popt, pcov = curve_fit(_gaussian, x, y, p0)
+    perr = np.sqrt(np.diag(pcov))
+    return popt, perr